@@ -0,0 +1,159 @@
+# %%
+import time
+
+import numpy as np
+
+import serialize
+import to_cell_json as tcj
+
+# %%
+
+SRAM_EXAMPLE = "examples/sram_2_16_sky130A.gds"
+SKY130_EXAMPLES = ("examples/example_sky130.gds", SRAM_EXAMPLE)
+
+
+def timeit(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, result
+
+
+def get_reference_tree(cell, tree=None):
+    """Return cell key -> references for all cells below cell."""
+    if tree is None:
+        tree = {}
+    key = tcj.get_cell_key(cell)
+    if key not in tree:
+        tree[key] = tcj.get_references(cell)
+        for reference in tree[key]:
+            get_reference_tree(reference["cell"], tree)
+    return tree
+
+
+def compose_hierarchy(tree, cell, parent_matrices=None):
+    """Compose the transform stacks of all hierarchy paths below cell.
+
+    Returns the number of composed matrices.
+    """
+    count = 0
+    for reference in tree[tcj.get_cell_key(cell)]:
+        matrices = reference["matrices"]
+        if parent_matrices is not None:
+            matrices = tcj.compose_matrices(parent_matrices, matrices)
+        tcj.to_matrix_buffer(matrices)
+        count += len(matrices) + compose_hierarchy(tree, reference["cell"], matrices)
+    return count
+
+
+def compose_hierarchy_loop(tree, cell, parent_matrices=None):
+    """Reference implementation with one 3x3 matmul per (parent, child) pair."""
+    count = 0
+    for reference in tree[tcj.get_cell_key(cell)]:
+        if parent_matrices is None:
+            matrices = reference["matrices3"]
+        else:
+            matrices = [
+                matrix @ child_matrix
+                for child_matrix in reference["matrices3"]
+                for matrix in parent_matrices
+            ]
+        np.asarray([matrix[:2].reshape(-1) for matrix in matrices], dtype="float32")
+        count += len(matrices) + compose_hierarchy_loop(
+            tree, reference["cell"], matrices
+        )
+    return count
+
+
+def bench_matrices(filename=SRAM_EXAMPLE):
+    tcj.init_sky130()
+    lib = tcj.read_gds(filename)
+    top_cell = lib.top_level()[0]
+
+    tree = get_reference_tree(top_cell)
+    for references in tree.values():
+        for reference in references:
+            reference["matrices3"] = [
+                np.vstack([matrix, (0, 0, 1)]) for matrix in reference["matrices"]
+            ]
+
+    for name, func in (
+        ("batched", compose_hierarchy),
+        ("loop", compose_hierarchy_loop),
+    ):
+        duration, count = timeit(lambda: func(tree, top_cell))
+        print(
+            f"{name:>8}: {count} matrices in {duration:.4f}s"
+            f" = {count / duration:,.0f} matrices/s"
+        )
+
+
+def get_arrays(value):
+    """All ndarrays of a converted assembly, once per JSON occurrence."""
+    if isinstance(value, np.ndarray):
+        return [value]
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [array for el in value for array in get_arrays(el)]
+    return []
+
+
+def bench_codec(arrays, codecs):
+    """Encode and decode all arrays with encode_buffer(codecs).
+
+    Returns the encoded size, encode and decode seconds and the codecs used.
+    """
+    start = time.perf_counter()
+    buffers = [serialize.encode_buffer(array, codecs) for array in arrays]
+    encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for buffer in buffers:
+        serialize.decode_buffer(buffer)
+    decode = time.perf_counter() - start
+
+    encoded = sum(len(buffer["buffer"]) for buffer in buffers)
+    used = {buffer["codec"] for buffer in buffers}
+    return encoded, encode, decode, used
+
+
+def bench_codecs(filenames=SKY130_EXAMPLES):
+    """Compression ratio (vs. plain b64) and speed of the buffer codecs."""
+    tcj.init_sky130()
+    for filename in filenames:
+        lib = tcj.read_gds(filename)
+        for encoding in ("float", "int"):
+            arrays = get_arrays(tcj.to_json(lib, return_json=False, encoding=encoding))
+            raw = sum(array.nbytes for array in arrays)
+            base, *_ = bench_codec(arrays, None)
+            print(f"{filename} {encoding}: {len(arrays)} buffers, {raw:,} bytes")
+
+            # single codecs fall back to b64 where they do not shrink a buffer
+            codecs = serialize.get_codecs(zstd=True)
+            for name, candidates in [(c, [c]) for c in codecs] + [("best", codecs)]:
+                encoded, encode, decode, used = bench_codec(arrays, candidates)
+                print(
+                    f"  {name:>36}: ratio {base / encoded:5.2f}"
+                    f" encode {raw / encode / 1e6:7.1f} MB/s"
+                    f" decode {raw / decode / 1e6:7.1f} MB/s"
+                    + (f" ({len(used)} codecs used)" if name == "best" else "")
+                )
+
+
+BENCHMARKS = {
+    "matrices": bench_matrices,
+    "codecs": bench_codecs,
+}
+
+# %%
+if __name__ == "__main__":
+    import sys
+
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS)
+    for name in names:
+        print(f"# {name}")
+        BENCHMARKS[name]()
@@ -0,0 +1,124 @@
+# %%
+import hashlib
+import os
+
+import numpy as np
+
+# bump when the layout of the cached arrays or the grouping changes
+CACHE_VERSION = 2
+
+# %%
+
+
+def hash_cell(layer_polygons, references, settings):
+    """Content hash of a cell.
+
+    Args:
+        layer_polygons: dict of layer -> list of polygon point arrays.
+        references: list of (child hash, (N, 2, 3) matrices).
+        settings: repr of the PDK layer table and grouping settings, so that
+          changing them invalidates all cells.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{CACHE_VERSION}:{settings}".encode())
+    for layer in sorted(layer_polygons):
+        polygons = layer_polygons[layer]
+        digest.update(repr(layer).encode())
+        digest.update(np.asarray([len(p) for p in polygons], dtype="<u4").tobytes())
+        digest.update(np.concatenate(polygons).astype("<f8").tobytes())
+    for child_hash, matrices in references:
+        digest.update(child_hash.encode())
+        digest.update(np.ascontiguousarray(matrices, dtype="<f8").tobytes())
+    return digest.hexdigest()
+
+
+def get_cache_file(cache_dir, cell_hash):
+    return os.path.join(cache_dir, f"{cell_hash}.npz")
+
+
+def save_templates(cache_dir, cell_hash, templates):
+    """Store the templates of a cell in one compact npz file.
+
+    templates is a dict layer -> list of (shape key, reference points,
+    (N, 2, 3) matrices), all lists are concatenated into flat arrays.
+    """
+    layers = list(templates)
+    entries = [
+        (i, *template)
+        for i, layer in enumerate(layers)
+        for template in templates[layer]
+    ]
+    arrays = {
+        # (layer, datatype) and derived (layer, datatype, n) keys, padded with -1
+        "layers": np.asarray(
+            [(*layer, -1)[:3] for layer in layers], dtype="int64"
+        ).reshape(-1, 3),
+        "layer_index": np.asarray([e[0] for e in entries], dtype="uint32"),
+        "key_sizes": np.asarray([len(e[1]) for e in entries], dtype="uint32"),
+        "keys": np.frombuffer(b"".join(e[1] for e in entries), dtype="uint8"),
+        "vertex_counts": np.asarray([len(e[2]) for e in entries], dtype="uint32"),
+        "points": np.concatenate([e[2] for e in entries] or [np.zeros((0, 2))]),
+        "instance_counts": np.asarray([len(e[3]) for e in entries], dtype="uint32"),
+        "matrices": np.concatenate([e[3] for e in entries] or [np.zeros((0, 2, 3))]),
+    }
+
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = get_cache_file(cache_dir, cell_hash)
+    # write to a temp file first, concurrent readers never see partial files
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fd:
+        np.savez(fd, **arrays)
+    os.replace(tmp, filename)
+
+
+def load_templates(cache_dir, cell_hash):
+    """Return the templates stored by save_templates or None if not cached."""
+    filename = get_cache_file(cache_dir, cell_hash)
+    try:
+        with np.load(filename) as data:
+            arrays = {name: data[name] for name in data.files}
+    except (OSError, ValueError, KeyError):
+        return None
+
+    # mark as recently used for the LRU eviction
+    os.utime(filename)
+
+    def split(values, sizes):
+        return np.split(values, np.cumsum(sizes)[:-1]) if len(sizes) else []
+
+    layers = [
+        tuple(value for value in layer if value != -1)
+        for layer in arrays["layers"].tolist()
+    ]
+    keys = split(arrays["keys"], arrays["key_sizes"])
+    points = split(arrays["points"], arrays["vertex_counts"])
+    matrices = split(arrays["matrices"], arrays["instance_counts"])
+
+    templates = {layer: [] for layer in layers}
+    for i, layer_index in enumerate(arrays["layer_index"].tolist()):
+        templates[layers[layer_index]].append(
+            (keys[i].tobytes(), points[i], matrices[i])
+        )
+    return templates
+
+
+def evict(cache_dir, max_bytes):
+    """Delete the least recently used cache files above max_bytes in total."""
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npz"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+        removed += 1
+    return removed
@@ -0,0 +1,53 @@
+# %%
+import numpy as np
+import shapely
+
+# %%
+
+# below this on-screen size (pixels) a cell is drawn as its bounding box
+LOD_BBOX_PIXELS = 8
+# outlines are simplified to 1 / LOD_OUTLINE_RESOLUTION of the cell extent
+LOD_OUTLINE_RESOLUTION = 256
+
+
+def get_outlines(polygons, tolerance):
+    """Merge polygons into simplified outlines (exterior rings, no holes).
+
+    The polygons are grown by tolerance before the union, so features closer
+    than 2 * tolerance (e.g. dense arrays of contacts) become one outline. The
+    outlines are not shrunk back, they are a proxy seen from far away.
+
+    Args:
+        polygons: list of (N, 2) point arrays.
+        tolerance: grow distance and simplification tolerance.
+
+    Returns:
+        list of (N, 2) float64 point arrays without the closing point.
+    """
+    grown = shapely.buffer(
+        shapely.polygons([shapely.linearrings(p) for p in polygons]),
+        tolerance,
+        join_style="mitre",
+    )
+    merged = shapely.simplify(shapely.union_all(grown), tolerance)
+
+    outlines = []
+    for geometry in shapely.get_parts(merged):
+        if isinstance(geometry, shapely.Polygon) and not geometry.is_empty:
+            outlines.append(np.asarray(geometry.exterior.coords)[:-1])
+    return outlines
+
+
+def get_min_feature(polygons):
+    """Smallest bounding box side over all polygons."""
+    return min(float(np.min(p.max(axis=0) - p.min(axis=0))) for p in polygons)
+
+
+def get_thresholds(extent, min_feature):
+    """On-screen cell sizes (pixels) below which the coarse levels are used.
+
+    The bounding box is used below LOD_BBOX_PIXELS, the outlines until the
+    smallest feature of the cell becomes larger than one pixel.
+    """
+    outline_pixels = extent / min_feature if min_feature > 0 else LOD_BBOX_PIXELS
+    return [LOD_BBOX_PIXELS, max(LOD_BBOX_PIXELS, outline_pixels)]
@@ -0,0 +1,245 @@
+# %%
+import numpy as np
+import shapely
+from numba import njit
+
+# %%
+
+# relative area below which three consecutive points count as collinear
+EPSILON = 1e-12
+
+
+@njit(cache=True)
+def earcut(points):
+    """Triangulate a simple counter-clockwise polygon by ear clipping.
+
+    Collinear points are dropped without a triangle. Rings that are not
+    simple (e.g. holes joined by bridges, see triangulate) can get stuck
+    without ears, the triangulation then fails.
+
+    Returns (T, 3) int32 point indices, T <= N - 2, and False if it failed.
+    """
+    n = len(points)
+    before = np.empty(n, np.int32)
+    after = np.empty(n, np.int32)
+    for i in range(n):
+        before[i] = (i - 1) % n
+        after[i] = (i + 1) % n
+
+    extent = max(
+        points[:, 0].max() - points[:, 0].min(), points[:, 1].max() - points[:, 1].min()
+    )
+    epsilon = EPSILON * extent * extent
+
+    triangles = np.empty((max(n - 2, 0), 3), np.int32)
+    count = 0
+    remaining = n
+    i = np.int32(0)
+    stuck = 0
+    while remaining > 3:
+        a, c = before[i], after[i]
+        ax, ay = points[a]
+        bx, by = points[i]
+        cx, cy = points[c]
+        cross = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+
+        ear = False
+        if cross > epsilon:
+            ear = True
+            j = after[c]
+            while j != a:
+                px, py = points[j]
+                if (
+                    (bx - ax) * (py - ay) - (by - ay) * (px - ax) >= 0
+                    and (cx - bx) * (py - by) - (cy - by) * (px - bx) >= 0
+                    and (ax - cx) * (py - cy) - (ay - cy) * (px - cx) >= 0
+                    and not (px == ax and py == ay)
+                    and not (px == cx and py == cy)
+                ):
+                    ear = False
+                    break
+                j = after[j]
+        elif abs(cross) <= epsilon:
+            # collinear or duplicate point, remove it without a triangle
+            after[a], before[c] = c, a
+            remaining -= 1
+            i, stuck = c, 0
+            continue
+
+        if stuck > remaining:
+            return triangles[:count], False
+        if ear:
+            triangles[count, 0] = a
+            triangles[count, 1] = i
+            triangles[count, 2] = c
+            count += 1
+            after[a], before[c] = c, a
+            remaining -= 1
+            i, stuck = c, 0
+        else:
+            i = c
+            stuck += 1
+
+    if remaining == 3:
+        a, c = before[i], after[i]
+        ax, ay = points[a]
+        bx, by = points[i]
+        cx, cy = points[c]
+        if abs((bx - ax) * (cy - ay) - (by - ay) * (cx - ax)) > epsilon:
+            triangles[count, 0] = a
+            triangles[count, 1] = i
+            triangles[count, 2] = c
+            count += 1
+    return triangles[:count], True
+
+
+def get_area(points, triangles=None):
+    """Area of a ring, or the summed area of its (T, 3) triangles."""
+    if triangles is None:
+        x, y = points[:, 0], points[:, 1]
+        return abs(np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)) / 2
+    a, b, c = (points[triangles[:, i]] for i in range(3))
+    cross = (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (
+        c[:, 0] - a[:, 0]
+    )
+    return np.sum(np.abs(cross)) / 2
+
+
+def delaunay(points):
+    """Constrained Delaunay triangles of a ring with holes joined by bridges.
+
+    The ring is repaired into a polygon with holes first (gdstk booleans
+    join holes to the outline through repeated bridge vertices), the
+    triangle corners are mapped back to point indices and turned counter
+    clockwise.
+    """
+    polygon = shapely.make_valid(shapely.Polygon(points))
+    triangles = shapely.get_parts(shapely.constrained_delaunay_triangles(polygon))
+    index = {point: i for i, point in enumerate(map(tuple, points.tolist()))}
+    corners = shapely.get_coordinates(triangles).reshape(-1, 4, 2)[:, :3]
+    try:
+        result = np.array(
+            [[index[point] for point in map(tuple, c)] for c in corners.tolist()],
+            dtype=np.int32,
+        ).reshape(-1, 3)
+    except KeyError as error:
+        raise ValueError(f"triangle corner {error} is not a polygon point") from None
+
+    a, b, c = (points[result[:, i]] for i in range(3))
+    clockwise = (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) < (b[:, 1] - a[:, 1]) * (
+        c[:, 0] - a[:, 0]
+    )
+    result[clockwise] = result[clockwise][:, ::-1]
+    return result
+
+
+def triangulate(points):
+    """Triangulate a counter-clockwise ring, checked by area.
+
+    Simple rings are ear clipped, rings with repeated points (holes joined by
+    bridges) or where ear clipping fails use delaunay. Raises ValueError if
+    the triangles do not cover the polygon area.
+    """
+    triangles, ok = None, False
+    if len(np.unique(points, axis=0)) == len(points):
+        triangles, ok = earcut(points)
+    area = get_area(points)
+    tolerance = 1e-9 * np.ptp(points, axis=0).max() ** 2
+    if not ok or abs(get_area(points, triangles) - area) > tolerance:
+        triangles = delaunay(points)
+    if abs(get_area(points, triangles) - area) > tolerance:
+        raise ValueError(f"triangulation of a {len(points)} point polygon failed")
+    return triangles
+
+
+def get_fan(n):
+    """(N - 2, 3) fan triangles of a convex polygon with n points."""
+    i = np.arange(1, n - 1, dtype=np.int32)
+    return np.stack([np.zeros_like(i), i, i + 1], axis=1)
+
+
+def get_sides(n):
+    """(2 N, 3) triangles of the side quads of an extruded polygon.
+
+    The side vertices follow the 2 N cap vertices, four per edge a, b
+    ordered as a0, b0, b1, a1, so every side face has its own normal.
+    """
+    quads = 2 * n + 4 * np.arange(n, dtype=np.int32)[:, None]
+    return (quads[:, None] + np.array([[0, 1, 2], [0, 2, 3]], np.int32)).reshape(-1, 3)
+
+
+def is_convex(rings):
+    """(K,) mask of the convex (K, N, 2) counter-clockwise rings."""
+    edges = np.roll(rings, -1, axis=1) - rings
+    cross = edges[..., 0] * np.roll(edges[..., 1], -1, axis=1) - edges[
+        ..., 1
+    ] * np.roll(edges[..., 0], -1, axis=1)
+    extent = np.ptp(rings, axis=1).max(axis=1)
+    return np.all(cross >= -EPSILON * extent[:, None] ** 2, axis=1)
+
+
+def extrude(rings, triangles):
+    """Unit height prisms of (K, N, 2) rings and their (T, 3) cap triangles.
+
+    Returns (K, 6 N, 3) vertices: bottom cap, top cap, sides (see get_sides)
+    and the (2 T + 2 N, 3) triangles, outward facing for counter-clockwise
+    rings. The height is applied as z scale of the placement matrices.
+    """
+    k, n, _ = rings.shape
+    vertices = np.zeros((k, 6 * n, 3), np.float32)
+    vertices[:, :n, :2] = rings
+    vertices[:, n : 2 * n, :2] = rings
+    vertices[:, n : 2 * n, 2] = 1
+
+    sides = np.zeros((k, n, 4, 3), np.float32)
+    sides[:, :, (0, 3), :2] = rings[:, :, None]
+    sides[:, :, (1, 2), :2] = np.roll(rings, -1, axis=1)[:, :, None]
+    sides[:, :, (2, 3), 2] = 1
+    vertices[:, 2 * n :] = sides.reshape(k, 4 * n, 3)
+
+    faces = np.concatenate([triangles[:, ::-1], triangles + n, get_sides(n)])
+    return vertices, faces
+
+
+def get_meshes(polygons):
+    """Triangulate and extrude polygons to unit height indexed meshes.
+
+    Polygons are grouped by vertex count, the vertices of a group and the
+    triangles of its convex polygons (fans) are built at once, only the
+    concave ones and those with repeated points go through triangulate.
+
+    Args:
+        polygons: list of (N, 2) point arrays.
+
+    Returns:
+        list of {"vertices": float32 (V, 3), "triangles": uint16 or uint32
+        (T, 3)}, the cap vertices are shared by the triangles of a polygon.
+    """
+    meshes = [None] * len(polygons)
+    by_length = {}
+    for i, points in enumerate(polygons):
+        by_length.setdefault(len(points), []).append(i)
+
+    for n, indices in by_length.items():
+        rings = np.stack([polygons[i] for i in indices]).astype(np.float64)
+        x, y = rings[..., 0], rings[..., 1]
+        area = np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1)
+        rings[area < 0] = rings[area < 0, ::-1]
+
+        # repeated points: holes joined by bridges, never a plain fan
+        points = np.sort(rings[..., 0] + 1j * rings[..., 1], axis=1)
+        repeated = np.any(points[:, 1:] == points[:, :-1], axis=1)
+        convex = is_convex(rings) & ~repeated
+        dtype = np.uint16 if 6 * n <= 65536 else np.uint32
+        if convex.any():
+            vertices, faces = extrude(rings[convex], get_fan(n))
+            faces = faces.astype(dtype)
+            for i, mesh_vertices in zip(np.compress(convex, indices), vertices):
+                meshes[i] = {"vertices": mesh_vertices, "triangles": faces}
+        for j in np.flatnonzero(~convex):
+            vertices, faces = extrude(rings[j : j + 1], triangulate(rings[j]))
+            meshes[indices[j]] = {
+                "vertices": vertices[0],
+                "triangles": faces.astype(dtype),
+            }
+    return meshes
@@ -1,20 +1,51 @@
 import numpy as np
 from numba import njit
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import plotly.graph_objects as go
 
-from shapely.geometry import Polygon
-from shapely import set_precision, normalize, get_coordinates
-
 import distinctipy
 
 # ---------------------------
 # 1. Core Congruence Detection
 # ---------------------------
 
-MAP_ALL = [0, 1, 2, 3, 4, 5, 6, 7]
-MAP_SQUARE = [0]
-MAP_RECTANGLE = [0, 1]
+# database grid the polygon points are snapped to before hashing
+GRID_SIZE = 0.00001
+
+# transform() as 2x2 matrices, applied as points @ TRANSFORMS[trans_index].T
+TRANSFORMS = np.array(
+    [
+        [[1, 0], [0, 1]],  # Identity
+        [[0, 1], [-1, 0]],  # Rotate 90°
+        [[-1, 0], [0, -1]],  # Rotate 180°
+        [[0, -1], [1, 0]],  # Rotate 270°
+        [[1, 0], [0, -1]],  # Reflect over y-axis
+        [[0, 1], [1, 0]],  # Reflect + Rotate 90°
+        [[-1, 0], [0, 1]],  # Reflect + Rotate 180°
+        [[0, -1], [-1, 0]],  # Reflect + Rotate 270°
+    ],
+    dtype=np.float32,
+)
+
+# linear parts of the placement matrices of the 8 Manhattan orientations,
+# indexed like get_trans_index in to_cell_json (applied as matrix @ point)
+ORIENTATIONS = np.array(
+    [
+        [[1, 0], [0, 1]],  # Identity
+        [[0, -1], [1, 0]],  # Rotate 90°
+        [[-1, 0], [0, -1]],  # Rotate 180°
+        [[0, 1], [-1, 0]],  # Rotate 270°
+        [[1, 0], [0, -1]],  # Reflect over y-axis
+        [[0, 1], [1, 0]],  # Reflect + Rotate 90°
+        [[-1, 0], [0, 1]],  # Reflect + Rotate 180°
+        [[0, -1], [-1, 0]],  # Reflect + Rotate 270°
+    ],
+    dtype=np.float64,
+)
+# orientation code of transforms stored with their full linear part
+FULL_ORIENTATION = 255
 
 
 def is_axis_aligned_rectangle_or_square(points, tol=1e-8):
@@ -115,6 +146,12 @@ def center(points):
     return (points - centroid).astype(np.float32), centroid
 
 
+def center_batch(polygons):
+    """Vectorized center() for an (M, N, 2) stack of polygons."""
+    centroids = (np.min(polygons, axis=1) + np.max(polygons, axis=1)) / 2
+    return (polygons - centroids[:, None, :]).astype(np.float32), centroids
+
+
 def group_by_length(polygons):
     groups = defaultdict(list)
     for polygon in polygons:
@@ -122,69 +159,268 @@ def group_by_length(polygons):
     return groups
 
 
-def hash_polygon(polygon):
-    return hash(
-        tuple(
-            get_coordinates(
-                (normalize(set_precision(Polygon(polygon), grid_size=0.00001)))
-            )
-            .flatten()
-            .tolist()
-        )
+def snap(polygons, grid_size=GRID_SIZE):
+    """Snap points to integer multiples of grid_size (rounding half up)."""
+    scale = np.round(1 / grid_size)
+    return np.floor(np.asarray(polygons, dtype=np.float64) * scale + 0.5).astype(
+        np.int64
     )
 
 
-def group_congruent_polygons(polygons):
-    groups = {}
+def canonical_ring(ring):
+    """Canonical form of one snapped (N, 2) ring: clockwise, starting at the
+    lexicographically smallest vertex, without repeated vertices."""
+    keep = np.any(ring != np.roll(ring, 1, axis=0), axis=1)
+    if np.any(keep):
+        ring = ring[keep]
+    return canonical_rings(ring[None])[0]
+
+
+def canonical_rings(rings):
+    """Canonical form of a snapped (M, N, 2) stack of rings, see canonical_ring.
+
+    Same as shapely's normalize(set_precision(Polygon(ring))) for polygons
+    without repeated or collinear-collapsing vertices.
+    """
+    x, y = rings[..., 0], rings[..., 1]
+    area = np.sum(
+        x.astype(np.float64) * np.roll(y, -1, axis=1)
+        - np.roll(x, -1, axis=1).astype(np.float64) * y,
+        axis=1,
+    )
+    rings = np.where((area > 0)[:, None, None], rings[:, ::-1], rings)
+
+    x, y = rings[..., 0], rings[..., 1]
+    y = np.where(x == x.min(axis=1, keepdims=True), y, np.iinfo(np.int64).max)
+    start = np.argmin(y, axis=1)
+    index = (start[:, None] + np.arange(rings.shape[1])) % rings.shape[1]
+    return np.take_along_axis(rings, index[..., None], axis=1)
+
+
+def lexicographic_argmin(forms):
+    """Index of the lexicographically smallest row per polygon of (M, K, L) forms."""
+    candidates = np.ones(forms.shape[:2], dtype=bool)
+    for column in range(forms.shape[2]):
+        values = np.where(candidates, forms[:, :, column], np.iinfo(np.int64).max)
+        candidates &= values == values.min(axis=1, keepdims=True)
+        if np.all(candidates.sum(axis=1) == 1):
+            break
+    return np.argmax(candidates, axis=1)
+
+
+def rectangle_mask(rings):
+    """Axis-aligned rectangles of a snapped (M, 4, 2) stack of rings."""
+    following = np.roll(rings, -1, axis=1)
+    same_x = rings[..., 0] == following[..., 0]
+    same_y = rings[..., 1] == following[..., 1]
+    return np.all(same_x ^ same_y, axis=1)
+
+
+def canonical_rectangles(rings):
+    """Canonical rings and transform indices of axis-aligned rectangles.
+
+    Only the boxes are transformed, the result is the same as for
+    canonical_polygons.
+    """
+    lower, upper = rings.min(axis=1), rings.max(axis=1)
+    x0, y0, x1, y1 = lower[:, 0], lower[:, 1], upper[:, 0], upper[:, 1]
+
+    # transformed box [x0, x1] x [y0, y1] for every entry of TRANSFORMS
+    boxes = np.array(
+        [
+            (x0, y0, x1, y1),  # Identity
+            (y0, -x1, y1, -x0),  # Rotate 90°
+            (-x1, -y1, -x0, -y0),  # Rotate 180°
+            (-y1, x0, -y0, x1),  # Rotate 270°
+            (x0, -y1, x1, -y0),  # Reflect over y-axis
+            (y0, x0, y1, x1),  # Reflect + Rotate 90°
+            (-x1, y0, -x0, y1),  # Reflect + Rotate 180°
+            (-y1, -x1, -y0, -x0),  # Reflect + Rotate 270°
+        ]
+    ).transpose(2, 0, 1)
+    bx0, by0, bx1, by1 = (boxes[..., i] for i in range(4))
+    # clockwise, starting at the lower left corner
+    forms = np.stack([bx0, by0, bx0, by1, bx1, by1, bx1, by0], axis=2)
+
+    trans_indices = lexicographic_argmin(forms)
+    canonical = forms[np.arange(len(forms)), trans_indices].reshape(-1, 4, 2)
+    return canonical, trans_indices
+
+
+def canonical_polygons(rings):
+    """Orientation invariant canonical rings and transform indices.
+
+    The canonical form of a snapped ring is the lexicographically smallest of
+    the canonical rings of its 8 dihedral transforms; the transform index maps
+    the ring onto it.
+    """
+    int_transforms = TRANSFORMS.astype(np.int64)
+    forms = np.stack(
+        [canonical_rings(rings @ int_transforms[i].T) for i in range(8)], axis=1
+    )
+    trans_indices = lexicographic_argmin(forms.reshape(*forms.shape[:2], -1))
+    return forms[np.arange(len(forms)), trans_indices], trans_indices
+
+
+def canonical_keys(polygons, grid_size=GRID_SIZE):
+    """Congruence key (bytes) and transform index per polygon of an (M, N, 2) stack.
+
+    transform(polygons[i], trans_indices[i]) is the canonical representative of
+    the congruence class of polygons[i].
+    """
+    rings = snap(polygons, grid_size)
+    canonical = np.empty_like(rings)
+    trans_indices = np.empty(len(rings), dtype=np.int64)
+
+    rectangles = np.zeros(len(rings), dtype=bool)
+    if rings.shape[1] == 4:
+        rectangles = rectangle_mask(rings)
+    if np.any(rectangles):
+        canonical[rectangles], trans_indices[rectangles] = canonical_rectangles(
+            rings[rectangles]
+        )
+    others = ~rectangles
+    if np.any(others):
+        canonical[others], trans_indices[others] = canonical_polygons(rings[others])
+
+    keys = [ring.tobytes() for ring in canonical]
+
+    # rings with repeated vertices after snapping need a shorter canonical form
+    repeated = np.any(np.all(rings == np.roll(rings, 1, axis=1), axis=2), axis=1)
+    int_transforms = TRANSFORMS.astype(np.int64)
+    for i in np.flatnonzero(repeated):
+        forms = [canonical_ring(rings[i] @ int_transforms[t].T) for t in range(8)]
+        trans_indices[i] = min(range(8), key=lambda t: forms[t].ravel().tolist())
+        keys[i] = forms[trans_indices[i]].tobytes()
+
+    return keys, trans_indices
 
-    for idx, poly in enumerate(polygons):
-        centered_poly, centroid = center(poly)
-
-        found = False
-
-        # is_rectangle, is_square = is_rectangle_or_square(centered_poly)
-        # if is_square:
-        #     MAP = MAP_SQUARE
-        # elif is_rectangle:
-        #     MAP = MAP_RECTANGLE
-        # else:
-        MAP = MAP_ALL
-
-        if idx > 0:
-            for trans_index in MAP:
-                key = hash_polygon(transform(centered_poly, trans_index))
-                if groups.get(key) is not None:
-                    groups[key].append(
-                        {
-                            "idx": idx,
-                            # ((origin.x, origin.y), rotation, x_reflection, magnification)
-                            "transformation": [
-                                centroid.tolist(),
-                                *remap_transform(trans_index),
-                                1.0,
-                            ],
-                        }
-                    )
-                    found = True
-                    break
-
-        if not found:
+
+def label_congruent_polygons(centered_polys):
+    """Label centered polygons by congruence class.
+
+    Returns the group keys in order of first occurrence, the group label and the
+    transform index (see canonical_keys) of every polygon.
+    """
+    keys, trans_indices = canonical_keys(centered_polys)
+    group_keys = {}
+    labels = np.empty(len(keys), dtype=np.int64)
+    for idx, key in enumerate(keys):
+        labels[idx] = group_keys.setdefault(key, len(group_keys))
+    return list(group_keys), labels, trans_indices
+
+
+def build_groups(centered_polys, centroids, group_keys, labels, trans_indices):
+    groups = {}
+    for idx, (label, trans_index) in enumerate(zip(labels, trans_indices)):
+        key = group_keys[label]
+        group = groups.get(key)
+        if group is None:
             # first element is the reference polygon
-            key = hash_polygon(centered_poly)
-            groups[key] = [centered_poly]
-            x = normalize(Polygon(transform(centered_poly, 0)))
-            # All other elements are instances
-            groups[key].append(
-                {
-                    "idx": idx,
-                    # ((origin.x, origin.y), rotation, x_reflection, magnification)
-                    "transformation": [centroid.tolist(), *remap_transform(0), 1.0],
-                }
-            )
+            group = groups[key] = [centered_polys[idx] @ TRANSFORMS[trans_index].T]
+
+        # All other elements are instances
+        group.append(
+            {
+                "idx": idx,
+                # ((origin.x, origin.y), rotation, x_reflection, magnification)
+                "transformation": [
+                    centroids[idx].tolist(),
+                    *remap_transform(trans_index),
+                    1.0,
+                ],
+            }
+        )
 
     return groups
 
 
+def group_congruent_polygons(polygons):
+    """Group congruent polygons under the 8 Manhattan transforms.
+
+    Returns a dict key -> [reference polygon, *instances]. The reference is the
+    centered polygon in canonical orientation, every instance records the
+    transformation that maps the reference onto the original polygon.
+    """
+    if len(polygons) == 0:
+        return {}
+
+    centered_polys, centroids = center_batch(np.asarray(polygons))
+    return build_groups(
+        centered_polys, centroids, *label_congruent_polygons(centered_polys)
+    )
+
+
+def _label_shared(name, offset, shape):
+    """Worker: label the polygon stack stored in shared memory name at offset."""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        polygons = np.ndarray(shape, dtype=np.float64, buffer=shm.buf, offset=offset)
+        centered_polys, _ = center_batch(polygons)
+        del polygons
+        return label_congruent_polygons(centered_polys)
+    finally:
+        shm.close()
+
+
+def group_congruent_layers(layers, workers=None, min_parallel=256):
+    """Run group_by_length and group_congruent_polygons for many layers.
+
+    Args:
+        layers: dict of key (e.g. layer) -> list of polygon point arrays.
+        workers: number of worker processes, None or 1 runs sequentially. The
+          vertex-count buckets are shipped to the workers via shared memory.
+        min_parallel: buckets with fewer polygons are grouped in process.
+
+    Returns:
+        dict of key -> list of congruent polygon groups, one per vertex-count
+        bucket, in the same order as the sequential version.
+    """
+    buckets = [
+        (key, np.asarray(polygons, dtype=np.float64))
+        for key, layer_polygons in layers.items()
+        for polygons in group_by_length(layer_polygons).values()
+    ]
+    result = {key: [] for key in layers}
+
+    if workers is None or workers <= 1:
+        for key, polygons in buckets:
+            result[key].append(group_congruent_polygons(polygons))
+        return result
+
+    shared = [i for i, (_, p) in enumerate(buckets) if len(p) >= min_parallel]
+    size = sum(buckets[i][1].nbytes for i in shared)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        jobs = {}
+        offset = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for i in shared:
+                polygons = buckets[i][1]
+                view = np.ndarray(
+                    polygons.shape, dtype=np.float64, buffer=shm.buf, offset=offset
+                )
+                view[:] = polygons
+                del view
+                jobs[i] = executor.submit(
+                    _label_shared, shm.name, offset, polygons.shape
+                )
+                offset += polygons.nbytes
+
+            for i, (key, polygons) in enumerate(buckets):
+                if i in jobs:
+                    centered_polys, centroids = center_batch(polygons)
+                    groups = build_groups(centered_polys, centroids, *jobs[i].result())
+                else:
+                    groups = group_congruent_polygons(polygons)
+                result[key].append(groups)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return result
+
+
 # ---------------------------
 # 2. Reconstruction Function
 # ---------------------------
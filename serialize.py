@@ -1,20 +1,171 @@
 import numpy as np
 import base64
+import filecmp
+import io
+import os
+import tempfile
+import zlib
+import orjson
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# codecs are "+" separated steps applied in order, the last step is always b64:
+# - delta: difference to the value stride elements before (integer arrays),
+#   stride is the size of the last axis of the array and stored with the buffer
+# - zigzag: signed integers to unsigned, small magnitudes get zero high bytes
+# - shuffle: group the i-th bytes of all elements (byte planes)
+# - deflate: zlib stream, DecompressionStream("deflate") in the browser
+# - zstd: zstandard frame, only if the zstandard package is installed
+
+# candidates tried per buffer by the default heuristic, see encode_buffer
+CODECS = (
+    "b64",
+    "deflate+b64",
+    "shuffle+deflate+b64",
+    "delta+zigzag+shuffle+deflate+b64",
+)
+
+# buffers below this size are never compressed (header overhead)
+MIN_COMPRESS_BYTES = 64
+
+
+def get_signed(dtype):
+    """Signed integer dtype of the same size."""
+    return np.dtype(f"<i{np.dtype(dtype).itemsize}")
+
+
+def delta_encode(values, stride):
+    values = values.view(get_signed(values.dtype))
+    result = values.copy()
+    result[stride:] -= values[:-stride]
+    return result
+
+
+def delta_decode(values, stride):
+    result = values.copy()
+    for start in range(stride):
+        # integer cumsum wraps around like the encoding
+        result[start::stride] = np.cumsum(result[start::stride], dtype=result.dtype)
+    return result
+
+
+def zigzag_encode(values):
+    bits = 8 * values.dtype.itemsize
+    unsigned = np.dtype(f"<u{values.dtype.itemsize}")
+    return ((values << 1) ^ (values >> (bits - 1))).view(unsigned)
+
+
+def zigzag_decode(values):
+    signed = get_signed(values.dtype)
+    return ((values >> 1) ^ (0 - (values & 1))).view(signed)
+
+
+def shuffle(data, itemsize):
+    return np.frombuffer(data, "uint8").reshape(-1, itemsize).T.tobytes()
+
+
+def unshuffle(data, itemsize):
+    return np.frombuffer(data, "uint8").reshape(itemsize, -1).T.tobytes()
+
+
+def get_codecs(zstd=False):
+    """Candidate codecs, with zstd also the zstd variants (needs zstandard).
+
+    Browsers only decode deflate natively, zstd is meant for other consumers.
+    """
+    if not zstd or zstandard is None:
+        return CODECS
+    return CODECS + tuple(
+        codec.replace("deflate", "zstd") for codec in CODECS if "deflate" in codec
+    )
+
+
+def encode_bytes(values, codec, stride=1):
+    """Apply the steps of codec (without b64) to the flat array values.
+
+    Returns the encoded bytes or None if codec does not apply to values.
+    """
+    steps = codec.split("+")[:-1]
+    if "delta" in steps or "zigzag" in steps:
+        if values.dtype.kind not in "iu" or len(values) <= stride:
+            return None
+    for step in steps:
+        if step == "delta":
+            values = delta_encode(values, stride)
+        elif step == "zigzag":
+            values = zigzag_encode(values.view(get_signed(values.dtype)))
+        elif step == "shuffle":
+            if values.dtype.itemsize == 1:
+                return None
+            values = shuffle(memoryview(values), values.dtype.itemsize)
+        elif step == "deflate":
+            values = zlib.compress(memoryview(values), 9)
+        elif step == "zstd":
+            values = zstandard.ZstdCompressor(level=19).compress(memoryview(values))
+        else:
+            raise ValueError(f"unknown codec step {step!r}")
+    return bytes(memoryview(values))
+
+
+def encode_buffer(obj, codecs=None):
+    """JSON buffer {"shape", "dtype", "buffer", "codec"} of an ndarray.
+
+    codecs: candidate codecs (see CODECS), the one with the smallest output is
+    used. None keeps the plain "b64" codec.
+    """
+    stride = obj.shape[-1] if obj.ndim > 1 else 1
+    obj = np.ascontiguousarray(obj, dtype=obj.dtype.newbyteorder("<")).ravel()
+    best = ("b64", memoryview(obj))
+    if codecs is not None and obj.nbytes >= MIN_COMPRESS_BYTES:
+        for codec in codecs:
+            if codec == "b64":
+                continue
+            data = encode_bytes(obj, codec, stride)
+            if data is not None and len(data) < len(best[1]):
+                best = (codec, data)
+
+    codec, data = best
+    result = {
+        "shape": obj.shape,
+        "dtype": str(obj.dtype),
+        "buffer": base64.b64encode(data).decode(),
+        "codec": codec,
+    }
+    if "delta" in codec:
+        result["stride"] = stride
+    return result
+
+
+def decode_buffer(buffer):
+    """ndarray of a JSON buffer written by encode_buffer."""
+    dtype = np.dtype(buffer["dtype"])
+    data = base64.b64decode(buffer["buffer"])
+    steps = buffer["codec"].split("+")[:-1]
+    for step in reversed(steps):
+        if step == "deflate":
+            data = zlib.decompress(data)
+        elif step == "zstd":
+            data = zstandard.ZstdDecompressor().decompress(data)
+        elif step == "shuffle":
+            data = unshuffle(data, dtype.itemsize)
+
+    values = np.frombuffer(data, dtype.newbyteorder("<"))
+    if "zigzag" in steps:
+        values = zigzag_decode(values.view(f"<u{dtype.itemsize}"))
+    if "delta" in steps:
+        values = delta_decode(values, buffer["stride"])
+    return values.view(dtype.newbyteorder("<")).reshape(buffer["shape"])
+
+
+def numpy_to_buffer_json(value, codecs=None):
+    """Replace all ndarrays of value by JSON buffers, see encode_buffer."""
 
-def numpy_to_buffer_json(value):
     def walk(obj):
         if isinstance(obj, np.ndarray):
-            if not obj.flags["C_CONTIGUOUS"]:
-                obj = np.ascontiguousarray(obj)
-
-            obj = obj.ravel()
-            return {
-                "shape": obj.shape,
-                "dtype": str(obj.dtype),
-                "buffer": base64.b64encode(memoryview(obj)).decode(),
-                "codec": "b64",
-            }
+            return encode_buffer(obj, codecs)
         elif isinstance(obj, (tuple, list)):
             return [walk(el) for el in obj]
         elif isinstance(obj, dict):
@@ -26,3 +177,227 @@ def numpy_to_buffer_json(value):
             return obj
 
     return walk(value)
+
+
+def numpy_to_buffer_bin(value, fd, buffer=0, alignment=8):
+    """Write all ndarrays of value as raw little-endian bytes to the binary file fd.
+
+    The arrays are replaced by views {"shape", "dtype", "buffer", "offset", "length",
+    "codec": "bin"} with byte offset and byte length into the buffer. Views are
+    aligned so that the browser can wrap them as typed arrays without copying.
+
+    Lists of ndarrays with one dtype (e.g. "instances") are packed into a single
+    view {"dtype", "buffer", "offset", "length", "sizes", "codec": "packed"}, where
+    "sizes" is a uint32 view with the element count of each array.
+
+    Returns the converted value and the byte length of the buffer.
+    """
+    offset = 0
+    views = {}  # arrays shared by several parts are written only once
+
+    def write(obj):
+        nonlocal offset
+
+        if id(obj) in views:
+            return dict(views[id(obj)][1])
+        original = obj
+
+        obj = np.ascontiguousarray(obj, dtype=obj.dtype.newbyteorder("<")).ravel()
+
+        padding = -offset % alignment
+        if padding > 0:
+            fd.write(bytes(padding))
+            offset += padding
+
+        fd.write(memoryview(obj).cast("B"))
+        view = {
+            "shape": obj.shape,
+            "dtype": str(obj.dtype),
+            "buffer": buffer,
+            "offset": offset,
+            "length": obj.nbytes,
+            "codec": "bin",
+        }
+        offset += obj.nbytes
+        views[id(original)] = (original, view)
+        return dict(view)
+
+    def is_packable(obj):
+        return (
+            len(obj) > 1
+            and all(isinstance(el, np.ndarray) for el in obj)
+            and len({el.dtype for el in obj}) == 1
+        )
+
+    def walk(obj):
+        if isinstance(obj, np.ndarray):
+            return write(obj)
+        elif isinstance(obj, (tuple, list)) and is_packable(obj):
+            sizes = np.asarray([el.size for el in obj], dtype="uint32")
+            view = write(np.concatenate([el.ravel() for el in obj]))
+            del view["shape"]
+            view["sizes"] = write(sizes)
+            view["codec"] = "packed"
+            return view
+        elif isinstance(obj, (tuple, list)):
+            return [walk(el) for el in obj]
+        elif isinstance(obj, dict):
+            rv = {}
+            for k, v in obj.items():
+                rv[k] = walk(v)
+            return rv
+        else:
+            return obj
+
+    return walk(value), offset
+
+
+def write_buffer_bin(value, filename):
+    """Write value as JSON manifest filename.json plus binary buffer filename.bin.
+
+    The manifest lists the buffer in "buffers" (glTF like), all ndarrays are
+    referenced by offset/length/dtype into it.
+    """
+    name = filename.replace("\\", "/").split("/")[-1]
+    buffer = io.BytesIO()
+    manifest, length = numpy_to_buffer_bin(value, buffer)
+    write_if_changed(f"{filename}.bin", buffer.getbuffer())
+
+    manifest["buffers"] = [{"uri": f"{name}.bin", "byteLength": length}]
+    write_if_changed(f"{filename}.json", orjson.dumps(manifest))
+
+
+def write_if_changed(filename, data):
+    """Replace filename with data unless it already has this content.
+
+    Unchanged files keep their mtime, so file watchers and browser caches only
+    see the outputs that really changed. Returns True if the file was written.
+    """
+    try:
+        if os.path.getsize(filename) == len(data):
+            with open(filename, "rb") as fd:
+                if fd.read() == data:
+                    return False
+    except FileNotFoundError:
+        pass
+
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fd:
+        fd.write(data)
+    os.replace(tmp, filename)
+    return True
+
+
+def write_stream_if_changed(filename, write):
+    """Like write_if_changed for output streamed by write(fd).
+
+    The output goes to a temporary file next to filename, which only replaces
+    filename if the content differs, so memory stays bounded by the writer.
+    Returns True if the file was written.
+    """
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as fd:
+            write(fd)
+        if os.path.exists(filename) and filecmp.cmp(tmp, filename, shallow=False):
+            os.remove(tmp)
+            return False
+        os.replace(tmp, filename)
+        return True
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class Fragment(dict):
+    """Placeholder for a part already serialized by a JsonStreamWriter.
+
+    Only "loc" is kept (parents sort their parts by zmin), the JSON text lives in
+    the writer's spool file.
+    """
+
+    def __init__(self, loc, pieces):
+        super().__init__(loc=loc)
+        self.pieces = pieces
+
+
+class JsonStreamWriter:
+    """Write an assembly incrementally, byte-compatible with numpy_to_buffer_json.
+
+    The output is prefix + orjson.dumps(numpy_to_buffer_json(assembly)) + suffix,
+    where the assembly has "instances" and "parts" as its last keys:
+
+    - instances are written to fd directly when appended,
+    - finished parts are serialized to a temporary spool file by fragment() and
+      replaced by a small Fragment,
+    - close() writes the parts by copying their JSON text from the spool.
+
+    Peak memory is therefore bounded by the largest part instead of the output.
+    """
+
+    def __init__(self, fd, assembly, prefix="", suffix="", codecs=None):
+        """fd: file opened in binary mode, codecs: see encode_buffer."""
+        self.fd = fd
+        self.codecs = codecs
+        self.suffix = suffix
+        self.spool = tempfile.TemporaryFile()
+        self.count = 0
+
+        header = {k: v for k, v in assembly.items() if k not in ("instances", "parts")}
+        fd.write(prefix.encode("utf-8") + orjson.dumps(header)[:-1] + b',"instances":[')
+
+    def append(self, instance):
+        if self.count > 0:
+            self.fd.write(b",")
+        self.fd.write(orjson.dumps(numpy_to_buffer_json(instance, self.codecs)))
+        self.count += 1
+
+    def _spool(self, data):
+        offset = self.spool.tell()
+        self.spool.write(data)
+        return (offset, len(data))
+
+    def _pieces(self, part):
+        if isinstance(part, Fragment):
+            return part.pieces
+        return [self._spool(orjson.dumps(numpy_to_buffer_json(part, self.codecs)))]
+
+    def _join(self, parts):
+        pieces = []
+        for i, part in enumerate(parts):
+            if i > 0:
+                pieces.append(b",")
+            pieces.extend(self._pieces(part))
+        return pieces
+
+    def fragment(self, part):
+        """Serialize a finished part (with "parts" as last key) to the spool."""
+        if list(part)[-1] != "parts":
+            return Fragment(part["loc"], self._pieces(part))
+
+        header = {k: v for k, v in part.items() if k != "parts"}
+        pieces = [
+            orjson.dumps(numpy_to_buffer_json(header, self.codecs))[:-1] + b',"parts":['
+        ]
+        pieces.extend(self._join(part["parts"]))
+        pieces.append(b"]}")
+        return Fragment(part["loc"], pieces)
+
+    def close(self, parts):
+        """Write the top level parts and finish the output."""
+        self.fd.write(b'],"parts":[')
+        for piece in self._join(parts):
+            if isinstance(piece, bytes):
+                self.fd.write(piece)
+                continue
+
+            offset, length = piece
+            self.spool.seek(offset)
+            while length > 0:
+                chunk = self.spool.read(min(length, 1 << 20))
+                self.fd.write(chunk)
+                length -= len(chunk)
+
+        self.fd.write(b"]}" + self.suffix.encode("utf-8"))
+        self.spool.close()
@@ -0,0 +1,20 @@
+import os
+import sys
+
+# the converter is a set of flat modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def layer_names():
+    """Init the generic PDK, returns (layer, datatype) -> layer name."""
+    import to_cell_json
+
+    to_cell_json.init_generic()
+    return {
+        layer[:2]: to_cell_json.get_layer_name(layer)
+        for layer in to_cell_json.LAYERS
+        if len(layer) == 2
+    }
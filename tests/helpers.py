@@ -0,0 +1,120 @@
+from collections import Counter
+import json
+
+import gdstk
+import numpy as np
+
+from tiles import get_layer_shapes, get_matrices
+
+
+def get_star():
+    """48 point polygon without any symmetry."""
+    angles = np.linspace(0, 2 * np.pi, 48, endpoint=False)
+    star = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    star *= np.where(np.arange(48) % 3 == 0, 0.5, 0.3)[:, None]
+    star[:, 0] += 0.1 * (star[:, 1] > 0)
+    return star
+
+
+def make_library():
+    """Small two level library on generic PDK layers.
+
+    The child cell has congruent (rotated and mirrored) polygons, the top
+    cell places it as an array, mirrored and once more through a wrapper cell
+    at the same transform as the first array element (a second hierarchy
+    path stacking the same polygons).
+    """
+    lib = gdstk.Library("LIB")
+    child = lib.new_cell("child")
+    child.add(gdstk.rectangle((0, 0), (1, 2), layer=2))
+    child.add(gdstk.rectangle((3, 0), (5, 1), layer=2))
+    child.add(gdstk.Polygon([(0, 3), (2, 3), (2, 4), (1, 5)], layer=3))
+    child.add(gdstk.Polygon([(5, 3), (3, 3), (3, 4), (4, 5)], layer=3))
+    child.add(gdstk.rectangle((0, 6), (6, 7), layer=2))
+    # congruent 48 point polygons in all orientations, worth a template
+    star = get_star()
+    for i, (rotation, x_reflection) in enumerate(
+        [(0, False), (1, False), (2, False), (3, False), (0, True), (1, True)]
+    ):
+        points = star * [1, -1] if x_reflection else star
+        points = points @ np.linalg.matrix_power([[0, -1], [1, 0]], rotation).T
+        child.add(gdstk.Polygon(np.round(points + (1.5 * i, 9), 3), layer=3))
+
+    top = lib.new_cell("top")
+    top.add(gdstk.Reference(child, (0, 0), columns=4, rows=2, spacing=(7, 8)))
+    top.add(gdstk.Reference(child, (0, -1), x_reflection=True))
+    wrapper = lib.new_cell("wrapper")
+    wrapper.add(gdstk.Reference(child, (0, 0)))
+    top.add(gdstk.Reference(wrapper, (0, 0)))
+    top.add(gdstk.rectangle((-5, -5), (40, -3), layer=2))
+    return lib
+
+
+def get_instance_points(instance, db_unit=None):
+    if isinstance(instance, dict):
+        # mesh: the bottom cap holds the ring (see mesh.extrude)
+        vertices = np.asarray(instance["vertices"]).reshape(-1, 3)
+        return vertices[: len(vertices) // 6, :2]
+    return np.asarray(instance, np.float64).reshape(-1, 2) * (db_unit or 1)
+
+
+def get_world_polygons(assembly):
+    """Yield (layer name, world points) of all placed polygons."""
+    db_unit = assembly.get("units", {}).get("db_unit")
+    instances = [get_instance_points(i, db_unit) for i in assembly["instances"]]
+    for layer, part in get_layer_shapes(assembly):
+        matrices = get_matrices(part["shape"]["matrices"], db_unit)
+        for ref in part["shape"]["refs"]:
+            world = np.einsum("nij,vj->nvi", matrices[:, :, :2], instances[ref])
+            world += matrices[:, None, :, 2]
+            for points in world:
+                yield layer, points
+
+
+def flatten(assembly, decimals=4):
+    """Counter of (layer name, sorted world points) of all placed polygons."""
+    result = Counter()
+    for layer, points in get_world_polygons(assembly):
+        points = np.round(points, decimals) + 0.0
+        result[layer, tuple(sorted(map(tuple, points.tolist())))] += 1
+    return result
+
+
+def flatten_gdstk(lib, names, decimals=4):
+    """flatten() of the gdstk polygons of the top cells on the layer names."""
+    result = Counter()
+    for cell in lib.top_level():
+        for polygon in cell.get_polygons():
+            name = names.get((polygon.layer, polygon.datatype))
+            if name is not None:
+                points = np.round(polygon.points, decimals) + 0.0
+                result[name, tuple(sorted(map(tuple, points.tolist())))] += 1
+    return result
+
+
+def load_bin(filename):
+    """Read a manifest written by serialize.write_buffer_bin back with ndarrays."""
+    with open(f"{filename}.json", "rb") as fd:
+        manifest = json.load(fd)
+    with open(f"{filename}.bin", "rb") as fd:
+        data = fd.read()
+
+    def read(view):
+        return np.frombuffer(data, view["dtype"], offset=view["offset"]).copy()[
+            : view["length"] // np.dtype(view["dtype"]).itemsize
+        ]
+
+    def walk(obj):
+        if isinstance(obj, dict) and obj.get("codec") == "bin":
+            return read(obj).reshape(obj["shape"])
+        if isinstance(obj, dict) and obj.get("codec") == "packed":
+            values = read(obj)
+            sizes = read(obj["sizes"])
+            return np.split(values, np.cumsum(sizes)[:-1])
+        if isinstance(obj, dict):
+            return {key: walk(value) for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [walk(value) for value in obj]
+        return obj
+
+    return walk(manifest)
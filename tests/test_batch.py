@@ -0,0 +1,87 @@
+from collections import Counter, defaultdict
+
+import numpy as np
+import pytest
+
+from helpers import flatten, make_library
+from tiles import get_layer_shapes, get_matrix_count, select_matrices
+from to_cell_json import dedup_batch, to_json
+
+
+def get_path(shape_id):
+    names = shape_id.split("/")
+    last = max(i for i, name in enumerate(names) if name.startswith("C:"))
+    return "/".join(names[: last + 1])
+
+
+def flatten_shape(assembly, shape, matrices=None):
+    if matrices is not None:
+        shape = {**shape, "shape": {**shape["shape"], "matrices": matrices}}
+    return flatten({**assembly, "parts": [shape]})
+
+
+def get_path_polygons(assembly):
+    """Placed polygons per hierarchy path of a plain (not batched) assembly."""
+    result = defaultdict(Counter)
+    for _, shape in get_layer_shapes(assembly):
+        result[get_path(shape["id"])] += flatten_shape(assembly, shape)
+    return result
+
+
+def get_batch_path_polygons(assembly):
+    """Placed polygons per hierarchy path of a batched assembly (see ranges)."""
+    result = defaultdict(Counter)
+    for top in assembly["parts"]:
+        for _, shape in get_layer_shapes({"parts": top["parts"]}):
+            matrices = shape["shape"]["matrices"]
+            ranges = shape["ranges"].astype(np.int64)
+            # contiguous ranges in matrix order cover all matrices
+            assert ranges[0, 1] == 0
+            assert np.all(ranges[1:, 1] == ranges[:-1, 1] + ranges[:-1, 2])
+            assert ranges[-1, 1] + ranges[-1, 2] == get_matrix_count(matrices)
+            for path_index, start, count in ranges:
+                selected = select_matrices(matrices, np.arange(start, start + count))
+                polygons = flatten_shape(assembly, shape, selected)
+                result[top["paths"][path_index]] += polygons
+    return result
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"encoding": "int"}, {"compact_transforms": True}]
+)
+def test_batch_ranges_map_to_paths(layer_names, options):
+    plain = to_json(make_library(), return_json=False, **options)
+    batched = to_json(make_library(), return_json=False, batch=True, **options)
+
+    names = {shape["name"][:2] for _, shape in get_layer_shapes(batched)}
+    assert names == {"P:", "T:"}
+    assert flatten(batched) == flatten(plain)
+    assert get_batch_path_polygons(batched) == get_path_polygons(plain)
+
+
+@pytest.mark.parametrize("options", [{}, {"encoding": "int"}])
+def test_dedup_drops_stacked_placements(layer_names, options):
+    plain = to_json(make_library(), return_json=False, **options)
+    deduped = to_json(
+        make_library(), return_json=False, batch=True, dedup=True, **options
+    )
+
+    # the wrapper path stacks the child on the first array element
+    expected = get_path_polygons(plain)
+    stacked = expected.pop("/LIB/C:top/C:wrapper/C:child")
+    assert flatten(deduped) == flatten(plain) - stacked
+    assert get_batch_path_polygons(deduped) == expected
+
+
+def test_dedup_batch_remaps_ranges():
+    matrices = np.zeros((5, 2, 3))
+    matrices[:, :, :2] = np.eye(2)
+    matrices[:, 0, 2] = [0, 1, 0, 1, 2]
+    unique, ranges = dedup_batch(matrices, [(0, 0, 2), (1, 2, 2), (2, 4, 1)])
+    np.testing.assert_array_equal(unique[:, 0, 2], [0, 1, 2])
+    assert ranges == [[0, 0, 2], [2, 2, 1]]
+
+
+def test_dedup_needs_batch(layer_names):
+    with pytest.raises(ValueError):
+        to_json(make_library(), return_json=False, dedup=True)
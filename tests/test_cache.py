@@ -0,0 +1,105 @@
+import os
+
+import gdstk
+import numpy as np
+
+from cache import hash_cell, load_templates, save_templates
+from helpers import make_library
+from to_cell_json import get_cell_groups, get_layer_polygons, to_json
+
+
+def convert(lib, capsys, **options):
+    """to_json of lib and the "cell cache: ..." line it prints."""
+    capsys.readouterr()
+    result = to_json(lib, **options)
+    lines = capsys.readouterr().out.splitlines()
+    return result, next(line for line in lines if line.startswith("cell cache:"))
+
+
+def make_changed_library(name):
+    """make_library with one more rectangle in the cell name."""
+    lib = make_library()
+    lib[name].add(gdstk.rectangle((10, 0), (11, 1), layer=2))
+    return lib
+
+
+def test_save_and_load_templates(layer_names, tmp_path):
+    cell = make_library()["child"]
+    groups = get_cell_groups({"child": get_layer_polygons(cell)})["child"]
+    save_templates(str(tmp_path), "child", groups)
+    loaded = load_templates(str(tmp_path), "child")
+    assert list(loaded) == list(groups)
+    for layer, templates in groups.items():
+        assert len(loaded[layer]) == len(templates)
+        for (key, points, matrices), expected in zip(loaded[layer], templates):
+            assert key == expected[0]
+            np.testing.assert_array_equal(points, expected[1])
+            np.testing.assert_array_equal(matrices, expected[2])
+    assert load_templates(str(tmp_path), "missing") is None
+
+
+def test_hash_cell_covers_content():
+    polygons = {(1, 0): [np.zeros((4, 2)), np.ones((3, 2))]}
+    matrices = np.eye(2, 3)[None]
+    cell_hash = hash_cell(polygons, [("child", matrices)], "settings")
+    assert cell_hash == hash_cell(polygons, [("child", matrices)], "settings")
+    moved = {(1, 0): [np.zeros((4, 2)), np.full((3, 2), 2.0)]}
+    assert cell_hash != hash_cell(moved, [("child", matrices)], "settings")
+    assert cell_hash != hash_cell(polygons, [("other", matrices)], "settings")
+    assert cell_hash != hash_cell(polygons, [("child", 2 * matrices)], "settings")
+    assert cell_hash != hash_cell(polygons, [("child", matrices)], "other")
+
+
+def test_cache_reuses_unchanged_cells(layer_names, tmp_path, capsys):
+    cache_dir = str(tmp_path / "cache")
+    expected = to_json(make_library())
+
+    result, stats = convert(make_library(), capsys, cache_dir=cache_dir)
+    assert result == expected
+    assert stats == "cell cache: 0 hits, 3 converted, 0 evicted"
+    assert len(os.listdir(cache_dir)) == 3
+
+    result, stats = convert(make_library(), capsys, cache_dir=cache_dir)
+    assert result == expected
+    assert stats == "cell cache: 3 hits, 0 converted, 0 evicted"
+
+    # a changed child changes the hashes of all cells referencing it
+    result, stats = convert(make_changed_library("child"), capsys, cache_dir=cache_dir)
+    assert stats == "cell cache: 0 hits, 3 converted, 0 evicted"
+    assert result == to_json(make_changed_library("child"))
+    assert result != expected
+
+    # only the changed top cell is analyzed again
+    result, stats = convert(make_changed_library("top"), capsys, cache_dir=cache_dir)
+    assert result == to_json(make_changed_library("top"))
+    assert stats == "cell cache: 2 hits, 1 converted, 0 evicted"
+
+
+def test_cache_evicts_least_recently_used(layer_names, tmp_path, capsys):
+    cache_dir = str(tmp_path / "cache")
+    _, stats = convert(make_library(), capsys, cache_dir=cache_dir, cache_size=0)
+    assert stats == "cell cache: 0 hits, 3 converted, 3 evicted"
+    assert os.listdir(cache_dir) == []
+
+
+def make_etched_library(length):
+    """WG of length in a child cell, etched by its parent."""
+    lib = gdstk.Library("LIB")
+    child = lib.new_cell("child")
+    child.add(gdstk.rectangle((0, 0), (length, 1), layer=1))
+    etched = lib.new_cell("etched")
+    etched.add(gdstk.Reference(child))
+    etched.add(gdstk.rectangle((4, -1), (6, 2), layer=3, datatype=6))
+    lib.new_cell("top").add(gdstk.Reference(etched))
+    return lib
+
+
+def test_cache_covers_flattened_operands(layer_names, tmp_path, capsys):
+    # the child is below max_depth, only the flattened WG of etched changes
+    # its hash (and so the one of top)
+    cache_dir = str(tmp_path / "cache")
+    options = {"cache_dir": cache_dir, "max_depth": 1}
+    convert(make_etched_library(10), capsys, **options)
+    result, stats = convert(make_etched_library(12), capsys, **options)
+    assert stats == "cell cache: 0 hits, 2 converted, 0 evicted"
+    assert result == to_json(make_etched_library(12), max_depth=1)
@@ -0,0 +1,192 @@
+from collections import Counter
+
+import gdstk
+import numpy as np
+import pytest
+
+from helpers import (
+    flatten,
+    flatten_gdstk,
+    get_instance_points,
+    get_star,
+    make_library,
+)
+from tiles import get_layer_shapes
+from to_cell_json import (
+    convert_cell_path,
+    get_assembly,
+    handle_references,
+    to_json,
+    to_matrix_buffer,
+)
+
+
+def count_instances(assembly, n):
+    """Number of emitted instances with n points."""
+    db_unit = assembly.get("units", {}).get("db_unit")
+    return sum(
+        len(get_instance_points(instance, db_unit)) == n
+        for instance in assembly["instances"]
+    )
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"collapse": True},
+        {"merge": True},
+        {"merge": True, "merge_cuts": True},
+        {"encoding": "int"},
+        {"encoding": "int", "collapse": True},
+        {"mesh": True},
+        {"mesh": True, "encoding": "int"},
+        {"compact_transforms": True},
+        {"compact_transforms": True, "encoding": "int"},
+    ],
+)
+def test_export_matches_gdstk(layer_names, options):
+    lib = make_library()
+    assembly = to_json(lib, return_json=False, **options)
+    assert flatten(assembly) == flatten_gdstk(lib, layer_names)
+
+
+def test_congruent_polygons_share_a_template(layer_names):
+    assembly = to_json(make_library(), return_json=False)
+    # the six stars of the child cell, placed ten times
+    assert count_instances(assembly, 48) == 1
+
+
+def test_templates_are_shared_across_cells(layer_names):
+    lib = gdstk.Library("LIB")
+    top = lib.new_cell("top")
+    star = np.round(get_star(), 3)
+    for i, layer in enumerate([2, 3]):
+        cell = lib.new_cell(f"cell{i}")
+        # four orientations per cell, mirrored in the second one
+        for j in range(4):
+            points = star @ np.linalg.matrix_power([[0, -1], [1, 0]], j).T
+            points = points * [1, (-1) ** i] + (2 * j, 0)
+            cell.add(gdstk.Polygon(points, layer=layer))
+        top.add(gdstk.Reference(cell, (0, 3 * i), columns=8, spacing=(10, 0)))
+    assembly = to_json(lib, return_json=False)
+    assert flatten(assembly) == flatten_gdstk(lib, layer_names)
+    assert count_instances(assembly, 48) == 1
+
+
+def get_cell_polygons(assembly):
+    """flatten() of the placed polygons per cell (the innermost C: of the id)."""
+    result = {}
+    for _, part in get_layer_shapes(assembly):
+        cell = [s for s in part["id"].split("/") if s.startswith("C:")][-1]
+        shape = {**assembly, "parts": [part]}
+        result[cell] = result.get(cell, Counter()) + flatten(shape)
+    return result
+
+
+@pytest.mark.parametrize("collapse", [False, True])
+def test_shared_cells_are_emitted_once(layer_names, collapse):
+    lib = make_library()
+    assembly = to_json(lib, return_json=False, collapse=collapse)
+    # the child is reached directly and through the wrapper, its polygons are
+    # emitted as often as with the direct path only
+    single = make_library()
+    top = single["top"]
+    top.remove(*(r for r in top.references if r.cell.name == "wrapper"))
+    expected = to_json(single, return_json=False, collapse=collapse)
+    assert len(assembly["instances"]) == len(expected["instances"])
+
+    refs = {}
+    for _, part in get_layer_shapes(assembly):
+        refs.setdefault(part["id"].split("/C:child/")[-1], set()).add(
+            tuple(part["shape"]["refs"])
+        )
+    assert refs and all(len(r) == 1 for r in refs.values())
+
+
+def test_collapse_keeps_cell_geometry(layer_names):
+    lib = make_library()
+    paths = get_cell_polygons(to_json(lib, return_json=False))
+    collapsed = get_cell_polygons(to_json(lib, return_json=False, collapse=True))
+    assert collapsed == paths
+
+
+def make_merge_library(rectangles):
+    lib = gdstk.Library("LIB")
+    cell = lib.new_cell("cell")
+    for layer, corners in rectangles:
+        cell.add(*(gdstk.rectangle(*c, layer=layer) for c in corners))
+    top = lib.new_cell("top")
+    top.add(gdstk.Reference(cell, (0, 0), columns=2, spacing=(5, 0)))
+    return lib
+
+
+@pytest.mark.parametrize("merge_cuts", [False, True])
+def test_merge_overlapping_and_abutting(layer_names, merge_cuts):
+    # M1 is merged, the VIAC cut layer only with merge_cuts
+    overlapping = [((0, 0), (2, 1)), ((1, 0), (3, 1))]
+    abutting = [((0, 2), (1, 3)), ((1, 2), (2, 3))]
+    lib = make_merge_library([(41, overlapping + abutting), (40, overlapping)])
+    merged = [((0, 0), (3, 1)), ((0, 2), (2, 3))]
+    expected = make_merge_library(
+        [(41, merged), (40, merged[:1] if merge_cuts else overlapping)]
+    )
+
+    assembly = to_json(lib, return_json=False, merge=True, merge_cuts=merge_cuts)
+    assert flatten(assembly) == flatten_gdstk(expected, layer_names)
+
+
+def test_int_encoding_uses_integer_buffers(layer_names):
+    assembly = to_json(make_library(), return_json=False, encoding="int")
+    assert assembly["units"]["db_unit"] > 0
+    for instance in assembly["instances"]:
+        # int32 only for instances that do not fit into int16
+        fits = np.abs(instance.astype(np.int64)).max() <= 32767
+        assert instance.dtype.name == ("int16" if fits else "int32")
+
+
+def get_placeholders(part):
+    if "lazy" in part:
+        yield part
+    for child in part.get("parts", []):
+        yield from get_placeholders(child)
+
+
+@pytest.mark.parametrize("max_depth", [0, 1])
+def test_lazy_cells_complete_the_export(layer_names, max_depth):
+    lib = make_library()
+    assembly = to_json(lib, return_json=False, max_depth=max_depth)
+    placeholders = [p for top in assembly["parts"] for p in get_placeholders(top)]
+    assert placeholders
+
+    result = flatten(assembly)
+    for placeholder in placeholders:
+        part = convert_cell_path(lib, placeholder["id"], return_json=False)
+        polygons = flatten(part)
+        assert sum(polygons.values()) > 0
+        # the placeholder box covers all polygons of the cell (up to rounding)
+        bbox = np.reshape(placeholder["lazy"]["bbox"], (2, 2))
+        points = np.concatenate([points for _, points in polygons])
+        assert np.all(points >= bbox[0] - 1e-4) and np.all(points <= bbox[1] + 1e-4)
+        result += polygons
+    assert result == flatten_gdstk(lib, layer_names)
+
+
+def test_convert_cell_path_rejects_unknown_cells(layer_names):
+    lib = make_library()
+    with pytest.raises(ValueError):
+        convert_cell_path(lib, "/OTHER/C:top")
+    with pytest.raises(KeyError):
+        convert_cell_path(lib, "/LIB/C:top/C:missing")
+
+
+def test_output_options_do_not_leak(layer_names):
+    to_json(make_library(), encoding="int", mesh=True, compact_transforms=True)
+    # the defaults are float32 rows and polygon points, whatever ran before
+    buffer = to_matrix_buffer(np.eye(2, 3)[None])
+    assert buffer.dtype == np.float32 and buffer.shape == (1, 6)
+    lib = make_library()
+    assembly = get_assembly(lib)
+    instance_index, _ = handle_references("top", lib["top"], "/LIB/C:top", assembly, 0)
+    assert instance_index == len(assembly["instances"]) > 0
+    assert all(i.dtype == np.float32 and i.ndim == 2 for i in assembly["instances"])
@@ -0,0 +1,293 @@
+import gdsfactory as gf
+import gdstk
+import klayout.db as kdb
+import numpy as np
+import pytest
+from gdsfactory.technology.layer_stack import DerivedLayer, LogicalLayer
+
+import to_cell_json
+from helpers import get_world_polygons
+from to_cell_json import check_layer_expression, get_derived_polygons
+
+POLYGONS = {
+    (1, 0): [
+        [(0, 0), (4, 0), (4, 1), (1, 1), (1, 3), (3, 3), (3, 4), (0, 4)],
+        [(6, 0), (9, 0), (6, 3)],
+    ],
+    (2, 0): [[(0.5, 0.5), (7, 0.5), (7, 2), (0.5, 2)]],
+}
+
+
+def get_expected_region(expression):
+    component = gf.Component()
+    for layer, polygons in POLYGONS.items():
+        for points in polygons:
+            component.add_polygon(points, layer=layer)
+    return expression.get_shapes(component)
+
+
+def get_region(polygons):
+    region = kdb.Region()
+    for polygon in polygons:
+        region.insert(
+            kdb.DPolygon([kdb.DPoint(x, y) for x, y in polygon.points]).to_itype(
+                gf.kcl.dbu
+            )
+        )
+    return region
+
+
+def evaluate(expression):
+    layers = {layer: [np.array(p, float) for p in ps] for layer, ps in POLYGONS.items()}
+    return get_derived_polygons(expression, layers)
+
+
+@pytest.mark.parametrize("operation", ["and", "&", "or", "|", "xor", "^", "not", "-"])
+def test_operations_match_gdsfactory(operation):
+    expression = DerivedLayer(
+        layer1=LogicalLayer(layer=(1, 0)),
+        layer2=LogicalLayer(layer=(2, 0)),
+        operation=operation,
+    )
+    check_layer_expression(expression)
+    result = get_region(evaluate(expression))
+    assert (result ^ get_expected_region(expression)).is_empty()
+
+
+@pytest.mark.parametrize(
+    "xoffset, yoffset, mode",
+    [(200, 200, 2), (100, 300, 2), (300, 0, 2), (-100, -100, 2), (150, 150, 0)],
+)
+def test_sizing_matches_gdsfactory(xoffset, yoffset, mode):
+    expression = DerivedLayer(
+        layer1=LogicalLayer(layer=(1, 0)),
+        layer2=LogicalLayer(layer=(2, 0)),
+        operation="or",
+        sizings_xoffsets=(xoffset,),
+        sizings_yoffsets=(yoffset,),
+        sizings_modes=(mode,),
+    )
+    polygons = evaluate(expression)
+    assert all(isinstance(polygon, gdstk.Polygon) for polygon in polygons)
+    assert (get_region(polygons) ^ get_expected_region(expression)).is_empty()
+
+
+def test_sized_drawn_layer_is_rejected():
+    with pytest.raises(ValueError):
+        check_layer_expression(
+            LogicalLayer(layer=(1, 0), sizings_xoffsets=(10,)), derived=False
+        )
+
+
+def make_split_library():
+    """WG in a child cell, the etch layers drawn over it at other levels.
+
+    "etched" draws DEEP_ETCH and SHALLOW_ETCH over its child, "siblings"
+    places the child next to a cell etching it, "apart" etches beside it.
+    The top cell also places the child unetched.
+    """
+    lib = gdstk.Library("LIB")
+    child = lib.new_cell("child")
+    child.add(gdstk.rectangle((0, 0), (10, 1), layer=1))
+    etched = lib.new_cell("etched")
+    etched.add(gdstk.Reference(child))
+    etched.add(gdstk.rectangle((4, -1), (6, 2), layer=3, datatype=6))
+    etched.add(gdstk.rectangle((7, -1), (8, 2), layer=2, datatype=6))
+    etch = lib.new_cell("etch")
+    etch.add(gdstk.rectangle((0, 0), (2, 3), layer=3, datatype=6))
+    siblings = lib.new_cell("siblings")
+    siblings.add(gdstk.Reference(child))
+    siblings.add(gdstk.Reference(etch, (1, -1)))
+    apart = lib.new_cell("apart")
+    apart.add(gdstk.Reference(child))
+    apart.add(gdstk.rectangle((4, 3), (6, 4), layer=3, datatype=6))
+    top = lib.new_cell("top")
+    top.add(gdstk.Reference(etched, (0, 0)))
+    top.add(gdstk.Reference(apart, (0, 10)))
+    top.add(gdstk.Reference(child, (0, 20), x_reflection=True))
+    top.add(gdstk.Reference(siblings, (0, 30), rotation=np.pi / 2))
+    return lib
+
+
+def get_points_region(polygons):
+    region = kdb.Region()
+    for points in polygons:
+        region.insert(
+            kdb.DPolygon([kdb.DPoint(x, y) for x, y in points]).to_itype(gf.kcl.dbu)
+        )
+    return region
+
+
+def check_derived_layers(lib, polygons):
+    """Compare the world polygons (layer name, points) of the derived layers
+    with gdsfactory's evaluation on the flattened library. They must not
+    overlap, i.e. the per cell result is not drawn below a cell evaluating the
+    layer on its flattened hierarchy."""
+    component = gf.Component()
+    for polygon in lib["top"].get_polygons():
+        component.add_polygon(polygon.points, layer=(polygon.layer, polygon.datatype))
+    for layer, info in to_cell_json.LAYER_INDEX.items():
+        if info.derived is not None:
+            result = get_points_region(p for name, p in polygons if name == info.name)
+            assert (result ^ info.derived.get_shapes(component)).is_empty(), info.name
+            result.merged_semantics = False
+            assert result.area() == result.merged().area(), info.name
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"collapse": True}, {"batch": True}, {"batch": True, "dedup": True}]
+)
+def test_derived_layers_across_hierarchy(layer_names, options):
+    lib = make_split_library()
+    assembly = to_cell_json.to_json(lib, return_json=False, **options)
+    check_derived_layers(lib, list(get_world_polygons(assembly)))
+
+
+def iter_parts(part):
+    yield part
+    for child in part.get("parts", []):
+        yield from iter_parts(child)
+
+
+@pytest.mark.parametrize("max_depth", [0, 1])
+def test_lazy_derived_layers_across_hierarchy(layer_names, max_depth):
+    lib = make_split_library()
+    assembly = to_cell_json.to_json(lib, return_json=False, max_depth=max_depth)
+    polygons = list(get_world_polygons(assembly))
+    placeholders = [
+        part["id"]
+        for top in assembly["parts"]
+        for part in iter_parts(top)
+        if "lazy" in part
+    ]
+    assert placeholders
+    for path in placeholders:
+        part = to_cell_json.convert_cell_path(lib, path, return_json=False)
+        polygons += get_world_polygons(part)
+    check_derived_layers(lib, polygons)
+
+
+def test_flattened_layers(layer_names):
+    lib = make_split_library()
+    cell_cache = to_cell_json.get_cell_cache(lib.top_level())
+    flattened = {key[0]: cached["flattened"] for key, cached in cell_cache.items()}
+    assert flattened == {
+        "top": set(),
+        "etched": {(1, 0, 1), (2, 0, 1)},
+        "apart": set(),
+        "child": set(),
+        "siblings": {(1, 0, 1)},
+        "etch": set(),
+    }
+
+
+@pytest.fixture(params=["generic", "sky130"])
+def pdk(request):
+    """Init the PDK of the param, the generic PDK is restored afterwards."""
+    getattr(to_cell_json, f"init_{request.param}")()
+    yield request.param
+    to_cell_json.init_generic()
+
+
+def get_scanned_view(layer):
+    """The layer view lookup by a scan over all views (before LAYER_VIEWS)."""
+    views = to_cell_json.PDK.layer_views.layer_views.values()
+    found = [view for view in views if view.layer == layer]
+    return found[0] if len(found) == 1 else None
+
+
+def test_layer_index_matches_layer_scans(pdk):
+    assert to_cell_json.LAYER_INDEX
+    for layer, info in to_cell_json.LAYER_INDEX.items():
+        level = to_cell_json.LAYERS[layer]
+        assert to_cell_json.get_layer_name(layer) == level["name"]
+        assert to_cell_json.get_layer_zmin(layer) == level["zmin"]
+        assert to_cell_json.get_layer_thickness(layer) == level["thickness"]
+
+        # derived layers are drawn with the view of their derived_layer
+        view = get_scanned_view(layer[:2])
+        if view is None:
+            with pytest.raises(KeyError):
+                to_cell_json.get_layer_color(layer)
+        else:
+            assert to_cell_json.get_layer_view(layer[:2]) is view
+            assert to_cell_json.get_layer_color(layer) == view.fill_color.as_hex()
+    with pytest.raises(KeyError):
+        to_cell_json.get_layer_name((12345, 0))
+
+
+def write_layers(path, layers):
+    lib = gdstk.Library("LIB")
+    cell = lib.new_cell("top")
+    for i, layer in enumerate(layers):
+        cell.add(gdstk.rectangle((2 * i, 0), (2 * i + 1, 1), *layer))
+    lib.write_gds(path)
+    return cell
+
+
+def read_layers(path):
+    (cell,) = to_cell_json.read_gds(path).cells
+    return {(p.layer, p.datatype) for p in cell.polygons}
+
+
+def test_excluded_and_unknown_layers_are_not_read(pdk, tmp_path, monkeypatch):
+    # an excluded layer that is in the layer stack, and one that is not
+    excluded = (81, 4)
+    monkeypatch.setitem(
+        to_cell_json.LAYERS, excluded, {"name": "excluded", "zmin": 0, "thickness": 1}
+    )
+    monkeypatch.setattr(to_cell_json, "EXCLUDE_LAYERS", [81, 236])
+    to_cell_json.build_layer_index()
+    assert to_cell_json.LAYER_INDEX[excluded].excluded
+
+    rendered = [
+        layer for layer in to_cell_json.LAYERS if len(layer) == 2 and layer != excluded
+    ]
+    skipped = [excluded, (236, 0), (12345, 0)]
+    path = tmp_path / "layers.gds"
+    cell = write_layers(path, rendered + skipped)
+
+    for layer in skipped:
+        assert layer not in to_cell_json.get_rendered_layers()
+        assert layer not in to_cell_json.get_source_layers()
+    assert read_layers(path) == {
+        layer for layer in rendered if layer in to_cell_json.get_source_layers()
+    }
+    assert not set(to_cell_json.get_source_polygons(cell)) & set(skipped)
+    assert not set(to_cell_json.get_polygons(cell)) & set(skipped)
+
+
+def test_derived_operands_are_read(layer_names, tmp_path):
+    # (1, 0) is not rendered itself, only as an operand of WG (1, 0, 1)
+    assert (1, 0) not in to_cell_json.get_rendered_layers()
+    assert (1, 0, 1) in to_cell_json.get_rendered_layers()
+    assert (1, 0) in to_cell_json.get_source_layers()
+
+    path = tmp_path / "layers.gds"
+    write_layers(path, [(1, 0), (12345, 0)])
+    assert read_layers(path) == {(1, 0)}
+    (cell,) = to_cell_json.read_gds(path).cells
+    assert set(to_cell_json.get_polygons(cell)) == {(1, 0, 1)}
+
+
+CUT_LAYERS = {
+    "generic": {(40, 0), (44, 0), (43, 0)},
+    "sky130": {(66, 44), (67, 44), (68, 44), (69, 44), (70, 44), (71, 44)},
+}
+
+
+def test_cut_layers_are_not_merged(pdk, monkeypatch):
+    # the cut flag, not the layer name decides ("polysilicon" contains "con")
+    monkeypatch.setitem(
+        to_cell_json.LAYERS,
+        (50, 0),
+        {"name": "polysilicon", "zmin": 0, "thickness": 1},
+    )
+    to_cell_json.build_layer_index()
+
+    cuts = {layer for layer, info in to_cell_json.LAYER_INDEX.items() if info.cut}
+    assert cuts == CUT_LAYERS[pdk]
+    rendered = set(to_cell_json.get_rendered_layers())
+    assert (50, 0) in to_cell_json.get_merge_layers()
+    assert to_cell_json.get_merge_layers() == rendered - cuts
+    assert to_cell_json.get_merge_layers(cuts=True) == rendered
@@ -0,0 +1,114 @@
+import io
+
+import gdstk
+import numpy as np
+import pytest
+import shapely
+
+from serialize import numpy_to_buffer_bin
+from helpers import get_instance_points, make_library
+from lod import LOD_BBOX_PIXELS
+from to_cell_json import convert_cell_path, to_json
+
+
+def get_lod_parts(part):
+    if "lod" in part:
+        yield part
+    for child in part.get("parts", []):
+        yield from get_lod_parts(child)
+
+
+def get_shapes(part):
+    for child in part["parts"]:
+        if "shape" in child:
+            yield child
+        elif not child["name"].startswith("C:"):
+            yield from get_shapes(child)
+
+
+def make_dense_library():
+    """A cell with a dense grid of small rectangles (worth an outline level).
+
+    The rectangles all differ in size, so they are not pooled as templates.
+    """
+    lib = gdstk.Library("LIB")
+    grid = lib.new_cell("grid")
+    for i in range(20):
+        for j in range(20):
+            corner = np.array((0.55 * i, 0.55 * j))
+            grid.add(
+                gdstk.rectangle(
+                    corner, corner + 0.5 + 0.002 * np.array((i, j)), layer=2
+                )
+            )
+    top = lib.new_cell("top")
+    top.add(gdstk.Reference(grid, (0, 0), columns=2, rows=1, spacing=(20, 0)))
+    top.add(gdstk.rectangle((-5, -5), (40, -3), layer=2))
+    return lib
+
+
+@pytest.mark.parametrize("make", [make_library, make_dense_library])
+def test_lod_stores_placements_once(layer_names, make):
+    assembly = to_json(make(), return_json=False, lod=True)
+    parts = [p for top in assembly["parts"] for p in get_lod_parts(top)]
+    assert parts
+
+    manifest, _ = numpy_to_buffer_bin(assembly, io.BytesIO())
+    lod_parts = [p for top in manifest["parts"] for p in get_lod_parts(top)]
+    checked = 0
+    for part in lod_parts:
+        lod = part["lod"]
+        for level in lod["levels"]:
+            for shape in level.get("parts", [level]):
+                assert "matrices" not in shape["shape"]
+        # the untransformed polygons of the cell share the placements buffer
+        offsets = {
+            shape["shape"]["matrices"]["offset"]
+            for shape in get_shapes(part)
+            if shape["name"] == "polygons" or shape["name"].startswith("L:")
+        }
+        checked += bool(offsets)
+        assert offsets <= {lod["matrices"]["offset"]}
+    assert checked
+
+
+def test_lod_outlines_cover_cell(layer_names):
+    lib = make_dense_library()
+    assembly = to_json(lib, return_json=False, lod=True)
+    (part,) = [p for top in assembly["parts"] for p in get_lod_parts(top)]
+    lod = part["lod"]
+    bbox, outline = lod["levels"]
+    assert outline["name"] == "LOD:outline"
+
+    # bbox below LOD_BBOX_PIXELS, outlines until the 0.5 squares reach a pixel
+    (x0, y0), (x1, y1) = lib.cells[0].bounding_box()
+    extent = max(x1 - x0, y1 - y0)
+    assert lod["thresholds"] == pytest.approx([LOD_BBOX_PIXELS, extent / 0.5])
+
+    instances = assembly["instances"]
+    assert np.allclose(
+        get_instance_points(instances[bbox["shape"]["refs"][0]]),
+        [(x0, y0), (x1, y0), (x1, y1), (x0, y1)],
+    )
+    (shape,) = outline["parts"]
+    outlines = shapely.union_all(
+        [
+            shapely.Polygon(get_instance_points(instances[ref]))
+            for ref in shape["shape"]["refs"]
+        ]
+    )
+    detail = sum(len(p.points) for p in lib.cells[0].polygons)
+    assert (
+        sum(len(get_instance_points(instances[ref])) for ref in shape["shape"]["refs"])
+        * 4
+        <= detail
+    )
+    for polygon in lib.cells[0].polygons:
+        assert outlines.covers(shapely.Polygon(polygon.points))
+
+
+def test_lod_rejects_max_depth(layer_names):
+    with pytest.raises(ValueError, match="max_depth"):
+        to_json(make_library(), return_json=False, lod=True, max_depth=1)
+    with pytest.raises(ValueError, match="max_depth"):
+        convert_cell_path(make_library(), "/LIB/C:top", lod=True, max_depth=1)
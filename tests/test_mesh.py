@@ -0,0 +1,66 @@
+import gdstk
+import numpy as np
+import pytest
+
+from mesh import earcut, get_area, get_meshes, triangulate
+
+
+def get_cap(mesh, n):
+    """Bottom cap triangles of an extruded mesh (see mesh.extrude)."""
+    triangles = mesh["triangles"].astype(np.int64)
+    return triangles[: (len(triangles) - 2 * n) // 2]
+
+
+def check_meshes(polygons):
+    for points, mesh in zip(polygons, get_meshes(polygons)):
+        n = len(points)
+        vertices = mesh["vertices"].astype(np.float64)
+        assert vertices.shape == (6 * n, 3)
+        ring = vertices[:n, :2]
+        cap = get_cap(mesh, n)
+        assert get_area(ring, cap) == pytest.approx(get_area(ring), rel=1e-6)
+
+
+def test_earcut_simple_ring():
+    ring = np.array([(0, 0), (4, 0), (4, 1), (1, 1), (1, 3), (4, 3), (4, 4), (0, 4)])
+    triangles, ok = earcut(ring.astype(np.float64))
+    assert ok
+    assert len(triangles) == len(ring) - 2
+    assert get_area(ring, triangles) == get_area(ring)
+
+
+def test_keyhole_ring():
+    # square with a square hole, joined by a bridge (repeated vertices)
+    ring = np.array(
+        [(0, 0), (4, 0), (4, 4), (0, 4), (0, 2), (1, 2), (1, 3), (3, 3), (3, 1)]
+        + [(1, 1), (1, 2), (0, 2)],
+        dtype=np.float64,
+    )
+    triangles = triangulate(ring)
+    assert get_area(ring, triangles) == pytest.approx(12)
+    check_meshes([ring])
+
+
+def test_merged_polygons():
+    rng = np.random.default_rng(1)
+    keyholes = 0
+    for _ in range(100):
+        corners = rng.uniform(0, 8, (rng.integers(3, 25), 2))
+        rectangles = [
+            gdstk.rectangle(tuple(p), tuple(p + rng.uniform(0.2, 3, 2)))
+            for p in corners
+        ]
+        polygons = [p.points for p in gdstk.boolean(rectangles, [], "or")]
+        keyholes += sum(len(np.unique(p, axis=0)) < len(p) for p in polygons)
+        check_meshes(polygons)
+    assert keyholes > 0
+
+
+def test_convex_polygons_use_fans():
+    polygons = [
+        np.array([(0, 0), (1, 0), (1, 1), (0, 1)]),
+        np.array([(0, 0), (2, 0), (3, 1), (2, 2), (0, 2)]),
+    ]
+    meshes = get_meshes(polygons)
+    assert len(get_cap(meshes[1], 5)) == 3
+    check_meshes(polygons)
@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+import shapely
+
+from polygon import (
+    TRANSFORMS,
+    canonical_keys,
+    canonical_polygons,
+    canonical_rectangles,
+    canonical_rings,
+    center_batch,
+    group_congruent_layers,
+    group_congruent_polygons,
+    snap,
+    transform,
+)
+from to_cell_json import get_trans_matrix
+
+
+def random_rings(count, n, seed=0):
+    """Star shaped integer rings without repeated or collinear vertices."""
+    rng = np.random.default_rng(seed)
+    # one vertex per sector keeps the rings simple
+    angles = (np.arange(n) + rng.uniform(0.1, 0.9, (count, n))) * 2 * np.pi / n
+    radii = rng.uniform(50, 100, (count, n))
+    rings = np.stack([np.cos(angles), np.sin(angles)], axis=2) * radii[..., None]
+    return np.rint(rings).astype(np.int64)
+
+
+def test_canonical_rings_match_shapely():
+    rings = random_rings(200, 7)
+    expected = [
+        np.asarray(shapely.normalize(shapely.Polygon(ring)).exterior.coords)[:-1]
+        for ring in rings
+    ]
+    np.testing.assert_array_equal(canonical_rings(rings), expected)
+
+
+def get_placements(points, rng):
+    """points in all 8 orientations of TRANSFORMS, each at a random offset."""
+    offsets = rng.integers(-1000, 1000, (8, 1, 2)) * 0.001
+    return np.stack([points @ t.T.astype(np.float64) for t in TRANSFORMS]) + offsets
+
+
+@pytest.mark.parametrize("n", [4, 6, 48])
+def test_canonical_keys_are_orientation_invariant(n):
+    rng = np.random.default_rng(n)
+    points = random_rings(1, n, seed=n)[0] * 0.001
+    if n == 4:
+        points = np.array([(0, 0), (0, 0.2), (0.5, 0.2), (0.5, 0)])
+    centered, _ = center_batch(get_placements(points, rng))
+    keys, trans_indices = canonical_keys(centered)
+    assert len(set(keys)) == 1
+    canonical = np.frombuffer(keys[0], dtype=np.int64).reshape(-1, 2)
+    for polygon, trans_index in zip(centered, trans_indices):
+        ring = snap(transform(polygon.astype(np.float64), trans_index))
+        assert shapely.Polygon(ring).equals(shapely.Polygon(canonical))
+
+
+def test_canonical_rectangles_match_polygons():
+    rng = np.random.default_rng(0)
+    lower = rng.integers(-100, 100, (50, 2))
+    upper = lower + rng.integers(1, 100, (50, 2))
+    x0, y0, x1, y1 = *lower.T, *upper.T
+    rings = np.stack([(x0, y0), (x0, y1), (x1, y1), (x1, y0)]).transpose(2, 0, 1)
+    # any start vertex and both orientations
+    rings = np.roll(rings, 1, axis=1)
+    rings[::2] = rings[::2, ::-1]
+    for expected, actual in zip(canonical_polygons(rings), canonical_rectangles(rings)):
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_group_transformations_restore_polygons():
+    rng = np.random.default_rng(1)
+    points = random_rings(1, 9)[0] * 0.001
+    polygons = get_placements(points, rng)
+    groups = group_congruent_polygons(polygons)
+    assert len(groups) == 1
+    reference, *instances = next(iter(groups.values()))
+    assert [instance["idx"] for instance in instances] == list(range(8))
+    for instance in instances:
+        matrix = get_trans_matrix(*instance["transformation"])
+        placed = reference @ matrix[:2, :2].T + matrix[:2, 2]
+        np.testing.assert_allclose(placed, polygons[instance["idx"]], atol=1e-6)
+
+
+def test_parallel_grouping_matches_sequential():
+    rng = np.random.default_rng(2)
+    layers = {
+        layer: [
+            polygon
+            for points in random_rings(3, n, seed=layer) * 0.001
+            for polygon in get_placements(points, rng)
+        ]
+        for layer, n in [(1, 5), (2, 8), (3, 5)]
+    }
+    expected = group_congruent_layers(layers)
+    result = group_congruent_layers(layers, workers=2, min_parallel=1)
+    assert result.keys() == expected.keys()
+    for key in expected:
+        for groups, expected_groups in zip(result[key], expected[key], strict=True):
+            assert list(groups) == list(expected_groups)
+            for group, expected_group in zip(groups.values(), expected_groups.values()):
+                np.testing.assert_array_equal(group[0], expected_group[0])
+                assert group[1:] == expected_group[1:]
@@ -0,0 +1,128 @@
+import base64
+import io
+import os
+
+import numpy as np
+import orjson
+import pytest
+
+from serialize import (
+    decode_buffer,
+    encode_buffer,
+    encode_bytes,
+    get_codecs,
+    write_stream_if_changed,
+)
+
+
+def test_write_stream_if_changed(tmp_path):
+    filename = str(tmp_path / "out.js")
+    assert write_stream_if_changed(filename, lambda fd: fd.write(b"abc"))
+    mtime = os.stat(filename).st_mtime_ns
+
+    assert not write_stream_if_changed(filename, lambda fd: fd.write(b"abc"))
+    assert os.stat(filename).st_mtime_ns == mtime
+
+    assert write_stream_if_changed(filename, lambda fd: fd.write(b"abd"))
+    with open(filename, "rb") as fd:
+        assert fd.read() == b"abd"
+    assert os.listdir(tmp_path) == ["out.js"]
+
+
+@pytest.mark.parametrize("codec", get_codecs(zstd=True))
+@pytest.mark.parametrize(
+    "dtype", ["int16", "int32", "uint8", "uint16", "uint32", "float32", "float64"]
+)
+def test_codec_round_trip(codec, dtype):
+    rng = np.random.default_rng(0)
+    info = np.iinfo(dtype) if np.dtype(dtype).kind in "iu" else None
+    if info is None:
+        values = rng.normal(size=(100, 6)).astype(dtype)
+    else:
+        # include the extremes, delta and zigzag must wrap around
+        values = rng.integers(info.min, info.max, (100, 2), endpoint=True)
+        values[:2] = [[info.min, info.max], [info.max, info.min]]
+        values = values.astype(dtype)
+
+    data = encode_bytes(values.ravel(), codec, stride=values.shape[-1])
+    if data is None:
+        pytest.skip(f"{codec} does not apply to {dtype}")
+    buffer = {
+        "shape": values.shape,
+        "dtype": dtype,
+        "buffer": base64.b64encode(data).decode(),
+        "codec": codec,
+        "stride": values.shape[-1],
+    }
+    np.testing.assert_array_equal(decode_buffer(buffer), values)
+
+
+def test_encode_buffer_picks_smallest():
+    values = np.repeat(np.arange(1000, dtype="int32"), 2).reshape(-1, 2)
+    buffer = encode_buffer(values, get_codecs())
+    assert buffer["codec"] != "b64"
+    assert len(buffer["buffer"]) < len(encode_buffer(values)["buffer"])
+    # buffers are flat, as the viewer expects them
+    np.testing.assert_array_equal(decode_buffer(buffer), values.ravel())
+    json_buffer = orjson.loads(orjson.dumps(buffer))
+    np.testing.assert_array_equal(decode_buffer(json_buffer), values.ravel())
+
+
+def test_compress_needs_json_output(layer_names):
+    from helpers import make_library
+    from to_cell_json import to_json
+
+    with pytest.raises(ValueError):
+        to_json(make_library(), return_json=False, compress=True)
+
+
+def decode_all(obj):
+    if isinstance(obj, dict) and "codec" in obj:
+        return decode_buffer(obj).tolist()
+    if isinstance(obj, dict):
+        return {key: decode_all(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [decode_all(value) for value in obj]
+    return obj
+
+
+@pytest.mark.parametrize("encoding", ["float", "int"])
+def test_compressed_json_decodes_to_plain(layer_names, encoding):
+    from helpers import make_library
+    from to_cell_json import to_json
+
+    plain = orjson.loads(to_json(make_library(), encoding=encoding))
+    compressed = orjson.loads(to_json(make_library(), encoding=encoding, compress=True))
+    assert decode_all(compressed) == decode_all(plain)
+
+
+@pytest.mark.parametrize("options", [{}, {"encoding": "int"}, {"mesh": True}])
+def test_binary_round_trip(layer_names, tmp_path, options):
+    from helpers import flatten, load_bin, make_library
+    from serialize import write_buffer_bin
+    from to_cell_json import to_json
+
+    assembly = to_json(make_library(), return_json=False, **options)
+    write_buffer_bin(assembly, str(tmp_path / "lib"))
+    loaded = load_bin(str(tmp_path / "lib"))
+    assert loaded["buffers"] == [
+        {"uri": "lib.bin", "byteLength": os.path.getsize(tmp_path / "lib.bin")}
+    ]
+    assert flatten(loaded) == flatten(assembly)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"compress": True}, {"lod": True}, {"collapse": True}, {"batch": True}],
+)
+def test_stream_matches_json(layer_names, options):
+    from helpers import make_library
+    from to_cell_json import to_json
+
+    expected = to_json(make_library(), **options)
+    fd = io.BytesIO()
+    assert (
+        to_json(make_library(), fd=fd, prefix="const a = ", suffix=";", **options)
+        is None
+    )
+    assert fd.getvalue() == f"const a = {expected};".encode()
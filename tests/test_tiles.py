@@ -0,0 +1,38 @@
+import os
+from collections import Counter
+
+from helpers import flatten, load_bin, make_library
+from tiles import write_tiles
+from to_cell_json import to_json
+
+
+def read_tiles(manifest, directory):
+    result = Counter()
+    for tile in manifest["tiles"]:
+        result += flatten(load_bin(os.path.join(directory, tile["uri"])))
+    return result
+
+
+def test_tiles_cover_all_polygons(layer_names, tmp_path):
+    assembly = to_json(make_library(), return_json=False, encoding="int")
+    manifest = write_tiles(assembly, str(tmp_path / "lib"), max_items=4)
+
+    assert len(manifest["tiles"]) > len({tile["layer"] for tile in manifest["tiles"]})
+    assert read_tiles(manifest, tmp_path) == flatten(assembly)
+    for tile in manifest["tiles"]:
+        assert tile["count"] <= 4 or len(tile["key"]) > 10
+
+
+def test_tiles_remove_stale_files(layer_names, tmp_path):
+    lib = make_library()
+    filename = str(tmp_path / "lib")
+    write_tiles(to_json(lib, return_json=False), filename, max_items=4)
+
+    # fewer polygons, some quadtree keys disappear
+    (top,) = lib.top_level()
+    top.remove(*top.references[:1])
+    manifest = write_tiles(to_json(lib, return_json=False), filename, max_items=4)
+    expected = {"lib.tiles.json"} | {
+        f"{tile['uri']}.{ext}" for tile in manifest["tiles"] for ext in ("json", "bin")
+    }
+    assert set(os.listdir(tmp_path)) == expected
@@ -0,0 +1,102 @@
+import gdstk
+import numpy as np
+import pytest
+
+from polygon import FULL_ORIENTATION
+from to_cell_json import (
+    compose_matrices,
+    get_orientations,
+    get_references,
+    get_trans_index,
+    get_trans_matrices,
+)
+
+
+def apply(matrices, points):
+    return (
+        np.einsum("nij,vj->nvi", matrices[:, :, :2], points) + matrices[:, None, :, 2]
+    )
+
+
+def polygon_set(polygons):
+    return sorted(tuple(np.sort(np.round(p, 6), axis=0).ravel()) for p in polygons)
+
+
+@pytest.mark.parametrize("magnification", [1, 2, 0.5])
+@pytest.mark.parametrize("x_reflection", [False, True])
+@pytest.mark.parametrize("rotation", [0, np.pi / 2, np.pi / 3])
+def test_references_match_gdstk(rotation, x_reflection, magnification):
+    cell = gdstk.Cell("child")
+    cell.add(gdstk.Polygon([(0, 0), (1, 0), (1, 2), (0.5, 3)]))
+    top = gdstk.Cell("top")
+    top.add(
+        gdstk.Reference(
+            cell,
+            (5, 3),
+            rotation=rotation,
+            magnification=magnification,
+            x_reflection=x_reflection,
+            columns=3,
+            rows=2,
+            spacing=(10, 7),
+        )
+    )
+    (reference,) = get_references(top)
+    points = cell.polygons[0].points
+    ours = polygon_set(apply(reference["matrices"], points))
+    expected = polygon_set(p.points for p in top.references[0].get_polygons())
+    assert ours == expected
+
+
+def test_compose_matrices_order():
+    rng = np.random.default_rng(0)
+    parents = rng.normal(size=(3, 2, 3))
+    children = rng.normal(size=(4, 2, 3))
+    result = compose_matrices(parents, children)
+
+    def full(m):
+        return np.vstack([m, [0, 0, 1]])
+
+    for n in range(4):
+        for p in range(3):
+            expected = full(parents[p]) @ full(children[n])
+            np.testing.assert_allclose(result[n * 3 + p], expected[:2])
+
+
+@pytest.mark.parametrize(
+    "repetition",
+    [
+        gdstk.Repetition(columns=3, rows=2, spacing=(10, 7)),
+        gdstk.Repetition(columns=2, rows=3, v1=(5, 1), v2=(-1, 4)),
+        gdstk.Repetition(offsets=[(3, 4), (-2, 7), (10, 0)]),
+        gdstk.Repetition(x_offsets=[2, 5, 11]),
+        gdstk.Repetition(y_offsets=[-3, 6]),
+    ],
+)
+def test_repetitions_match_gdstk(repetition):
+    cell = gdstk.Cell("child")
+    cell.add(gdstk.Polygon([(0, 0), (1, 0), (1, 2), (0.5, 3)]))
+    top = gdstk.Cell("top")
+    reference = gdstk.Reference(cell, (5, 3), rotation=np.pi / 2, magnification=2)
+    reference.repetition = repetition
+    top.add(reference)
+
+    (converted,) = get_references(top)
+    points = cell.polygons[0].points
+    ours = polygon_set(apply(converted["matrices"], points))
+    expected = polygon_set(p.points for p in reference.get_polygons())
+    assert ours == expected
+
+
+def test_orientations_of_trans_matrices():
+    rotations = np.repeat(np.arange(4) * np.pi / 2, 2)
+    reflections = np.tile([False, True], 4)
+    matrices = get_trans_matrices(np.zeros((8, 2)), rotations, reflections, np.ones(8))
+    expected = [get_trans_index(*args) for args in zip(rotations, reflections)]
+    assert get_orientations(matrices).tolist() == expected
+
+    # arbitrary angles and magnifications keep their linear part
+    matrices = get_trans_matrices(
+        np.zeros((2, 2)), [np.pi / 3, np.pi / 2], [False, True], [1, 2]
+    )
+    assert get_orientations(matrices).tolist() == [FULL_ORIENTATION] * 2
@@ -0,0 +1,56 @@
+import os
+
+from helpers import make_library
+from to_cell_json import poll
+
+
+def write(path, lib, mtime):
+    lib.write_gds(path)
+    # distinct mtimes, whatever the resolution of the file system
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_poll_exports_stable_changes_once(layer_names, tmp_path):
+    path = tmp_path / "lib.gds"
+    exported = []
+    state = {}
+
+    assert not poll(path, exported.append, state)
+    write(path, make_library(), 10**9)
+    data = path.read_bytes()
+    path.write_bytes(data[: len(data) // 2])
+    # first seen, the write may still go on
+    assert not poll(path, exported.append, state)
+    path.write_bytes(data)
+    assert not poll(path, exported.append, state)
+    assert poll(path, exported.append, state)
+    assert not poll(path, exported.append, state)
+    assert [cell.name for cell in exported[0].cells] == [
+        cell.name for cell in make_library().cells
+    ]
+
+    lib = make_library()
+    lib.new_cell("new")
+    write(path, lib, 2 * 10**9)
+    assert not poll(path, exported.append, state)
+    assert poll(path, exported.append, state)
+    assert not poll(path, exported.append, state)
+    assert len(exported) == 2 and "new" in {cell.name for cell in exported[1].cells}
+
+
+def test_poll_keeps_watching_after_a_failed_export(layer_names, tmp_path, capsys):
+    path = tmp_path / "lib.gds"
+    path.write_bytes(b"not a gds file")
+    exported = []
+    state = {}
+
+    assert not poll(path, exported.append, state)
+    assert poll(path, exported.append, state)
+    assert "failed" in capsys.readouterr().out
+    # not retried until the file changes
+    assert not poll(path, exported.append, state)
+
+    write(path, make_library(), 10**9)
+    assert not poll(path, exported.append, state)
+    assert poll(path, exported.append, state)
+    assert len(exported) == 1
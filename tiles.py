@@ -0,0 +1,301 @@
+# %%
+import os
+import re
+
+import numpy as np
+import orjson
+
+from polygon import ORIENTATIONS, FULL_ORIENTATION
+from serialize import write_buffer_bin, write_if_changed
+
+# %%
+
+MAX_TILE_ITEMS = 4096
+MAX_TILE_LEVEL = 10
+
+
+def get_layer_shapes(assembly):
+    """Yield (layer name, poly shape) for all shapes of a converted assembly."""
+
+    def walk(part):
+        if "shape" in part:
+            layer = [s for s in part["id"].split("/") if s.startswith("L:")][-1]
+            yield layer[2:], part
+        for child in part.get("parts", []):
+            yield from walk(child)
+
+    for part in assembly["parts"]:
+        yield from walk(part)
+
+
+def get_instance_bboxes(instances, db_unit=None):
+    """Return the (I, 2, 2) min/max corners of all instance polygons.
+
+    Meshes (see mesh.get_meshes) are in user units, points in database units
+    if db_unit is given.
+    """
+    bboxes = np.zeros((len(instances), 2, 2))
+    for i, instance in enumerate(instances):
+        if isinstance(instance, dict):
+            points = instance["vertices"][:, :2]
+            scale = 1.0
+        else:
+            points = instance
+            scale = 1.0 if db_unit is None else db_unit
+        bboxes[i] = points.min(axis=0) * scale, points.max(axis=0) * scale
+    return bboxes
+
+
+def get_matrices(buffer, db_unit=None):
+    """(N, 2, 3) float64 transforms of a matrix buffer (see to_matrix_buffer)."""
+    if not isinstance(buffer, dict):
+        return np.asarray(buffer, np.float64).reshape(-1, 2, 3)
+
+    translation = np.asarray(buffer["translation"], np.float64).reshape(-1, 2)
+    if buffer["translation"].dtype.kind == "i":
+        translation = translation * db_unit
+    if "orientation" in buffer:
+        orientation = np.asarray(buffer["orientation"])
+        linear = ORIENTATIONS[np.minimum(orientation, len(ORIENTATIONS) - 1)]
+        full = orientation == FULL_ORIENTATION
+        if full.any():
+            linear[full] = np.asarray(buffer["linear"]).reshape(-1, 2, 2)
+    else:
+        linear = np.asarray(buffer["linear"], np.float64).reshape(-1, 2, 2)
+    return np.concatenate([linear, translation[:, :, None]], axis=2)
+
+
+def get_matrix_count(buffer):
+    if isinstance(buffer, dict):
+        return len(buffer["translation"])
+    return len(buffer)
+
+
+def select_matrices(buffer, index):
+    """Subset of a matrix buffer, keeping its encoding."""
+    if not isinstance(buffer, dict):
+        return np.asarray(buffer, "float32").reshape(-1, 6)[index]
+    if "orientation" not in buffer:
+        return {key: value[index] for key, value in buffer.items()}
+
+    orientation = buffer["orientation"][index]
+    result = {"orientation": orientation, "translation": buffer["translation"][index]}
+    full = buffer["orientation"] == FULL_ORIENTATION
+    if (orientation == FULL_ORIENTATION).any():
+        # position of every transform within the stored linear parts
+        full_index = np.cumsum(full) - 1
+        result["linear"] = buffer["linear"][full_index[index][full[index]]]
+    return result
+
+
+def get_layer_items(shapes, instance_bboxes, db_unit=None):
+    """Flatten the placed polygons of the shapes of one layer.
+
+    Every (matrix, ref) pair of a shape is one placed polygon (item). Returns
+    the item arrays shape index, matrix index, ref and world bounding boxes
+    (K, 4) as xmin, ymin, xmax, ymax.
+    """
+    shape_index, matrix_index, refs, bboxes = [], [], [], []
+    for i, shape in enumerate(shapes):
+        shape_refs = np.asarray(shape["shape"]["refs"], dtype=np.int64)
+        matrices = get_matrices(shape["shape"]["matrices"], db_unit)
+
+        (x0, y0), (x1, y1) = instance_bboxes[shape_refs].transpose(1, 2, 0)
+        corners = np.stack(
+            [
+                np.stack([x, y], axis=-1)
+                for x, y in ((x0, y0), (x0, y1), (x1, y0), (x1, y1))
+            ],
+            axis=1,
+        )  # (R, 4, 2)
+        points = np.einsum("mij,rcj->mrci", matrices[:, :, :2], corners)
+        points += matrices[:, None, None, :, 2]
+
+        shape_index.append(np.full(len(matrices) * len(shape_refs), i))
+        matrix_index.append(np.repeat(np.arange(len(matrices)), len(shape_refs)))
+        refs.append(np.tile(shape_refs, len(matrices)))
+        bboxes.append(
+            np.concatenate([points.min(axis=2), points.max(axis=2)], axis=-1).reshape(
+                -1, 4
+            )
+        )
+
+    return (
+        np.concatenate(shape_index),
+        np.concatenate(matrix_index),
+        np.concatenate(refs),
+        np.concatenate(bboxes),
+    )
+
+
+def quadtree(centers, bounds, max_items=MAX_TILE_ITEMS, max_level=MAX_TILE_LEVEL):
+    """Partition points into quadtree leaves with at most max_items points.
+
+    Returns a list of (key, indices), where key is the quadrant path from the
+    root ("r", "r0", "r03", ...), quadrants are numbered x + 2 * y.
+    """
+    leaves = []
+
+    def split(indices, bounds, key):
+        if len(indices) <= max_items or len(key) > max_level:
+            leaves.append((key, indices))
+            return
+        (x0, y0, x1, y1) = bounds
+        xm, ym = (x0 + x1) / 2, (y0 + y1) / 2
+        quadrant = (centers[indices, 0] >= xm) + 2 * (centers[indices, 1] >= ym)
+        for q, sub_bounds in enumerate(
+            ((x0, y0, xm, ym), (xm, y0, x1, ym), (x0, ym, xm, y1), (xm, ym, x1, y1))
+        ):
+            sub_indices = indices[quadrant == q]
+            if len(sub_indices) > 0:
+                split(sub_indices, sub_bounds, f"{key}{q}")
+
+    split(np.arange(len(centers)), bounds, "r")
+    return leaves
+
+
+def get_tile_assembly(name, layer, key, shapes, items, indices, instances, header=None):
+    """Build an independent assembly holding the items of one tile.
+
+    Items of the same shape are regrouped into poly shapes: one per matrix for
+    shapes with more refs than matrices (untransformed polygons), one per ref
+    otherwise (instanced templates). Only the referenced instances are kept.
+    """
+    shape_index, matrix_index, refs, _ = (item[indices] for item in items)
+    used, local_refs = np.unique(refs, return_inverse=True)
+
+    layer_id = f"/{name}/L:{layer}"
+    tile = {
+        "version": 3,
+        "name": f"T:{key}",
+        "id": f"{layer_id}/T:{key}",
+        "loc": [(0, 0, 0), (0, 0, 0, 1)],
+        "parts": [],
+    }
+    for i in np.unique(shape_index):
+        source = shapes[i]
+        matrices = source["shape"]["matrices"]
+        count = get_matrix_count(matrices)
+        selected = np.flatnonzero(shape_index == i)
+        by_matrix = count <= len(source["shape"]["refs"])
+        group_index = (matrix_index if by_matrix else refs)[selected]
+        order = np.argsort(group_index, kind="stable")
+        _, starts = np.unique(group_index[order], return_index=True)
+        for members in np.split(selected[order], starts[1:]):
+            if by_matrix:
+                shape_refs = local_refs[members]
+                shape_matrices = select_matrices(matrices, matrix_index[members[:1]])
+            else:
+                shape_refs = local_refs[members[:1]]
+                shape_matrices = select_matrices(matrices, matrix_index[members])
+            index = len(tile["parts"])
+            # batch ranges (see get_batched_parts) refer to the whole batch
+            tile["parts"].append(
+                {
+                    **{k: v for k, v in source.items() if k != "ranges"},
+                    "name": f"s_{index}",
+                    "id": f"{tile['id']}/s_{index}",
+                    "shape": {
+                        **source["shape"],
+                        "refs": shape_refs.tolist(),
+                        "matrices": shape_matrices,
+                    },
+                }
+            )
+
+    return {
+        "format": "GDS",
+        "version": 3,
+        "name": name,
+        "id": f"/{name}",
+        "loc": [(0, 0, 0), (0, 0, 0, 1)],
+        **(header or {}),
+        "instances": [instances[i] for i in used],
+        "parts": [
+            {
+                "version": 3,
+                "name": f"L:{layer}",
+                "id": layer_id,
+                "loc": [(0, 0, 0), (0, 0, 0, 1)],
+                "parts": [tile],
+            }
+        ],
+    }
+
+
+def write_tiles(assembly, filename, max_items=MAX_TILE_ITEMS):
+    """Split a converted assembly into per-layer quadtree tiles.
+
+    Every tile is written as an independent binary assembly
+    filename.<layer>.<key>.json/.bin (see write_buffer_bin), the manifest
+    filename.tiles.json lists all tiles with their world bounding box, so a
+    viewer can load only the tiles intersecting the viewport.
+    """
+    name = assembly["name"]
+    base = filename.replace("\\", "/").split("/")[-1]
+    instances = assembly["instances"]
+    header = {key: assembly[key] for key in ("units", "mesh") if key in assembly}
+    db_unit = header["units"]["db_unit"] if "units" in header else None
+    instance_bboxes = get_instance_bboxes(instances, db_unit)
+
+    layers = {}
+    for layer, shape in get_layer_shapes(assembly):
+        layers.setdefault(layer, []).append(shape)
+
+    manifest = {"name": name, "bbox": None, "tiles": []}
+    for layer, shapes in layers.items():
+        items = get_layer_items(shapes, instance_bboxes, db_unit)
+        bboxes = items[3]
+        centers = (bboxes[:, :2] + bboxes[:, 2:]) / 2
+        bounds = (*centers.min(axis=0), *centers.max(axis=0))
+
+        for key, indices in quadtree(centers, bounds, max_items):
+            tile_bbox = [
+                *bboxes[indices, :2].min(axis=0),
+                *bboxes[indices, 2:].max(axis=0),
+            ]
+            uri = f"{base}.{layer}.{key}"
+            write_buffer_bin(
+                get_tile_assembly(
+                    name, layer, key, shapes, items, indices, instances, header
+                ),
+                f"{filename}.{layer}.{key}",
+            )
+            manifest["tiles"].append(
+                {
+                    "layer": layer,
+                    "key": key,
+                    "bbox": [float(v) for v in tile_bbox],
+                    "count": len(indices),
+                    "uri": uri,
+                }
+            )
+
+    if manifest["tiles"]:
+        tile_bboxes = np.asarray([tile["bbox"] for tile in manifest["tiles"]])
+        manifest["bbox"] = [
+            *tile_bboxes[:, :2].min(axis=0).tolist(),
+            *tile_bboxes[:, 2:].max(axis=0).tolist(),
+        ]
+    write_if_changed(f"{filename}.tiles.json", orjson.dumps(manifest))
+    remove_stale_tiles(filename, manifest)
+    return manifest
+
+
+def remove_stale_tiles(filename, manifest):
+    """Delete the tile files of filename that are not in manifest any more.
+
+    After an edit (e.g. in watch mode) quadtree keys can disappear, their
+    .json/.bin files would otherwise stay on disk. Returns the removed count.
+    """
+    directory, base = os.path.split(filename)
+    pattern = re.compile(rf"{re.escape(base)}\..+\.r[0-3]*\.(json|bin)")
+    current = {
+        f"{tile['uri']}.{ext}" for tile in manifest["tiles"] for ext in ("json", "bin")
+    }
+    removed = 0
+    for name in os.listdir(directory or "."):
+        if pattern.fullmatch(name) and name not in current:
+            os.remove(os.path.join(directory, name))
+            removed += 1
+    return removed
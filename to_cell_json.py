@@ -1,33 +1,139 @@
 # %%
 from collections import defaultdict
+from types import MappingProxyType
+from typing import NamedTuple
 
+import os
 import numpy as np
 import orjson
 import time
 
 import gdstk
+import klayout.db as kdb
 import sky130
 import gdsfactory as gf
-from gdsfactory.generic_tech import get_generic_pdk
-
-from serialize import numpy_to_buffer_json
-from polygon import group_by_length, group_congruent_polygons
+from gdsfactory.generic_tech import LAYER as GENERIC_LAYER, get_generic_pdk
+
+from serialize import (
+    get_codecs,
+    numpy_to_buffer_json,
+    write_buffer_bin,
+    write_stream_if_changed,
+    JsonStreamWriter,
+)
+from polygon import (
+    group_congruent_layers,
+    GRID_SIZE,
+    ORIENTATIONS,
+    FULL_ORIENTATION,
+)
+from cache import hash_cell, load_templates, save_templates, evict
+from tiles import write_tiles
+from mesh import get_meshes
+from lod import get_outlines, get_min_feature, get_thresholds, LOD_OUTLINE_RESOLUTION
 
 # %%
 
 PDK = None
 LAYERS = {}
+EXCLUDE_LAYERS = []
+# (layer, datatype) of the via and contact layers, see get_merge_layers
+CUT_LAYERS = frozenset()
+LAYER_INDEX = MappingProxyType({})
+LAYER_VIEWS = MappingProxyType({})
 
 DEBUG = False
 
 
+class LayerInfo(NamedTuple):
+    name: str
+    zmin: float
+    thickness: float
+    color: str  # None if the PDK has no unique layer view
+    excluded: bool
+    cut: bool = False  # via or contact layer, see get_merge_layers
+    derived: object = None  # DerivedLayer expression, see get_derived_polygons
+
+
+class OutputOptions(NamedTuple):
+    """Buffer encoding of an export, see get_output_options."""
+
+    # size of a database unit in user units for the "int" encoding, None for
+    # float32 buffers
+    db_unit: float = None
+    # emit instances as pre-triangulated unit height prisms
+    mesh: bool = False
+    # emit matrices as orientation code plus translation (see to_matrix_buffer)
+    compact_transforms: bool = False
+
+
+DEFAULT_OUTPUT = OutputOptions()
+
+
+def build_layer_index():
+    """Build the immutable (layer, datatype) -> LayerInfo table from LAYERS.
+
+    Derived layers are keyed (layer, datatype, n) with the (layer, datatype)
+    of the PDK's derived_layer, which also gives their color. Their
+    expressions are checked here, so an unsupported layer stack is rejected
+    before any conversion starts.
+    """
+    global LAYER_INDEX
+    global LAYER_VIEWS
+
+    for level in LAYERS.values():
+        if "derived" in level:
+            check_layer_expression(level["derived"])
+
+    views = defaultdict(list)
+    for view in PDK.layer_views.layer_views.values():
+        if view.layer is not None:
+            views[tuple(view.layer)].append(view)
+    LAYER_VIEWS = MappingProxyType(
+        {layer: found[0] for layer, found in views.items() if len(found) == 1}
+    )
+
+    LAYER_INDEX = MappingProxyType(
+        {
+            layer: LayerInfo(
+                name=level["name"],
+                zmin=level["zmin"],
+                thickness=level["thickness"],
+                color=(
+                    LAYER_VIEWS[layer[:2]].fill_color.as_hex()
+                    if layer[:2] in LAYER_VIEWS
+                    else None
+                ),
+                excluded=layer[0] in EXCLUDE_LAYERS,
+                cut=layer in CUT_LAYERS,
+                derived=level.get("derived"),
+            )
+            for layer, level in LAYERS.items()
+        }
+    )
+
+
 def init_sky130():
     global PDK
     global LAYERS
     global EXCLUDE_LAYERS
+    global CUT_LAYERS
 
     EXCLUDE_LAYERS = [81, 236]
+    CUT_LAYERS = frozenset(
+        tuple(layer)
+        for layer in (
+            sky130.LAYER.licon1drawing,
+            sky130.LAYER.mcondrawing,
+            sky130.LAYER.viadrawing,
+            sky130.LAYER.via2drawing,
+            sky130.LAYER.via3drawing,
+            sky130.LAYER.via4drawing,
+        )
+    )
     PDK = sky130.PDK
+    for level in PDK.layer_stack.layers.values():
+        check_layer_expression(level.layer, derived=False)
     LAYERS = {
         tuple(level.layer.layer): {
             "name": level.layer.layer.name,
@@ -36,122 +142,553 @@ def init_sky130():
         }
         for level in PDK.layer_stack.layers.values()
     }
+    build_layer_index()
 
 
 def init_generic():
     global PDK
     global LAYERS
     global EXCLUDE_LAYERS
+    global CUT_LAYERS
 
     EXCLUDE_LAYERS = []
+    CUT_LAYERS = frozenset(
+        tuple(layer)
+        for layer in (GENERIC_LAYER.VIAC, GENERIC_LAYER.VIA1, GENERIC_LAYER.VIA2)
+    )
     PDK = get_generic_pdk()
     LAYERS = {}
 
-    for level in PDK.get_layer_stack().layers.values():
+    derived = []
+    for name, level in PDK.get_layer_stack().layers.items():
         if isinstance(level.layer, gf.technology.layer_stack.DerivedLayer):
-            LAYERS[tuple(level.derived_layer.layer)] = {
-                "name": level.derived_layer.layer.name,
-                "thickness": level.thickness,
-                "zmin": level.zmin,
-            }
+            derived.append((name, level))
         else:
+            check_layer_expression(level.layer, derived=False)
             LAYERS[tuple(level.layer.layer)] = {
                 "name": level.layer.layer.name,
                 "thickness": level.thickness,
                 "zmin": level.zmin,
             }
 
+    # derived layers get their own key, their polygons are computed from the
+    # boolean expression of the level (see get_derived_polygons)
+    for name, level in derived:
+        layer = tuple(level.derived_layer.layer)
+        count = sum(1 for key in LAYERS if key[:2] == layer and len(key) == 3)
+        names = {info["name"] for info in LAYERS.values()}
+        LAYERS[(*layer, count + 1)] = {
+            "name": (
+                level.derived_layer.layer.name
+                if level.derived_layer.layer.name not in names
+                else name
+            ),
+            "thickness": level.thickness,
+            "zmin": level.zmin,
+            "derived": level.layer,
+        }
+    build_layer_index()
 
-def get_layer_name(layer):
-    if LAYERS.get(layer) is not None:
-        return LAYERS[layer]["name"]
+
+def get_layer_info(layer):
+    info = LAYER_INDEX.get(layer)
+    if info is not None:
+        return info
     else:
         raise KeyError(f"Layer {layer} is unknown")
 
 
+def get_layer_name(layer):
+    return get_layer_info(layer).name
+
+
 def get_layer_thickness(layer):
-    if LAYERS.get(layer) is not None:
-        return LAYERS[layer]["thickness"]
-    else:
-        raise KeyError(f"Layer {layer} is unknown")
+    return get_layer_info(layer).thickness
 
 
 def get_layer_zmin(layer):
-    if LAYERS.get(layer) is not None:
-        return LAYERS[layer]["zmin"]
-    else:
-        raise KeyError(f"Layer {layer} is unknown")
+    return get_layer_info(layer).zmin
 
 
 def get_layer_view(layer):
-    result = [
-        view for view in PDK.layer_views.layer_views.values() if view.layer == layer
-    ]
-    if len(result) == 1:
-        return result[0]
+    view = LAYER_VIEWS.get(layer)
+    if view is not None:
+        return view
     else:
         raise KeyError(f"Layer {layer} is unknown")
 
 
 def get_layer_color(layer):
-    view = get_layer_view(layer)
-    return view.fill_color.as_hex()
+    color = get_layer_info(layer).color
+    if color is not None:
+        return color
+    else:
+        raise KeyError(f"Layer {layer} has no unique layer view")
 
 
-def get_polygons(cell, as_points=False):
-    layers = defaultdict(list)
+def get_rendered_layers():
+    """The layers that are converted, drawn (layer, datatype) and derived."""
+    return [layer for layer, info in LAYER_INDEX.items() if not info.excluded]
 
-    for polygon in cell.polygons:
-        key = (polygon.layer, polygon.datatype)
-        try:
-            _ = get_layer_name((polygon.layer, polygon.datatype))
-        except:
-            continue
 
-        if polygon.layer not in EXCLUDE_LAYERS:
-            if as_points:
-                layers[key].append(polygon.points)
-            else:
-                layers[key].append(polygon)
+def get_operand_layers(expression):
+    """The (layer, datatype) pairs a derived layer expression is built from."""
+    if isinstance(expression, gf.technology.layer_stack.DerivedLayer):
+        return get_operand_layers(expression.layer1) | get_operand_layers(
+            expression.layer2
+        )
+    return {tuple(expression.layer)}
+
+
+def get_source_layers():
+    """The drawn (layer, datatype) pairs needed for all rendered layers."""
+    layers = set()
+    for layer in get_rendered_layers():
+        derived = get_layer_info(layer).derived
+        layers |= {layer} if derived is None else get_operand_layers(derived)
+    return layers
+
+
+def read_gds(filename):
+    """Read a GDS file, materializing only the shapes of the rendered layers.
+
+    Fill, text, marker and other unknown or excluded layers are skipped by
+    gdstk while parsing, so they cost neither parse time nor memory.
+    """
+    return gdstk.read_gds(filename, filter=get_source_layers())
+
+
+# operation keywords of the DerivedLayer operator symbols
+BOOLEAN_OPERATIONS = {"&": "and", "|": "or", "^": "xor", "-": "not"}
+
+
+def get_operation(expression):
+    """gdstk boolean operation of a DerivedLayer, keyword or symbol."""
+    return BOOLEAN_OPERATIONS.get(expression.operation, expression.operation)
+
+
+def get_sizings(expression):
+    """Non zero (dx, dy, mode) sizings of a layer expression, in database
+    units of the gdsfactory layout."""
+    return [
+        (dx, dy, mode)
+        for dx, dy, mode in zip(
+            expression.sizings_xoffsets,
+            expression.sizings_yoffsets,
+            expression.sizings_modes,
+        )
+        if dx != 0 or dy != 0
+    ]
+
+
+def check_layer_expression(expression, derived=True):
+    """Raise ValueError for a layer expression get_derived_polygons cannot
+    evaluate, derived=False for the layer of a drawn level."""
+    if get_sizings(expression) and not derived:
+        raise ValueError(f"sizing of the drawn layer {expression} is not supported")
+    if isinstance(expression, gf.technology.layer_stack.DerivedLayer):
+        if get_operation(expression) not in BOOLEAN_OPERATIONS.values():
+            raise ValueError(
+                f"unknown operation {expression.operation!r} in {expression}"
+            )
+        check_layer_expression(expression.layer1)
+        check_layer_expression(expression.layer2)
+
+
+def size_polygons(polygons, dx, dy, mode):
+    """Size polygons with klayout's Region.sized like gdsfactory does.
+
+    dx, dy are in database units of the gdsfactory layout, mode selects the
+    corner cutoff. Holes are joined to the outline (keyhole), as in gdstk's
+    boolean results.
+    """
+    dbu = gf.kcl.dbu
+    region = kdb.Region()
+    for polygon in polygons:
+        points = polygon.points if isinstance(polygon, gdstk.Polygon) else polygon
+        region.insert(kdb.DPolygon([kdb.DPoint(x, y) for x, y in points]).to_itype(dbu))
+    return [
+        gdstk.Polygon(
+            [(p.x * dbu, p.y * dbu) for p in polygon.resolved_holes().each_point_hull()]
+        )
+        for polygon in region.sized(dx, dy, mode).each()
+    ]
+
+
+def get_derived_polygons(expression, layers):
+    """Evaluate a DerivedLayer expression with gdstk booleans and sizings
+    (see size_polygons).
+
+    Args:
+        expression: DerivedLayer or LogicalLayer of the PDK layer stack.
+        layers: dict of (layer, datatype) -> list of polygons (gdstk polygons
+          or point arrays) of one cell.
+
+    Returns:
+        list of gdstk polygons.
+    """
+    if isinstance(expression, gf.technology.layer_stack.DerivedLayer):
+        polygons1 = get_derived_polygons(expression.layer1, layers)
+        polygons2 = get_derived_polygons(expression.layer2, layers)
+        operation = get_operation(expression)
+        if not polygons1 and operation in ("and", "not"):
+            return []
+        result = gdstk.boolean(polygons1, polygons2, operation)
+    else:
+        result = list(layers.get(tuple(expression.layer), []))
+
+    for dx, dy, mode in get_sizings(expression):
+        result = size_polygons(result, dx, dy, mode)
+    return result
+
+
+def get_source_polygons(cell, layers=None, depth=0):
+    """Return the point arrays of cell per source layer.
+
+    Args:
+        layers: (layer, datatype) pairs to read, default get_source_layers().
+        depth: 0 for the own polygons of cell (without references), None for
+          the flattened hierarchy.
+
+    Uses gdstk's per-layer filtering, so unknown and excluded layers are never
+    copied.
+    """
+    result = {}
+    for layer, datatype in sorted(get_source_layers() if layers is None else layers):
+        polygons = cell.get_polygons(
+            include_paths=False, depth=depth, layer=layer, datatype=datatype
+        )
+        if len(polygons) > 0:
+            result[(layer, datatype)] = [polygon.points for polygon in polygons]
+    return result
+
+
+def get_flattened_source(cell, flattened):
+    """Source polygons of the flattened hierarchy of cell per derived layer in
+    flattened (see get_flattened_layers), only the operands of each layer."""
+    return {
+        layer: get_source_polygons(
+            cell, get_operand_layers(get_layer_info(layer).derived), depth=None
+        )
+        for layer in flattened
+    }
 
-    return dict(layers)
+
+def evaluate_layers(source, flattened_source=None):
+    """Map source layer polygons (see get_source_polygons) to rendered layers.
+
+    Drawn layers are taken as they are, derived layers are evaluated from
+    their operands, the ones in flattened_source (see get_flattened_source)
+    from the operands of the flattened hierarchy.
+    """
+    flattened_source = flattened_source or {}
+    layers = {}
+    for layer in get_rendered_layers():
+        derived = get_layer_info(layer).derived
+        if derived is None:
+            polygons = source.get(layer, [])
+        else:
+            operands = flattened_source.get(layer, source)
+            polygons = [p.points for p in get_derived_polygons(derived, operands)]
+        if len(polygons) > 0:
+            layers[layer] = polygons
+    return layers
+
+
+def get_interacting_layers(expression):
+    """Pairs of source layers whose polygons interact in a layer expression.
+
+    The expression evaluated on the polygons of two cells is the union of the
+    expression evaluated per cell, unless polygons of such a pair from
+    different cells overlap: the operands on both sides of an "and", "not" or
+    "xor", and any two operands (the same one too) below a shrinking sizing.
+    Returns a set of sorted (layer, layer) pairs.
+    """
+    pairs = set()
+    if isinstance(expression, gf.technology.layer_stack.DerivedLayer):
+        pairs |= get_interacting_layers(expression.layer1)
+        pairs |= get_interacting_layers(expression.layer2)
+        if get_operation(expression) != "or":
+            pairs |= {
+                tuple(sorted((a, b)))
+                for a in get_operand_layers(expression.layer1)
+                for b in get_operand_layers(expression.layer2)
+            }
+    if any(dx < 0 or dy < 0 for dx, dy, _ in get_sizings(expression)):
+        operands = sorted(get_operand_layers(expression))
+        pairs |= {(a, b) for i, a in enumerate(operands) for b in operands[i:]}
+    return pairs
+
+
+def get_sizing_margin(expression):
+    """Upper bound of the growth of polygons by the sizings of expression, in
+    database units of the gdsfactory layout."""
+    margin = sum(max(abs(dx), abs(dy)) for dx, dy, _ in get_sizings(expression))
+    if isinstance(expression, gf.technology.layer_stack.DerivedLayer):
+        margin += max(
+            get_sizing_margin(expression.layer1), get_sizing_margin(expression.layer2)
+        )
+    return margin
+
+
+def get_derived_layers():
+    """Rendered derived layers with interacting operands, as (layer,
+    interacting pairs, sizing margin in user units)."""
+    result = []
+    for layer in get_rendered_layers():
+        derived = get_layer_info(layer).derived
+        if derived is not None:
+            pairs = get_interacting_layers(derived)
+            if pairs:
+                result.append((layer, pairs, get_sizing_margin(derived) * gf.kcl.dbu))
+    return result
+
+
+def place_boxes(boxes, matrices):
+    """(N * B, 4) bounding boxes of (B, 4) boxes placed with (N, 2, 3) matrices."""
+    x0, y0, x1, y1 = np.asarray(boxes, dtype=np.float64).T
+    corners = np.stack([(x0, y0), (x0, y1), (x1, y0), (x1, y1)]).transpose(2, 0, 1)
+    points = np.einsum("nij,bcj->nbci", matrices[:, :, :2], corners)
+    points += matrices[:, None, None, :, 2]
+    return np.concatenate([points.min(axis=2), points.max(axis=2)], axis=2).reshape(
+        -1, 4
+    )
+
+
+def get_operand_boxes(cell, layers, cell_cache, memo):
+    """Bounding boxes of the polygons on layers in the hierarchy of cell.
+
+    Returns {"own": {layer: (P, 4) boxes of the own polygons}, "boxes":
+    {layer: (x0, y0, x1, y1) of the whole hierarchy}}, memoized per unique
+    cell in memo. The references of cells in cell_cache are reused.
+    """
+    key = get_cell_key(cell)
+    if key in memo:
+        return memo[key]
+
+    own = {
+        layer: np.array(
+            [(*p.min(axis=0), *p.max(axis=0)) for p in polygons], dtype=np.float64
+        )
+        for layer, polygons in get_source_polygons(cell, layers).items()
+    }
+    placed = {layer: [boxes] for layer, boxes in own.items()}
+    cached = cell_cache.get(key)
+    references = get_references(cell) if cached is None else cached["references"]
+    for reference in references:
+        child = get_operand_boxes(reference["cell"], layers, cell_cache, memo)
+        for layer, box in child["boxes"].items():
+            placed.setdefault(layer, []).append(
+                place_boxes([box], reference["matrices"])
+            )
+
+    boxes = {}
+    for layer, layer_boxes in placed.items():
+        layer_boxes = np.concatenate(layer_boxes)
+        boxes[layer] = (
+            *layer_boxes[:, :2].min(axis=0),
+            *layer_boxes[:, 2:].max(axis=0),
+        )
+    memo[key] = {"own": own, "boxes": boxes}
+    return memo[key]
+
+
+def boxes_overlap(boxes1, ids1, boxes2, ids2, margin=0.0, chunk=1024):
+    """Whether any two (N, 4) boxes with different ids overlap or touch, with
+    the boxes grown by margin."""
+    for start in range(0, len(boxes1), chunk):
+        b = boxes1[start : start + chunk, None]
+        hit = (
+            (b[..., 0] <= boxes2[:, 2] + 2 * margin)
+            & (boxes2[:, 0] <= b[..., 2] + 2 * margin)
+            & (b[..., 1] <= boxes2[:, 3] + 2 * margin)
+            & (boxes2[:, 1] <= b[..., 3] + 2 * margin)
+            & (ids1[start : start + chunk, None] != ids2)
+        )
+        if hit.any():
+            return True
+    return False
+
+
+def get_flattened_layers(cell, cell_cache, memo):
+    """Derived layers of cell that are evaluated on its flattened hierarchy.
+
+    A derived layer is evaluated per unique cell (see evaluate_layers), which
+    only matches the evaluation on the flattened polygons (as gdsfactory's
+    get_shapes does) if interacting operands (see get_interacting_layers)
+    never come from different cells. Where the own polygons of cell and the
+    hierarchies of its placements, or two placements, have interacting
+    operands with overlapping bounding boxes, the layer is evaluated on the
+    flattened hierarchy of cell instead and hidden in the cells below it (see
+    handle_references). memo holds the operand boxes, see get_operand_boxes.
+
+    Returns a frozenset of derived layer keys.
+    """
+    derived_layers = get_derived_layers()
+    if not derived_layers:
+        return frozenset()
+
+    operands = {
+        layer for _, pairs, _ in derived_layers for pair in pairs for layer in pair
+    }
+    key = get_cell_key(cell)
+    boxes = {}
+    for layer, own in get_operand_boxes(cell, operands, cell_cache, memo)[
+        "own"
+    ].items():
+        boxes[layer] = [(own, np.zeros(len(own), dtype=np.int64))]
+    cached = cell_cache.get(key)
+    references = get_references(cell) if cached is None else cached["references"]
+    # every placement of a reference is a contributor of its own
+    contributor = 1
+    for reference in references:
+        matrices = reference["matrices"]
+        child = get_operand_boxes(reference["cell"], operands, cell_cache, memo)
+        ids = np.arange(contributor, contributor + len(matrices))
+        for layer, box in child["boxes"].items():
+            boxes.setdefault(layer, []).append((place_boxes([box], matrices), ids))
+        contributor += len(matrices)
+
+    def concatenate(layer):
+        found = boxes.get(layer, [])
+        return (
+            np.concatenate([b for b, _ in found]) if found else np.zeros((0, 4)),
+            np.concatenate([i for _, i in found]) if found else np.zeros(0, np.int64),
+        )
+
+    flattened = set()
+    for layer, pairs, margin in derived_layers:
+        for a, b in pairs:
+            if boxes_overlap(*concatenate(a), *concatenate(b), margin):
+                flattened.add(layer)
+                break
+    return frozenset(flattened)
+
+
+def get_polygons(cell, as_points=False, flattened=()):
+    """Return the polygons of the rendered layers of cell (without references),
+    the derived layers in flattened of the flattened hierarchy."""
+    layers = evaluate_layers(
+        get_source_polygons(cell), get_flattened_source(cell, flattened)
+    )
+    if as_points:
+        return layers
+    return {
+        layer: [gdstk.Polygon(points, *layer[:2]) for points in polygons]
+        for layer, polygons in layers.items()
+    }
 
 
 def get_layer_polygons(cell):
-    return {k: [p.points for p in v] for k, v in get_polygons(cell).items()}
+    return get_polygons(cell, as_points=True)
+
+
+def get_merge_layers(cuts=False):
+    """Rendered layers merged by merge_layer_polygons.
+
+    Via and contact layers (CUT_LAYERS of the PDK) consist of many identical
+    squares that instance well, they are skipped unless cuts is True.
+    """
+    return {
+        layer
+        for layer in get_rendered_layers()
+        if cuts or not get_layer_info(layer).cut
+    }
+
+
+def merge_layer_polygons(layers, merge_layers):
+    """Merge overlapping and abutting polygons of the layers in merge_layers.
+
+    Uses gdstk's boolean "or" on all polygons of a layer at once, holes are
+    connected to the outline by gdstk, so the results are simple rings.
+    """
+    return {
+        layer: (
+            [p.points for p in gdstk.boolean(polygons, [], "or")]
+            if layer in merge_layers
+            else polygons
+        )
+        for layer, polygons in layers.items()
+    }
+
+
+def get_cell_key(cell):
+    return (cell.name, hash(cell))
+
+
+def get_repetition_offsets(repetition):
+    """Return the (N, 2) placement offsets of a gdstk Repetition, or None."""
+    if repetition.columns is not None:
+        columns, rows = np.meshgrid(
+            np.arange(repetition.columns),
+            np.arange(repetition.rows),
+            indexing="ij",
+        )
+        columns, rows = columns.reshape(-1, 1), rows.reshape(-1, 1)
+        if repetition.spacing is not None:
+            return np.hstack([columns, rows]) * np.asarray(repetition.spacing)
+        else:
+            return columns * np.asarray(repetition.v1) + rows * np.asarray(
+                repetition.v2
+            )
+
+    if repetition.offsets is not None:
+        offsets = np.asarray(repetition.offsets)
+    elif repetition.x_offsets is not None:
+        offsets = np.asarray(repetition.x_offsets)[:, None] * [1.0, 0.0]
+    elif repetition.y_offsets is not None:
+        offsets = np.asarray(repetition.y_offsets)[:, None] * [0.0, 1.0]
+    else:
+        return None
+
+    # explicit offsets do not contain the reference placement itself
+    return np.vstack([[(0.0, 0.0)], offsets])
 
 
 def get_references(cell):
-    reference_data = defaultdict(set)
+    """Return the referenced cells of cell with all placements as (N, 2, 3) matrices.
+
+    Repetitions (GDS arrays) are expanded into one matrix row per placement.
+    Placements are deduplicated and sorted by (origin, rotation, x_reflection,
+    magnification).
+    """
+    reference_data = defaultdict(list)
     cells = {}
 
     for ref in cell.references:
         transform = (
-            tuple(ref.origin),  # (x, y) coordinates
+            *ref.origin,  # (x, y) coordinates
             ref.rotation,  # Rotation in radians
             ref.x_reflection,  # Boolean reflection state
             ref.magnification,  # Magnification factor
         )
 
-        if (
-            ref.repetition.columns is not None
-            or ref.repetition.offsets is not None
-            or ref.repetition.x_offsets is not None
-            or ref.repetition.y_offsets is not None
-        ):
-            print(
-                f"Warning: Repetition not supported for {ref.cell.name} in {cell.name}"
-            )
-        cells[(ref.cell.name, hash(ref.cell))] = ref.cell
-        reference_data[(ref.cell.name, hash(ref.cell))].add(transform)
+        key = get_cell_key(ref.cell)
+        cells[key] = ref.cell
 
-    return [
-        {
-            "cell": cells[key],
-            "transforms": sorted(transforms, key=lambda x: (x[0], x[1], x[2], x[3])),
-        }
-        for key, transforms in reference_data.items()
-    ]
+        offsets = get_repetition_offsets(ref.repetition)
+        if offsets is None:
+            reference_data[key].append(np.asarray([transform], dtype=np.float64))
+        else:
+            transforms = np.repeat([transform], len(offsets), axis=0)
+            transforms[:, :2] += offsets
+            reference_data[key].append(transforms)
+
+    references = []
+    for key, transforms in reference_data.items():
+        transforms = np.unique(np.concatenate(transforms), axis=0)
+        references.append(
+            {
+                "cell": cells[key],
+                "matrices": get_trans_matrices(
+                    transforms[:, :2],
+                    transforms[:, 2],
+                    transforms[:, 3] != 0,
+                    transforms[:, 4],
+                ),
+            }
+        )
+    return references
 
 
 # %%
@@ -188,13 +725,667 @@ def get_trans_matrix(origin, rotation, x_reflected, magnification):
     x, y = origin
     r = -1 if x_reflected else 1
     m = magnification
-    # Use scaling to mirror
-    return np.array([[c, -r * s, x], [s, r * c, y], [0, 0, 1]]) * m
+    # Use scaling to mirror, the magnification scales the linear part only
+    return np.array([[c * m, -r * s * m, x], [s * m, r * c * m, y], [0, 0, 1]])
 
     # use rotation around x axis to mirror
     # return np.array([[c * m, -r * s * m, r * x], [s * m, r * c * m, r * y], [0, 0, r]])
 
 
+def get_trans_matrices(origins, rotations, x_reflected, magnifications):
+    """Vectorized get_trans_matrix returning the upper (N, 2, 3) rows."""
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+    r = np.where(x_reflected, -1.0, 1.0)
+    m = np.asarray(magnifications, dtype=np.float64)
+    s, c = np.sin(rotations), np.cos(rotations)
+
+    matrices = np.empty((len(origins), 2, 3))
+    matrices[:, 0, 0] = c
+    matrices[:, 0, 1] = -r * s
+    matrices[:, 0, 2] = origins[:, 0]
+    matrices[:, 1, 0] = s
+    matrices[:, 1, 1] = r * c
+    matrices[:, 1, 2] = origins[:, 1]
+    matrices[:, :, :2] *= m[:, None, None]
+    return matrices
+
+
+def compose_matrices(parent_matrices, matrices):
+    """Compose (P, 2, 3) parent with (N, 2, 3) child affine transforms.
+
+    One batched matmul; result[n * P + p] = parent_matrices[p] @ matrices[n],
+    i.e. the same order as looping over children and then parents.
+    """
+    result = np.matmul(parent_matrices[None, :, :, :2], matrices[:, None, :, :])
+    result[..., 2] += parent_matrices[None, :, :, 2]
+    return result.reshape(-1, 2, 3)
+
+
+def get_orientations(matrices):
+    """Orientation codes (see ORIENTATIONS) of (N, 2, 3) transforms.
+
+    Transforms with arbitrary angles or a magnification get FULL_ORIENTATION.
+    """
+    linear = matrices[:, None, :, :2] - ORIENTATIONS[None]
+    match = np.all(np.abs(linear) < 1e-9, axis=(2, 3))
+    return np.where(match.any(axis=1), match.argmax(axis=1), FULL_ORIENTATION).astype(
+        "uint8"
+    )
+
+
+def to_matrix_buffer(matrices, output=DEFAULT_OUTPUT):
+    """Matrix buffer of (N, 2, 3) transforms.
+
+    float32 (N, 6) rows, or with output.db_unit set {"linear": float32 (N, 4),
+    "translation": int32 (N, 2) in database units}.
+
+    With output.compact_transforms {"orientation": uint8 (N,), "translation"}
+    where the translation is float32 or int32 database units as above. Only
+    the transforms with FULL_ORIENTATION store their linear part, in order, as
+    "linear": float32 (F, 4).
+    """
+    if output.db_unit is None:
+        translation = np.ascontiguousarray(matrices[:, :, 2], dtype="float32")
+    else:
+        translation = np.rint(matrices[:, :, 2] / output.db_unit).astype("int32")
+
+    if output.compact_transforms:
+        orientation = get_orientations(matrices)
+        buffer = {"orientation": orientation, "translation": translation}
+        full = orientation == FULL_ORIENTATION
+        if full.any():
+            buffer["linear"] = np.ascontiguousarray(
+                matrices[full, :, :2].reshape(-1, 4), "float32"
+            )
+        return buffer
+
+    if output.db_unit is None:
+        return np.ascontiguousarray(matrices.reshape(-1, 6), dtype="float32")
+    return {
+        "linear": np.ascontiguousarray(matrices[:, :, :2].reshape(-1, 4), "float32"),
+        "translation": translation,
+    }
+
+
+def to_instance_buffer(points, output=DEFAULT_OUTPUT):
+    """Polygon points as float32, or with output.db_unit set as int16 (if they
+    fit) or int32 in database units."""
+    if output.db_unit is None:
+        return points.astype("float32")
+    points = np.rint(points / output.db_unit)
+    dtype = "int16" if np.abs(points).max(initial=0) <= 32767 else "int32"
+    return points.astype(dtype)
+
+
+def add_instances(poly_assembly, polygons, output=DEFAULT_OUTPUT):
+    """Append the instance buffers of polygons to the assembly.
+
+    With output.mesh every polygon is emitted as its triangulated unit height
+    prism (see mesh.get_meshes) with float32 vertices in user units, built from
+    the encoded points so that it matches the plain buffer exactly.
+    """
+    buffers = [to_instance_buffer(points, output) for points in polygons]
+    if output.mesh:
+        scale = 1.0 if output.db_unit is None else output.db_unit
+        buffers = get_meshes([buffer * scale for buffer in buffers])
+    for buffer in buffers:
+        poly_assembly["instances"].append(buffer)
+
+
+def anchor_template(points, db_unit=None):
+    """Shift a centered template onto the database grid.
+
+    The centroid of a template is usually not a grid point, so its points are
+    not either. Shifting by the offset d of the first point puts all points on
+    the grid (they differ by grid vectors). Returns the shifted points and the
+    (1, 2, 3) matrix mapping them back onto the template. db_unit None means
+    float32 buffers, nothing is shifted.
+    """
+    if db_unit is None:
+        return points, np.eye(2, 3)[None]
+    d = points[0] - np.rint(points[0] / db_unit) * db_unit
+    return points - d, np.array([[[1, 0, d[0]], [0, 1, d[1]]]])
+
+
+def get_cell_groups(cell_polygons, workers=None):
+    """Analyze the layer polygons of unique cells for congruent polygons.
+
+    Args:
+        cell_polygons: dict of cell key -> layer polygons (see get_layer_polygons).
+        workers: number of processes, see group_congruent_layers.
+
+    Returns:
+        dict of cell key -> {layer: [(shape key, reference points, matrices)]},
+        one entry per group of congruent polygons, the (N, 2, 3) matrices map
+        the reference onto the N polygons of the group.
+    """
+    layers = {
+        (key, layer): layer_polygons
+        for key, polygons in cell_polygons.items()
+        for layer, layer_polygons in polygons.items()
+    }
+    cell_groups = {key: {} for key in cell_polygons}
+    for (key, layer), groups_by_length in group_congruent_layers(
+        layers, workers
+    ).items():
+        cell_groups[key][layer] = [
+            (
+                shape_key,
+                group[0],
+                np.asarray(
+                    [get_trans_matrix(*p["transformation"])[:2] for p in group[1:]]
+                ),
+            )
+            for groups in groups_by_length
+            for shape_key, group in groups.items()
+        ]
+    return cell_groups
+
+
+def get_cache_settings(merge_layers=None):
+    """Everything besides the cell content the cached groups depend on."""
+    merged = sorted(merge_layers) if merge_layers else None
+    return repr((GRID_SIZE, sorted(LAYER_INDEX.items()), merged))
+
+
+def get_cached_groups(
+    cells, order, workers=None, cache_dir=None, cache_size=None, merge_layers=None
+):
+    """Return get_cell_groups for cells, reusing the on-disk cache in cache_dir.
+
+    Cells are identified by a content hash of their polygons, the hashes of
+    the referenced cells and the PDK layer table, computed in order (children
+    first). Cells that are not cached are analyzed and stored, afterwards the
+    least recently used entries above cache_size bytes are evicted.
+
+    The hash covers the drawn source polygons and the operands of the derived
+    layers evaluated on the flattened hierarchy (cells[key]["flattened"], see
+    get_flattened_layers), which may lie below the converted levels. Derived
+    layers (see evaluate_layers) and merging of merge_layers (see
+    merge_layer_polygons) are only computed for the cells that are not cached.
+    """
+
+    def prepare(key):
+        layers = evaluate_layers(cell_polygons[key], flattened_source[key])
+        if merge_layers:
+            layers = merge_layer_polygons(layers, merge_layers)
+        return layers
+
+    cell_polygons = {key: get_source_polygons(cells[key]["cell"]) for key in order}
+    flattened_source = {
+        key: get_flattened_source(cells[key]["cell"], cells[key]["flattened"])
+        for key in order
+    }
+    if cache_dir is None:
+        return get_cell_groups({key: prepare(key) for key in order}, workers)
+
+    settings = get_cache_settings(merge_layers)
+    hashes = {}
+    for key in order:
+        references = [
+            (
+                hashes.get(get_cell_key(reference["cell"]), reference["cell"].name),
+                reference["matrices"],
+            )
+            for reference in cells[key]["references"]
+        ]
+        # the flattened operands keyed (layer, datatype, *derived layer)
+        polygons = {
+            **cell_polygons[key],
+            **{
+                (*source_layer, *layer): source_polygons
+                for layer, source in flattened_source[key].items()
+                for source_layer, source_polygons in source.items()
+            },
+        }
+        hashes[key] = hash_cell(polygons, references, settings)
+
+    cell_groups = {}
+    by_hash = {}
+    for key in order:
+        if hashes[key] not in by_hash:
+            by_hash[hashes[key]] = load_templates(cache_dir, hashes[key])
+        cell_groups[key] = by_hash[hashes[key]]
+
+    dirty = {key: prepare(key) for key in order if cell_groups[key] is None}
+    for key, groups in get_cell_groups(dirty, workers).items():
+        if by_hash[hashes[key]] is None:
+            save_templates(cache_dir, hashes[key], groups)
+            by_hash[hashes[key]] = groups
+        cell_groups[key] = by_hash[hashes[key]]
+
+    removed = 0
+    if cache_size is not None:
+        removed = evict(cache_dir, cache_size)
+    print(
+        f"cell cache: {len(order) - len(dirty)} hits, {len(dirty)} converted,"
+        f" {removed} evicted"
+    )
+    return cell_groups
+
+
+def get_cell_cache(
+    top_cells,
+    workers=None,
+    max_depth=None,
+    top_placements=None,
+    cache_dir=None,
+    cache_size=None,
+    merge_layers=None,
+):
+    """Analyze all unique cells below top_cells once.
+
+    Args:
+        top_cells: list of cells to start from.
+        workers: number of processes for the geometry analysis.
+        max_depth: if given, only cells up to this hierarchy depth below the
+          top cells are analyzed (see to_json).
+        top_placements: number of placements of each top cell, default 1.
+        cache_dir: optional directory of the persistent cell cache, see
+          get_cached_groups.
+        cache_size: maximum size of cache_dir in bytes.
+        merge_layers: layers whose polygons are merged per cell before the
+          analysis, see get_merge_layers.
+
+    Returns a dict cell key -> {"cell", "references", "flattened", "groups",
+    "placements"}, where "placements" counts the placements of the cell over
+    all hierarchy paths, "flattened" are the derived layers evaluated on its
+    flattened hierarchy (see get_flattened_layers) and "groups" are the
+    congruent polygon groups (see get_cell_groups).
+    """
+    cell_cache = {}
+    depths = {}
+
+    def expand(cell, depth):
+        # a cell reached again on a shorter path may expose deeper levels
+        key = get_cell_key(cell)
+        if key in depths and depths[key] <= depth:
+            return
+        depths[key] = depth
+        if key not in cell_cache:
+            cell_cache[key] = {"cell": cell, "references": get_references(cell)}
+        if max_depth is None or depth < max_depth:
+            for reference in cell_cache[key]["references"]:
+                expand(reference["cell"], depth + 1)
+
+    def is_expanded(key):
+        return max_depth is None or depths[key] < max_depth
+
+    order = []
+    visited = set()
+
+    def visit(key):
+        if key in visited:
+            return
+        visited.add(key)
+        if is_expanded(key):
+            for reference in cell_cache[key]["references"]:
+                visit(get_cell_key(reference["cell"]))
+        order.append(key)
+
+    for top_cell in top_cells:
+        expand(top_cell, 0)
+    for top_cell in top_cells:
+        visit(get_cell_key(top_cell))
+
+    # reversed post-order: every cell comes before the cells it references
+    for key in cell_cache:
+        cell_cache[key]["placements"] = 0
+    for top_cell, count in zip(top_cells, top_placements or [1] * len(top_cells)):
+        cell_cache[get_cell_key(top_cell)]["placements"] += count
+    for key in reversed(order):
+        if not is_expanded(key):
+            continue
+        for reference in cell_cache[key]["references"]:
+            child = cell_cache[get_cell_key(reference["cell"])]
+            child["placements"] += cell_cache[key]["placements"] * len(
+                reference["matrices"]
+            )
+
+    memo = {}
+    for key in order:
+        cell_cache[key]["flattened"] = get_flattened_layers(
+            cell_cache[key]["cell"], cell_cache, memo
+        )
+
+    cell_groups = get_cached_groups(
+        cell_cache, order, workers, cache_dir, cache_size, merge_layers
+    )
+    for key, groups in cell_groups.items():
+        cell_cache[key]["groups"] = groups
+
+    return cell_cache
+
+
+# approximate json overhead of one poly_shape part and of one instance
+PART_BYTES = 256
+INSTANCE_BYTES = 64
+
+
+def use_template(points, members, placements, pooled=False):
+    """Whether instancing congruent polygons shrinks the output.
+
+    A template costs one instance (nothing if it is already in the template
+    pool), one part and one composed matrix per member and placement. Emitting
+    the members as they are costs one instance per member.
+    """
+    instance = 8 * points + INSTANCE_BYTES  # float32 x, y
+    template = 24 * placements * members + PART_BYTES
+    if not pooled:
+        template += instance
+    return template < instance * members
+
+
+def invert_matrices(matrices):
+    """Inverse of a stack of (N, 2, 3) affine transforms."""
+    linear = np.linalg.inv(matrices[:, :, :2])
+    translation = -linear @ matrices[:, :, 2:]
+    return np.concatenate([linear, translation], axis=2)
+
+
+def get_cell_instances(
+    cell, poly_assembly, instance_index, cell_cache, pool=None, output=DEFAULT_OUTPUT
+):
+    """Emit the layer polygons of a cell once and return its layer templates.
+
+    cell_cache[key]["groups"] holds the congruent polygon groups of the cell
+    (see get_cell_cache). Groups where instancing pays off (see use_template)
+    become a template plus local (G, 2, 3) matrices, the remaining polygons
+    are emitted as they are and share one template with matrices None.
+
+    pool is the library wide template pool: canonical shape key -> (instance
+    index, matrix mapping the instance onto the canonical shape). Shapes found
+    in the pool are referenced instead of emitted again, whatever cell or layer
+    they come from.
+
+    Every placement of the cell reuses the templates stored in cell_cache,
+    output is the buffer encoding of the export (see get_output_options).
+    """
+    cached = cell_cache[get_cell_key(cell)]
+    if cached.get("layers") is not None:
+        return instance_index, cached["layers"]
+    if pool is None:
+        pool = {}
+
+    layers = {}
+    instances = []
+    for layer, groups in cached["groups"].items():
+        polygons = {"refs": [], "matrices": None}
+        templates = [polygons]
+        for key, reference, matrices in groups:
+            pooled = key in pool
+            if use_template(
+                len(reference), len(matrices), cached["placements"], pooled
+            ):
+                if not pooled:
+                    points, anchor = anchor_template(reference, output.db_unit)
+                    instances.append(points)
+                    pool[key] = (instance_index, anchor)
+                    instance_index += 1
+                ref, inverse = pool[key]
+                templates.append(
+                    {"refs": [ref], "matrices": compose_matrices(matrices, inverse)}
+                )
+                continue
+
+            if not pooled:
+                pool[key] = (instance_index, invert_matrices(matrices[:1]))
+            for matrix in matrices:
+                instances.append(reference @ matrix[:, :2].T + matrix[:, 2])
+                polygons["refs"].append(instance_index)
+                instance_index += 1
+
+        layers[layer] = templates if polygons["refs"] else templates[1:]
+
+    add_instances(poly_assembly, instances, output)
+    cached["layers"] = layers
+    return instance_index, layers
+
+
+def get_poly_shape(name, shape_id, layer, refs, matrices):
+    """Poly shape part of refs on layer, without "matrices" if matrices is None."""
+    if matrices is None:
+        matrices_entry = {}
+    else:
+        matrices_entry = {"matrices": [len(matrices)] if DEBUG else matrices}
+    return {
+        "version": 3,
+        "name": name,
+        "id": shape_id,
+        "loc": [(0, 0, get_layer_zmin(layer)), (0, 0, 0, 1)],
+        "color": get_layer_color(layer),
+        "shape": {
+            "refs": refs,
+            **matrices_entry,
+            "height": get_layer_thickness(layer),
+        },
+        "renderback": False,
+        "state": [1, 1],
+        "type": "polygon",
+        "subtype": "solid",
+    }
+
+
+def get_layer_shapes(cell_id, layers, matrices, buffer=None, output=DEFAULT_OUTPUT):
+    """Return the shapes of all layer templates of a cell placed at matrices.
+
+    The untransformed polygons of a layer are one poly_shape using the float32
+    buffer of the placements (built once per cell unless given). Each
+    congruent group gets its own poly_shape with the placements composed with
+    the local matrices. Layers with groups become a part with the shapes as
+    children.
+    """
+    if buffer is None:
+        buffer = to_matrix_buffer(matrices, output)
+    shapes = []
+    for layer, templates in layers.items():
+        layer_name = get_layer_name(layer)
+        layer_id = f"{cell_id}/L:{layer_name}"
+
+        if len(templates) == 1 and templates[0]["matrices"] is None:
+            refs = templates[0]["refs"]
+            shapes.append(
+                get_poly_shape(f"L:{layer_name}", layer_id, layer, refs, buffer)
+            )
+            continue
+
+        layer_parts = {
+            "version": 3,
+            "name": f"L:{layer_name}",
+            "id": layer_id,
+            "loc": [(0, 0, 0), (0, 0, 0, 1)],
+            "parts": [],
+        }
+        index = 0
+        for template in templates:
+            if template["matrices"] is None:
+                name, template_matrices = "polygons", buffer
+            else:
+                name = f"group_{index}"
+                template_matrices = to_matrix_buffer(
+                    compose_matrices(matrices, template["matrices"]), output
+                )
+                index += 1
+            layer_parts["parts"].append(
+                get_poly_shape(
+                    name,
+                    f"{layer_id}/{name}",
+                    layer,
+                    template["refs"],
+                    template_matrices,
+                )
+            )
+        shapes.append(layer_parts)
+    return shapes
+
+
+def get_visible_layers(layers, hidden):
+    """The layer templates of a cell without the hidden layers."""
+    if not hidden:
+        return layers
+    return {
+        layer: templates for layer, templates in layers.items() if layer not in hidden
+    }
+
+
+def get_cell_outlines(cell, cell_cache, memo=None):
+    """Merged outlines per layer of the whole hierarchy of cell.
+
+    Built bottom-up from the own polygons and the placed outlines of the
+    referenced cells, so every cell is merged once: in cell_cache, or in memo
+    (cell key -> outlines) for cells that are not in cell_cache. Returns
+    {"layers": {layer: outlines}, "min_feature", "detail" (vertex count of the
+    full detail)}, None for cells without rendered polygons.
+    """
+    if memo is None:
+        memo = {}
+    key = get_cell_key(cell)
+    cached = cell_cache.get(key, {})
+    if "outlines" in cached:
+        return cached["outlines"]
+    if key in memo:
+        return memo[key]
+
+    flattened = cached.get("flattened", frozenset())
+    layers = get_polygons(cell, as_points=True, flattened=flattened)
+    polygons = {layer: list(p) for layer, p in layers.items()}
+    min_feature = min((get_min_feature(p) for p in layers.values()), default=None)
+    detail = sum(len(p) for layer_polygons in layers.values() for p in layer_polygons)
+
+    references = cached.get("references")
+    if references is None:
+        references = get_references(cell)
+    for reference in references:
+        child = get_cell_outlines(reference["cell"], cell_cache, memo)
+        if child is None:
+            continue
+        matrices = reference["matrices"]
+        for layer, outlines in child["layers"].items():
+            if layer in flattened:
+                continue
+            polygons.setdefault(layer, []).extend(
+                points
+                for outline in outlines
+                for points in outline @ matrices[:, :, :2].transpose(0, 2, 1)
+                + matrices[:, None, :, 2]
+            )
+        detail += child["detail"] * len(matrices)
+        if min_feature is None or child["min_feature"] < min_feature:
+            min_feature = child["min_feature"]
+
+    bbox = cell.bounding_box()
+    result = None
+    if polygons and bbox is not None:
+        (x0, y0), (x1, y1) = bbox
+        tolerance = max(x1 - x0, y1 - y0) / LOD_OUTLINE_RESOLUTION
+        result = {
+            "layers": {
+                layer: get_outlines(layer_polygons, tolerance)
+                for layer, layer_polygons in polygons.items()
+            },
+            "min_feature": min_feature,
+            "detail": detail,
+        }
+
+    if cached:
+        cached["outlines"] = result
+    memo[key] = result
+    return result
+
+
+def get_cell_lod(
+    cell, poly_assembly, instance_index, cell_cache, output=DEFAULT_OUTPUT
+):
+    """Emit the coarse levels of detail of a cell once.
+
+    Level 0 is the bounding box spanning all layers of the cell, level 1 the
+    merged and simplified outlines per layer (see get_cell_outlines). The
+    outline level is dropped if it does not reduce the vertex count 4 times.
+    Returns the cached {"bbox", "z", "outlines", "thresholds"}, None for cells
+    without rendered polygons.
+    """
+    cached = cell_cache[get_cell_key(cell)]
+    if "lod" in cached:
+        return instance_index, cached["lod"]
+
+    outlines = get_cell_outlines(cell, cell_cache)
+    if outlines is None:
+        cached["lod"] = None
+        return instance_index, None
+
+    (x0, y0), (x1, y1) = cell.bounding_box()
+    layers = outlines["layers"]
+    lod = {
+        "bbox": instance_index,
+        "z": (
+            min(get_layer_zmin(layer) for layer in layers),
+            max(get_layer_zmin(layer) + get_layer_thickness(layer) for layer in layers),
+        ),
+        "outlines": {},
+        "thresholds": get_thresholds(max(x1 - x0, y1 - y0), outlines["min_feature"]),
+    }
+    instances = [np.array([(x0, y0), (x1, y0), (x1, y1), (x0, y1)])]
+    instance_index += 1
+
+    # only worth it if the outlines are much coarser than the full detail
+    if sum(len(p) for o in layers.values() for p in o) * 4 <= outlines["detail"]:
+        for layer, layer_outlines in layers.items():
+            refs = []
+            for outline in layer_outlines:
+                instances.append(outline)
+                refs.append(instance_index)
+                instance_index += 1
+            if refs:
+                lod["outlines"][layer] = refs
+    else:
+        lod["thresholds"] = lod["thresholds"][:1]
+
+    add_instances(poly_assembly, instances, output)
+    cached["lod"] = lod
+    return instance_index, lod
+
+
+def get_lod_parts(cell_id, lod, buffer):
+    """Return the "lod" entry of a cell part placed with the matrix buffer.
+
+    The viewer replaces the part by levels[i] when the cell is smaller than
+    thresholds[i] pixels on screen. The placements are stored once as the
+    entry's "matrices", the shapes of the levels have no matrices of their own
+    and are drawn at these.
+    """
+    zmin, zmax = lod["z"]
+    bbox_part = {
+        "version": 3,
+        "name": "LOD:bbox",
+        "id": f"{cell_id}/LOD:bbox",
+        "loc": [(0, 0, zmin), (0, 0, 0, 1)],
+        "color": "#808080",
+        "shape": {"refs": [lod["bbox"]], "height": zmax - zmin},
+        "renderback": False,
+        "state": [1, 1],
+        "type": "polygon",
+        "subtype": "solid",
+    }
+    outline_part = {
+        "version": 3,
+        "name": "LOD:outline",
+        "id": f"{cell_id}/LOD:outline",
+        "loc": [(0, 0, 0), (0, 0, 0, 1)],
+        "parts": [
+            get_poly_shape(
+                f"L:{get_layer_name(layer)}",
+                f"{cell_id}/LOD:outline/L:{get_layer_name(layer)}",
+                layer,
+                refs,
+                None,
+            )
+            for layer, refs in lod["outlines"].items()
+        ],
+    }
+    levels = [bbox_part, outline_part] if lod["outlines"] else [bbox_part]
+    return {"thresholds": lod["thresholds"], "matrices": buffer, "levels": levels}
+
+
 def handle_references(
     parent_cell_name,
     parent_cell,
@@ -202,31 +1393,54 @@ def handle_references(
     poly_assembly,
     instance_index,
     parent_matrices=None,
+    cell_cache=None,
+    placements=None,
+    writer=None,
+    pool=None,
+    max_depth=None,
+    depth=0,
+    lod=False,
+    output=DEFAULT_OUTPUT,
+    hidden=frozenset(),
 ):
+    """Convert the references of parent_cell recursively.
+
+    Args:
+        cell_cache: dict of cell key -> analyzed cell (see get_cell_instances),
+          so that the polygons of each unique cell are emitted only once into
+          poly_assembly["instances"].
+        placements: if given, the per-path part hierarchy is collapsed: the
+          matrices and part ids of every path are collected per unique cell
+          in this dict and no parts are returned.
+        writer: optional JsonStreamWriter, finished parts are serialized right
+          away and replaced by fragments.
+        pool: library wide template pool, see get_cell_instances.
+        max_depth: references deeper than max_depth levels below the top cell
+          become placeholders (see get_placeholder), depth is the level of
+          parent_cell.
+        lod: if True, cell parts get coarse levels of detail, see get_lod_parts.
+        output: buffer encoding of the export, see get_output_options.
+        hidden: derived layers an ancestor of parent_cell evaluates on its
+          flattened hierarchy (see get_flattened_layers), they are not emitted
+          again below it.
+    """
     parts = []
+    if cell_cache is None:
+        cell_cache = get_cell_cache([parent_cell], max_depth=max_depth)
 
-    references = get_references(parent_cell)
+    parent = cell_cache[get_cell_key(parent_cell)]
+    references = parent["references"]
+    hidden = hidden | parent["flattened"]
     for reference in references:
         cell = reference["cell"]
 
-        if parent_matrices is None:
-            matrices = [
-                get_trans_matrix(*transform) for transform in reference["transforms"]
-            ]
-        else:
-            matrices = [
-                matrix @ get_trans_matrix(*transform)
-                for transform in reference["transforms"]
-                for matrix in parent_matrices
-            ]
+        matrices = reference["matrices"]
+        if parent_matrices is not None:
+            matrices = compose_matrices(parent_matrices, matrices)
 
-        cell_parts = {
-            "version": 3,
-            "name": f"C:{cell.name}",
-            "id": f"{path}/C:{cell.name}",
-            "loc": [(0, 0, 0), (0, 0, 0, 1)],
-            "parts": [],
-        }
+        if max_depth is not None and depth >= max_depth:
+            parts.append(get_placeholder(f"{path}/C:{cell.name}", cell, matrices))
+            continue
 
         instance_index, ref_parts = handle_references(
             cell.name,
@@ -235,181 +1449,805 @@ def handle_references(
             poly_assembly,
             instance_index,
             matrices,
+            cell_cache,
+            placements,
+            writer,
+            pool,
+            max_depth,
+            depth + 1,
+            lod,
+            output,
+            hidden,
         )
 
-        cell_parts["parts"] = ref_parts
-
-        polygons = get_polygons(cell)
+        instance_index, layers = get_cell_instances(
+            cell, poly_assembly, instance_index, cell_cache, pool, output
+        )
 
-        for layer, layer_polygons in polygons.items():
-            try:
-                layer_name = get_layer_name(layer)
-            except:
-                continue
+        if placements is not None:
+            key = get_cell_key(cell)
+            if key not in placements:
+                placements[key] = {
+                    "cell": cell,
+                    "matrices": [],
+                    "paths": [],
+                    "hidden": [],
+                }
+            placements[key]["matrices"].append(matrices)
+            placements[key]["paths"].append(f"{path}/C:{cell.name}")
+            placements[key]["hidden"].append(hidden)
+            continue
 
-            refs = []
-            for polygon in layer_polygons:
-                poly_assembly["instances"].append(polygon.points.astype("float32"))
-                refs.append(instance_index)
-                instance_index += 1
+        layers = get_visible_layers(layers, hidden)
 
-            poly_shape = {
-                "version": 3,
-                "name": f"L:{layer_name}",
-                "id": f"{path}/C:{cell.name}/L:{layer_name}",
-                "loc": [(0, 0, get_layer_zmin(layer)), (0, 0, 0, 1)],
-                "color": get_layer_color(layer),
-                "shape": {
-                    "refs": refs,
-                    "matrices": (
-                        [len(matrices)]
-                        if DEBUG
-                        else np.asarray(
-                            [matrix[:2].reshape(-1) for matrix in matrices],
-                            dtype="float32",
-                        )
-                    ),
-                    "height": get_layer_thickness(layer),
-                },
-                "renderback": False,
-                "state": [1, 1],
-                "type": "polygon",
-                "subtype": "solid",
-            }
-            cell_parts["parts"].append(poly_shape)
+        # shared by the layer shapes and the lod, the binary output stores it once
+        buffer = to_matrix_buffer(matrices, output)
+        cell_parts = {
+            "version": 3,
+            "name": f"C:{cell.name}",
+            "id": f"{path}/C:{cell.name}",
+            "loc": [(0, 0, 0), (0, 0, 0, 1)],
+            "parts": ref_parts
+            + get_layer_shapes(
+                f"{path}/C:{cell.name}", layers, matrices, buffer, output
+            ),
+        }
 
         cell_parts["parts"] = sorted(
             cell_parts["parts"], key=lambda shape: shape["loc"][0][2]  # sort be zmin
         )
 
+        if lod:
+            instance_index, cell_lod = get_cell_lod(
+                cell, poly_assembly, instance_index, cell_cache, output
+            )
+            if cell_lod is not None:
+                # keep "parts" as last key for JsonStreamWriter.fragment
+                cell_parts["lod"] = get_lod_parts(cell_parts["id"], cell_lod, buffer)
+                cell_parts["parts"] = cell_parts.pop("parts")
+
+        if writer is not None:
+            cell_parts = writer.fragment(cell_parts)
+
         parts.append(cell_parts)
 
     return instance_index, parts
 
 
-def to_json(lib, return_json=True):
-    """Return optimzed json.
-
-    Args:
-        lib: to extrude in 3D.
-        exclude_layers: list of layer index to exclude.
+def get_placeholder(cell_id, cell, matrices):
+    """Part standing in for a cell that is not converted yet.
 
+    It carries the cell name and the bounding box of all its placements, the
+    cell can be converted on request with convert_cell_path(lib, cell_id).
     """
-    start = time.time()
-    poly_assembly = {
-        "format": "GDS",
+    bbox = cell.bounding_box()
+    if bbox is not None:
+        (x0, y0), (x1, y1) = bbox
+        corners = np.array([(x0, y0, 1), (x0, y1, 1), (x1, y0, 1), (x1, y1, 1)])
+        points = (matrices @ corners.T).transpose(0, 2, 1).reshape(-1, 2)
+        bbox = [*points.min(axis=0).tolist(), *points.max(axis=0).tolist()]
+
+    return {
         "version": 3,
-        "name": lib.name,
-        "id": f"/{lib.name}",
+        "name": f"C:{cell.name}",
+        "id": cell_id,
         "loc": [(0, 0, 0), (0, 0, 0, 1)],
-        "instances": [],
+        "lazy": {"cell": cell.name, "bbox": bbox, "count": len(matrices)},
         "parts": [],
     }
-    instance_index = 0
-    top_level_cells = {c.name: c for c in lib.top_level()}
 
-    for top_name, top_cell in top_level_cells.items():
 
-        #
-        # Handle top level references
-        #
+def get_collapsed_parts(
+    path, placements, cell_cache, writer=None, output=DEFAULT_OUTPUT
+):
+    """Return one part per unique cell holding the matrices of all its paths.
 
-        top_parts = {
+    A layer hidden on some paths (see handle_references) only gets the
+    matrices of the others.
+    """
+    parts = []
+    for key, placement in placements.items():
+        cell = placement["cell"]
+        shown_layers = defaultdict(dict)
+        for layer, templates in cell_cache[key]["layers"].items():
+            shown = tuple(layer not in hidden for hidden in placement["hidden"])
+            if any(shown):
+                shown_layers[shown][layer] = templates
+        shapes = []
+        for shown, layers in shown_layers.items():
+            shapes += get_layer_shapes(
+                f"{path}/C:{cell.name}",
+                layers,
+                np.concatenate([m for m, s in zip(placement["matrices"], shown) if s]),
+                output=output,
+            )
+        cell_parts = {
             "version": 3,
-            "name": f"C:{top_name}",
-            "id": f"/{lib.name}/C:{top_name}",
+            "name": f"C:{cell.name}",
+            "id": f"{path}/C:{cell.name}",
             "loc": [(0, 0, 0), (0, 0, 0, 1)],
-            "parts": [],
+            "parts": sorted(
+                shapes, key=lambda shape: shape["loc"][0][2]  # sort be zmin
+            ),
         }
+        if len(cell_parts["parts"]) > 0:
+            parts.append(cell_parts if writer is None else writer.fragment(cell_parts))
+    return parts
 
-        instance_index, ref_parts = handle_references(
-            top_name,
+
+def get_unique_matrices(matrices):
+    """Mask of the first occurrences of (N, 2, 3) transforms.
+
+    Translations are compared on GRID_SIZE, the linear parts to 1e-6.
+    """
+    keys = np.concatenate(
+        [
+            np.rint(matrices[:, :, :2].reshape(-1, 4) * 1e6),
+            np.rint(matrices[:, :, 2] / GRID_SIZE),
+        ],
+        axis=1,
+    ).astype(np.int64)
+    _, first = np.unique(keys, axis=0, return_index=True)
+    mask = np.zeros(len(matrices), dtype=bool)
+    mask[first] = True
+    return mask
+
+
+def dedup_batch(matrices, ranges):
+    """Drop repeated transforms of a batch and remap its ranges.
+
+    Returns the unique matrices and ranges, empty ranges are removed.
+    """
+    mask = get_unique_matrices(matrices)
+    kept = np.concatenate([[0], np.cumsum(mask)])
+    result = []
+    for path_index, start, count in ranges:
+        new_count = int(kept[start + count] - kept[start])
+        if new_count > 0:
+            result.append([path_index, int(kept[start]), new_count])
+    return matrices[mask], result
+
+
+def get_batched_parts(path, placements, cell_cache, dedup=False, output=DEFAULT_OUTPUT):
+    """Regroup the placements of all cells into one batch per layer and template.
+
+    A template shared by several cells becomes a single poly_shape with the
+    composed matrices of all its placements, the untransformed polygons of a
+    cell one poly_shape per layer. The matrices of a batch are in traversal
+    order, cell by cell and within a cell path by path, so the matrices of
+    one path are contiguous. "ranges" (R, 3) uint32 rows (path index, first
+    matrix, matrix count) map them back to the ids of the returned paths,
+    the first matrices are increasing, the path indices are not sorted.
+
+    With dedup, placements stacking the same template on the same layer at
+    the same transform (e.g. contacts shared by abutted cells) are emitted
+    once, the first path keeps them. Layers hidden on a path (see
+    handle_references) get no matrices of it.
+
+    Returns the list of paths and the layer parts holding the batches,
+    sorted by zmin.
+    """
+    paths = {}
+    batches = {}
+    shape_count = 0
+    for key, placement in placements.items():
+        cell = placement["cell"]
+        for layer, templates in cell_cache[key]["layers"].items():
+            for template in templates:
+                if template["matrices"] is None:
+                    batch_key, name = (layer, key), f"P:{cell.name}"
+                else:
+                    batch_key, name = (
+                        layer,
+                        template["refs"][0],
+                    ), f"T:{template['refs'][0]}"
+                for cell_path, matrices, hidden in zip(
+                    placement["paths"], placement["matrices"], placement["hidden"]
+                ):
+                    # evaluated on the flattened hierarchy of an ancestor
+                    if layer in hidden:
+                        continue
+                    if batch_key not in batches:
+                        batches[batch_key] = {
+                            "layer": layer,
+                            "name": name,
+                            "refs": template["refs"],
+                            "matrices": [],
+                            "ranges": [],
+                            "count": 0,
+                        }
+                    batch = batches[batch_key]
+                    if template["matrices"] is not None:
+                        matrices = compose_matrices(matrices, template["matrices"])
+                    path_index = paths.setdefault(cell_path, len(paths))
+                    ranges = batch["ranges"]
+                    if ranges and ranges[-1][0] == path_index:
+                        ranges[-1][2] += len(matrices)
+                    else:
+                        ranges.append([path_index, batch["count"], len(matrices)])
+                    batch["matrices"].append(matrices)
+                    batch["count"] += len(matrices)
+                    shape_count += 1
+
+    layer_parts = {}
+    removed = removed_polygons = 0
+    for batch in batches.values():
+        matrices = np.concatenate(batch["matrices"])
+        if dedup:
+            count = len(matrices)
+            matrices, batch["ranges"] = dedup_batch(matrices, batch["ranges"])
+            removed += count - len(matrices)
+            removed_polygons += (count - len(matrices)) * len(batch["refs"])
+
+        layer = batch["layer"]
+        if layer not in layer_parts:
+            layer_parts[layer] = {
+                "version": 3,
+                "name": f"L:{get_layer_name(layer)}",
+                "id": f"{path}/L:{get_layer_name(layer)}",
+                "loc": [(0, 0, 0), (0, 0, 0, 1)],
+                "parts": [],
+            }
+        layer_part = layer_parts[layer]
+        shape = get_poly_shape(
+            batch["name"],
+            f"{layer_part['id']}/{batch['name']}",
+            layer,
+            batch["refs"],
+            to_matrix_buffer(matrices, output),
+        )
+        shape["ranges"] = np.asarray(batch["ranges"], dtype="uint32")
+        layer_part["parts"].append(shape)
+
+    print(f"batched {shape_count} cell layer shapes into {len(batches)} batches")
+    if dedup:
+        total = sum(batch["count"] for batch in batches.values())
+        print(
+            f"dedup: removed {removed} of {total} placements"
+            f" ({removed_polygons} polygons) stacked at identical transforms"
+        )
+    parts = [layer_parts[layer] for layer in sorted(layer_parts, key=get_layer_zmin)]
+    return list(paths), parts
+
+
+def to_json(
+    lib,
+    return_json=True,
+    collapse=False,
+    fd=None,
+    prefix="",
+    suffix="",
+    workers=None,
+    max_depth=None,
+    cache_dir=None,
+    cache_size=None,
+    lod=False,
+    merge=False,
+    merge_cuts=False,
+    encoding="float",
+    mesh=False,
+    compress=False,
+    compact_transforms=False,
+    batch=False,
+    dedup=False,
+):
+    """Return optimzed json.
+
+    Args:
+        lib: to extrude in 3D.
+        collapse: if True, emit one part per unique cell with the placements of
+          all its hierarchy paths instead of the per-path part hierarchy.
+        fd: if given, a file opened in binary mode the json (wrapped in prefix
+          and suffix) is streamed to while the hierarchy is converted. Nothing
+          is returned in this case.
+        workers: number of processes for the geometry analysis, None = sequential.
+        max_depth: if given, only the top max_depth hierarchy levels below the
+          top cells are converted, deeper cells are emitted as placeholders
+          that can be converted on request with convert_cell_path.
+        cache_dir: directory of the persistent cell cache, only cells whose
+          content changed since they were cached are analyzed again.
+        cache_size: maximum cache size in bytes, least recently used cells
+          are evicted.
+        lod: if True, every referenced cell part gets a "lod" entry with a
+          bounding box and a merged outline proxy and the on-screen size
+          thresholds to use them (see get_lod_parts). Not used with collapse,
+          cannot be combined with max_depth (the proxies cover the whole
+          hierarchy).
+        merge: if True, the overlapping and abutting polygons of each cell
+          and layer are merged before instancing, except for via and contact
+          layers unless merge_cuts is True.
+        encoding: "float" for float32 points and matrices, "int" for points
+          relative to the template centroid as int16 (if they fit) or int32
+          and translations as int32, all in database units. The size of a
+          database unit is stored in the assembly's "units".
+        mesh: if True, every instance is emitted as its triangulated and
+          extruded unit height prism {"vertices", "triangles"} (see
+          mesh.get_meshes), the viewer scales it by the shape height and never
+          triangulates.
+        compress: if True, every JSON buffer uses the smallest of the
+          serialize codecs (delta, zigzag, byte shuffle, deflate/zstd), only
+          for the JSON output (fd or return_json=True).
+        compact_transforms: if True, matrices are stored as uint8 orientation
+          codes plus translations, see to_matrix_buffer.
+        batch: if True, the placements of all hierarchy paths are regrouped
+          into one instanced batch per layer and template, with ranges mapping
+          them back to the part ids (see get_batched_parts). Not used with lod.
+        dedup: with batch, drop placements duplicating the same template on
+          the same layer at the same transform.
+
+    """
+    if collapse and max_depth is not None:
+        raise ValueError("collapse and max_depth cannot be combined")
+    if lod and max_depth is not None:
+        raise ValueError("lod and max_depth cannot be combined")
+    if batch and (collapse or max_depth is not None):
+        raise ValueError("batch cannot be combined with collapse or max_depth")
+    if dedup and not batch:
+        raise ValueError("dedup needs batch")
+    if compress and fd is None and not return_json:
+        raise ValueError("compress only applies to the JSON output")
+
+    start = time.time()
+    output = get_output_options(lib, encoding, mesh, compact_transforms)
+    poly_assembly = get_assembly(lib, output)
+    codecs = get_codecs() if compress else None
+    writer = None
+    if fd is not None:
+        writer = JsonStreamWriter(fd, poly_assembly, prefix, suffix, codecs)
+        poly_assembly["instances"] = writer
+
+    instance_index = 0
+    top_level_cells = {c.name: c for c in lib.top_level()}
+
+    #
+    # Analyze all unique cells for congruent polygons
+    #
+    cell_cache = get_cell_cache(
+        list(top_level_cells.values()),
+        workers,
+        max_depth=max_depth,
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+        merge_layers=get_merge_layers(merge_cuts) if merge else None,
+    )
+    pool = {}
+    print("duration with geo analyzer:", time.time() - start)
+
+    for top_name, top_cell in top_level_cells.items():
+        start = time.time()
+
+        instance_index, top_parts = get_top_parts(
             top_cell,
             f"/{lib.name}/C:{top_name}",
+            None,
             poly_assembly,
             instance_index,
+            cell_cache,
+            collapse=collapse,
+            writer=writer,
+            pool=pool,
+            max_depth=max_depth,
+            lod=lod,
+            batch=batch,
+            dedup=dedup,
+            output=output,
         )
 
-        top_parts["parts"] = ref_parts
+        if len(top_parts["parts"]) > 0:
+            poly_assembly["parts"].append(
+                top_parts if writer is None else writer.fragment(top_parts)
+            )
 
+        if DEBUG and writer is None:
+            poly_assembly["instances"] = []
         print("duration for references:", time.time() - start)
 
-        #
-        # Handle top level elements
-        #
-        start = time.time()
-        polygons = get_layer_polygons(top_cell)
-        for layer, layer_polygons in polygons.items():
-            layer_name = get_layer_name(layer)
-            layer_parts = {
-                "version": 3,
-                "name": f"L:{layer_name}",
-                "id": f"/{lib.name}/C:{top_name}/L:{layer_name}",
-                "loc": [(0, 0, 0), (0, 0, 0, 1)],
-                "parts": [],
-            }
-            index = 0
-            groups_by_length = group_by_length(layer_polygons).values()
-            for groups in groups_by_length:
-                congruent_polygons = group_congruent_polygons(groups)
-
-                for group in congruent_polygons.values():
-                    poly_assembly["instances"].append(group[0])
-                    matrices = np.asarray(
-                        [
-                            get_trans_matrix(*p["transformation"])[:2].reshape(-1)
-                            for p in group[1:]
-                        ],
-                        dtype="float32",
-                    )
-                    poly_shape = {
-                        "version": 3,
-                        "name": f"group_{index}",
-                        "id": f"/{lib.name}/C:{top_name}/L:{layer_name}/group_{index}",
-                        "loc": [(0, 0, get_layer_zmin(layer)), (0, 0, 0, 1)],
-                        "color": get_layer_color(layer),
-                        "shape": {
-                            "refs": [instance_index],
-                            "matrices": ([len(matrices)] if DEBUG else matrices),
-                            "height": get_layer_thickness(layer),
-                        },
-                        "renderback": False,
-                        "state": [1, 1],
-                        "type": "polygon",
-                        "subtype": "solid",
-                    }
-                    index += 1
-
-                    layer_parts["parts"].append(poly_shape)
-                    instance_index += 1
+    print_pool_stats(pool, instance_index, cell_cache)
 
-            layer_parts["parts"] = sorted(
-                layer_parts["parts"], key=lambda shape: shape["loc"][0][2]
-            )  # sort be zmin
+    if writer is not None:
+        writer.close(poly_assembly["parts"])
+    elif return_json:
+        return orjson.dumps(numpy_to_buffer_json(poly_assembly, codecs)).decode("utf-8")
+    else:
+        return poly_assembly
 
-            top_parts["parts"].append(layer_parts)
 
-        if len(top_parts["parts"]) > 0:
-            poly_assembly["parts"].append(top_parts)
+def get_output_options(lib, encoding="float", mesh=False, compact_transforms=False):
+    """Return the OutputOptions of an export of lib, see to_json."""
+    if encoding not in ("float", "int"):
+        raise ValueError(f"unknown encoding {encoding!r}")
+    return OutputOptions(
+        db_unit=lib.precision / lib.unit if encoding == "int" else None,
+        mesh=mesh,
+        compact_transforms=compact_transforms,
+    )
 
-        if DEBUG:
-            poly_assembly["instances"] = []
-        print("duration with geo analyzer:", time.time() - start)
+
+def get_assembly(lib, output=DEFAULT_OUTPUT):
+    """Return the empty assembly of lib with the units of output."""
+    poly_assembly = {
+        "format": "GDS",
+        "version": 3,
+        "name": lib.name,
+        "id": f"/{lib.name}",
+        "loc": [(0, 0, 0), (0, 0, 0, 1)],
+    }
+    if output.db_unit is not None:
+        poly_assembly["units"] = {"db_unit": output.db_unit, "encoding": "int"}
+    if output.mesh:
+        poly_assembly["mesh"] = True
+    poly_assembly["instances"] = []
+    poly_assembly["parts"] = []
+    return poly_assembly
+
+
+def get_top_parts(
+    cell,
+    path,
+    matrices,
+    poly_assembly,
+    instance_index,
+    cell_cache,
+    collapse=False,
+    writer=None,
+    pool=None,
+    max_depth=None,
+    lod=False,
+    batch=False,
+    dedup=False,
+    output=DEFAULT_OUTPUT,
+    hidden=frozenset(),
+):
+    """Convert cell placed with matrices (None = untransformed) with its references.
+
+    With batch, the parts are the layer batches of get_batched_parts and
+    top_parts["paths"] holds the part ids their ranges refer to. hidden are
+    the derived layers the ancestors of cell evaluate on their flattened
+    hierarchy, see handle_references.
+    """
+    top_parts = {
+        "version": 3,
+        "name": f"C:{cell.name}",
+        "id": path,
+        "loc": [(0, 0, 0), (0, 0, 0, 1)],
+        "parts": [],
+    }
+
+    #
+    # Handle references
+    #
+    placements = {} if collapse or batch else None
+    instance_index, ref_parts = handle_references(
+        cell.name,
+        cell,
+        path,
+        poly_assembly,
+        instance_index,
+        parent_matrices=matrices,
+        cell_cache=cell_cache,
+        placements=placements,
+        writer=writer,
+        pool=pool,
+        max_depth=max_depth,
+        lod=lod,
+        output=output,
+        hidden=hidden,
+    )
+
+    if collapse:
+        ref_parts = get_collapsed_parts(path, placements, cell_cache, writer, output)
+
+    top_parts["parts"] = ref_parts
+
+    #
+    # Handle own elements
+    #
+    instance_index, layers = get_cell_instances(
+        cell, poly_assembly, instance_index, cell_cache, pool, output
+    )
+    if matrices is None:
+        matrices = np.eye(2, 3)[None]
+    if batch:
+        placements[get_cell_key(cell)] = {
+            "cell": cell,
+            "matrices": [matrices],
+            "paths": [path],
+            "hidden": [hidden],
+        }
+        top_parts["paths"], parts = get_batched_parts(
+            path, placements, cell_cache, dedup, output
+        )
+        # keep "parts" as last key for JsonStreamWriter.fragment
+        del top_parts["parts"]
+        top_parts["parts"] = parts
+    else:
+        top_parts["parts"].extend(
+            get_layer_shapes(
+                path, get_visible_layers(layers, hidden), matrices, output=output
+            )
+        )
+
+    return instance_index, top_parts
+
+
+def print_pool_stats(pool, instance_index, cell_cache):
+    polygon_count = sum(
+        len(matrices)
+        for cached in cell_cache.values()
+        for groups in cached["groups"].values()
+        for _, _, matrices in groups
+    )
+    print(
+        f"template pool: {len(pool)} unique shapes, {instance_index} instances"
+        f" for {polygon_count} cell polygons,"
+        f" dedup ratio {polygon_count / max(instance_index, 1):.2f}"
+    )
+
+
+def convert_cell_path(
+    lib,
+    path,
+    return_json=True,
+    workers=None,
+    max_depth=None,
+    cache_dir=None,
+    cache_size=None,
+    lod=False,
+    merge=False,
+    merge_cuts=False,
+    encoding="float",
+    mesh=False,
+    compress=False,
+    compact_transforms=False,
+):
+    """Convert a single cell of lib on request.
+
+    Args:
+        lib: library the cell is read from.
+        path: hierarchy path of the cell, i.e. the id of a part or placeholder
+          emitted by to_json, e.g. "/LIB/C:top/C:child".
+        max_depth: as in to_json, counted from the requested cell.
+        cache_dir, cache_size: persistent cell cache, see to_json.
+        lod, merge, merge_cuts, encoding, mesh, compress, compact_transforms:
+          see to_json.
+
+    The result has the same format as to_json with one part for the cell in
+    world coordinates, all placements along the path are combined.
+    """
+    if lod and max_depth is not None:
+        raise ValueError("lod and max_depth cannot be combined")
+    lib_name, *names = path.strip("/").split("/")
+    if lib_name != lib.name or not names or not all(n.startswith("C:") for n in names):
+        raise ValueError(f"invalid cell path {path!r}")
+    names = [name[2:] for name in names]
+
+    top_level_cells = {c.name: c for c in lib.top_level()}
+    if names[0] not in top_level_cells:
+        raise KeyError(f"unknown top level cell {names[0]!r}")
+    cell = top_level_cells[names[0]]
+    matrices = np.eye(2, 3)[None]
+    # derived layers the ancestors evaluate on their flattened hierarchy
+    hidden = frozenset()
+    memo = {}
+    for name in names[1:]:
+        hidden |= get_flattened_layers(cell, {}, memo)
+        references = [r for r in get_references(cell) if r["cell"].name == name]
+        if not references:
+            raise KeyError(f"cell {cell.name!r} does not reference {name!r}")
+        cell = references[0]["cell"]
+        matrices = compose_matrices(matrices, references[0]["matrices"])
+
+    output = get_output_options(lib, encoding, mesh, compact_transforms)
+    poly_assembly = get_assembly(lib, output)
+    cell_cache = get_cell_cache(
+        [cell],
+        workers,
+        max_depth=max_depth,
+        top_placements=[len(matrices)],
+        cache_dir=cache_dir,
+        cache_size=cache_size,
+        merge_layers=get_merge_layers(merge_cuts) if merge else None,
+    )
+    pool = {}
+    instance_index, cell_parts = get_top_parts(
+        cell,
+        path,
+        matrices,
+        poly_assembly,
+        0,
+        cell_cache,
+        pool=pool,
+        max_depth=max_depth,
+        lod=lod,
+        output=output,
+        hidden=hidden,
+    )
+    poly_assembly["parts"].append(cell_parts)
 
     if return_json:
-        return orjson.dumps(numpy_to_buffer_json(poly_assembly)).decode("utf-8")
+        codecs = get_codecs() if compress else None
+        return orjson.dumps(numpy_to_buffer_json(poly_assembly, codecs)).decode("utf-8")
     else:
         return poly_assembly
 
 
-# %%
-if __name__ == "__main__":
-    import sys
+def poll(filename, export, state):
+    """One polling step of watch, returns True if export was called.
 
-    if len(sys.argv) == 2:
-        example = int(sys.argv[1])
+    state is {"previous": (mtime, size) at the last poll, "exported": at the
+    last export}. The file is only read once its size and mtime are the same
+    as at the last poll, so half written files are skipped. A failed export
+    is reported and the file is not read again until it changes.
+    """
+    try:
+        stat = os.stat(filename)
+        current = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        current = None
+
+    previous = state.get("previous")
+    state["previous"] = current
+    if current is None or current != previous or current == state.get("exported"):
+        return False
+
+    start = time.time()
+    try:
+        export(read_gds(filename))
+    except Exception as error:  # keep watching after a broken write
+        print(f"export of {filename} failed: {error}")
     else:
-        example = 2
+        print(f"exported {filename} in {time.time() - start:.3f}s")
+    state["exported"] = current
+    return True
+
+
+def watch(filename, export, interval=0.2):
+    """Call export(lib) with the library in filename whenever the file changes.
+
+    The file is polled every interval seconds (see poll). Combined with the
+    cell cache (see to_json) only the cells changed since the last export are
+    analyzed again, the output itself is serialized again in full (export
+    should write it with write_stream_if_changed). Runs until interrupted.
+    """
+    state = {}
+    while True:
+        poll(filename, export, state)
+        time.sleep(interval)
+
+
+# %%
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert a GDS example for the viewer")
+    parser.add_argument("example", type=int, nargs="?", default=2)
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="write viewer/data/<name>.json manifest plus <name>.bin buffer",
+    )
+    parser.add_argument(
+        "--tiles",
+        type=int,
+        nargs="?",
+        const=4096,
+        default=None,
+        metavar="N",
+        help="write per-layer quadtree tiles of at most N polygons to viewer/data",
+    )
+    parser.add_argument(
+        "--lod",
+        action="store_true",
+        help="add bounding box and outline levels of detail to the cell parts",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="merge overlapping polygons per cell and layer (not via/contact layers)",
+    )
+    parser.add_argument(
+        "--merge-cuts",
+        action="store_true",
+        help="with --merge, merge via and contact layers too",
+    )
+    parser.add_argument(
+        "--encoding",
+        choices=["float", "int"],
+        default="float",
+        help="float32 buffers or int16/int32 database units",
+    )
+    parser.add_argument(
+        "--mesh",
+        action="store_true",
+        help="emit pre-triangulated extruded meshes instead of polygon outlines",
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        help="delta/shuffle/deflate codecs for the JSON buffers, smallest per buffer",
+    )
+    parser.add_argument(
+        "--compact-transforms",
+        action="store_true",
+        help="store matrices as orientation code plus translation",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="one instanced batch per layer and template across the hierarchy",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="with --batch, drop placements stacked at identical transforms",
+    )
+    parser.add_argument(
+        "--collapse",
+        action="store_true",
+        help="one part per unique cell instead of the per-path hierarchy",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="worker processes for the geometry analysis (0 = all cores)",
+    )
+    parser.add_argument(
+        "--max-depth",
+        type=int,
+        default=None,
+        help="convert only this many hierarchy levels, deeper cells become placeholders",
+    )
+    parser.add_argument(
+        "--cache",
+        nargs="?",
+        const=".cell_cache",
+        default=None,
+        metavar="DIR",
+        help="persistent cell cache directory (default .cell_cache)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=512,
+        help="maximum cell cache size in MB",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="re-export whenever the GDS file changes (implies --cache)",
+    )
+    args = parser.parse_args()
+    if args.lod and args.max_depth is not None:
+        parser.error("--lod cannot be combined with --max-depth")
+    if args.compress and (args.binary or args.tiles):
+        parser.error(
+            "--compress only applies to the JSON output, not --binary or --tiles"
+        )
+    if args.batch and (args.collapse or args.max_depth is not None):
+        parser.error("--batch cannot be combined with --collapse or --max-depth")
+    if args.dedup and not args.batch:
+        parser.error("--dedup only applies with --batch")
+    workers = os.cpu_count() if args.workers == 0 else args.workers
+    example = args.example
+    if args.watch and args.cache is None:
+        args.cache = ".cell_cache"
+    options = dict(
+        collapse=args.collapse,
+        workers=workers,
+        max_depth=args.max_depth,
+        cache_dir=args.cache,
+        cache_size=args.cache_size * 2**20,
+        lod=args.lod,
+        merge=args.merge,
+        merge_cuts=args.merge_cuts,
+        encoding=args.encoding,
+        mesh=args.mesh,
+        compress=args.compress,
+        compact_transforms=args.compact_transforms,
+        batch=args.batch,
+        dedup=args.dedup,
+    )
 
     if example == 1:
 
@@ -418,14 +2256,14 @@ if __name__ == "__main__":
         # c = gf.c.straight_heater_doped_rib(length=100)
         # c.write_gds("straight_heater_doped_rib.gds")
 
-        c = gdstk.read_gds("examples/straight_heater_doped_rib.gds")
+        filename = "examples/straight_heater_doped_rib.gds"
 
         name = "straight_heater_doped"
 
     elif example == 2:
         init_sky130()
 
-        c = gdstk.read_gds("examples/example_sky130.gds")
+        filename = "examples/example_sky130.gds"
         name = "sky130"
 
         # polydrawing_m:    polygons:   3626 points:   42794
@@ -448,7 +2286,7 @@ if __name__ == "__main__":
     elif example == 3:
         init_sky130()
 
-        c = gdstk.read_gds("examples/sram_2_16_sky130A.gds")
+        filename = "examples/sram_2_16_sky130A.gds"
         name = "sram_2_16"
 
         # polydrawing_m:    polygons:   515 points:   6764
@@ -468,7 +2306,7 @@ if __name__ == "__main__":
     elif example == 4:
         init_sky130()
 
-        c = gdstk.read_gds("examples/sram_32_1024_sky130A.gds")
+        filename = "examples/sram_32_1024_sky130A.gds"
         name = "sram_32_1024"
 
         # polydrawing_m:   polygons:  70406 points: 1014418
@@ -492,13 +2330,42 @@ if __name__ == "__main__":
         # c = gf.c.straight_heater_doped_rib(length=100)
         # c.write_gds("straight_heater_doped_rib.gds")
 
-        c = gdstk.read_gds("ref.gds")
+        filename = "ref.gds"
 
         name = "ref"
 
-    with open(f"viewer/js/{name}.js", "w") as fd:
-        j = to_json(c, return_json=True)
-        if not DEBUG:
-            fd.write(f"const {name} = {j};")
+    def export(c):
+        if args.tiles:
+            os.makedirs("viewer/data", exist_ok=True)
+            manifest = write_tiles(
+                to_json(c, return_json=False, **options),
+                f"viewer/data/{name}",
+                args.tiles,
+            )
+            print(f"{len(manifest['tiles'])} tiles")
+        elif args.binary:
+            os.makedirs("viewer/data", exist_ok=True)
+            write_buffer_bin(
+                to_json(c, return_json=False, **options),
+                f"viewer/data/{name}",
+            )
+        elif DEBUG:
+            to_json(c, return_json=False, **options)
+        elif args.watch:
+            # stream to a temp file, keep the file untouched if nothing changed
+            write_stream_if_changed(
+                f"viewer/js/{name}.js",
+                lambda fd: to_json(
+                    c, fd=fd, prefix=f"const {name} = ", suffix=";", **options
+                ),
+            )
+        else:
+            with open(f"viewer/js/{name}.js", "wb") as fd:
+                to_json(c, fd=fd, prefix=f"const {name} = ", suffix=";", **options)
+
+    if args.watch:
+        watch(filename, export)
+    else:
+        export(read_gds(filename))
 
     # %%
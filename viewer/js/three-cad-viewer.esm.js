@@ -59642,6 +59642,46 @@ class NestedGroup {
     return group;
   }
 
+  // Merge the {vertices, triangles} meshes of refs into one indexed geometry
+  _meshGeometry(refs) {
+    const meshes = refs.map((ref) => this.instances[ref]);
+    const geometry = new BufferGeometry();
+    if (meshes.length == 1) {
+      geometry.setAttribute(
+        "position",
+        new BufferAttribute(meshes[0].vertices, 3),
+      );
+      geometry.setIndex(new BufferAttribute(meshes[0].triangles, 1));
+    } else {
+      var vertexCount = 0;
+      var indexCount = 0;
+      for (const mesh of meshes) {
+        vertexCount += mesh.vertices.length / 3;
+        indexCount += mesh.triangles.length;
+      }
+      const positions = new Float32Array(3 * vertexCount);
+      const index =
+        vertexCount > 65535
+          ? new Uint32Array(indexCount)
+          : new Uint16Array(indexCount);
+      var offset = 0;
+      var start = 0;
+      for (const mesh of meshes) {
+        positions.set(mesh.vertices, 3 * offset);
+        for (let i = 0; i < mesh.triangles.length; i++) {
+          index[start + i] = mesh.triangles[i] + offset;
+        }
+        offset += mesh.vertices.length / 3;
+        start += mesh.triangles.length;
+      }
+      geometry.setAttribute("position", new BufferAttribute(positions, 3));
+      geometry.setIndex(new BufferAttribute(index, 1));
+    }
+    // side vertices are not shared between faces, so the normals stay flat
+    geometry.computeVertexNormals();
+    return geometry;
+  }
+
   renderInstancedPolygon(
     shape,
     color,
@@ -59667,24 +59707,32 @@ class NestedGroup {
     group.name = path.replaceAll("/", this.delim);
     this.groups[path] = group;
 
-    var polygons = [];
     var matrices = shape.matrices;
-    for (var ref of shape.refs) {
-      var vertices = this.instances[ref];
-      const n = vertices.length / 2;
-      const points = new Array(n);
-      for (let i = 0; i < n; i++) {
-        points[i] = new Vector2(vertices[2 * i], vertices[2 * i + 1]);
+    var polyGeometry;
+    // pre-triangulated unit height meshes are scaled to the height per instance
+    var depthScale = 1;
+    if (this.instances[shape.refs[0]].vertices) {
+      polyGeometry = this._meshGeometry(shape.refs);
+      depthScale = shape.height;
+    } else {
+      var polygons = [];
+      for (var ref of shape.refs) {
+        var vertices = this.instances[ref];
+        const n = vertices.length / 2;
+        const points = new Array(n);
+        for (let i = 0; i < n; i++) {
+          points[i] = new Vector2(vertices[2 * i], vertices[2 * i + 1]);
+        }
+        const polygon = new Shape(points);
+        polygons.push(polygon);
       }
-      const polygon = new Shape(points);
-      polygons.push(polygon);
-    }
 
-    const extrudeSettings = {
-      depth: shape.height,
-      bevelEnabled: false,
-    };
-    const polyGeometry = new ExtrudeGeometry(polygons, extrudeSettings);
+      const extrudeSettings = {
+        depth: shape.height,
+        bevelEnabled: false,
+      };
+      polyGeometry = new ExtrudeGeometry(polygons, extrudeSettings);
+    }
 
     // see https://stackoverflow.com/a/37651610
     // "A common draw configuration you see is to draw all the opaque object with depth testing on,
@@ -59796,7 +59844,7 @@ class NestedGroup {
         matrices[6 * i + 5],
         0,
         0,
-        1,
+        depthScale,
         0,
         0,
         0,